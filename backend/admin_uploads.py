@@ -8,6 +8,8 @@ import shutil
 from pathlib import Path
 import PyPDF2
 import io
+from collections import Counter
+import pii
 
 @app.post("/admin/upload-documents")
 async def upload_documents(
@@ -55,6 +57,7 @@ async def upload_documents(
             try:
                 pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
                 pages_extracted = 0
+                masked = Counter()
                 
                 for page_num, pdf_page in enumerate(pdf_reader.pages, 1):
                     try:
@@ -63,7 +66,7 @@ async def upload_documents(
                             page = models.Page(
                                 document_id=document.id,
                                 page_num=page_num,
-                                text_content=text[:10000],
+                                text_content=pii.masker.mask(text, masked)[0][:10000],
                                 text_quality=0.7,
                                 media_type='pdf_page'
                             )
@@ -76,6 +79,7 @@ async def upload_documents(
                 uploaded.append({
                     "filename": file.filename,
                     "pages": pages_extracted,
+                    "masked": dict(masked),
                     "document_id": document.id
                 })
                 
@@ -0,0 +1,430 @@
+"""
+Autocomplete
+In-memory prefix index over entity names, normalized names and document
+filenames, so type-ahead never touches the database.
+
+Completions live in one sorted array of keys: a prefix lookup is a bisect to
+the matching range, and the heaviest entries in it (by mention count) win.
+Every word start of a label is a key, so "epst" finds "Jeffrey Epstein".
+Prefixes of up to CACHED_PREFIX_CHARS characters, whose ranges are huge, keep
+a precomputed top-k list that updates maintain instead of invalidating.
+
+State is a snapshot file plus an append-only journal. Ingesters append to the
+journal through corpus_events; a background thread in the API applies new
+journal lines in batches and folds them into the snapshot once the journal
+grows. Each batch builds a new generation of the arrays and swaps it in, so
+lookups never wait for an update (or for the first load).
+"""
+import os
+import re
+import json
+import time
+import heapq
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import List
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+try:
+    from backend.database import BASE_DIR
+except ImportError:
+    from database import BASE_DIR
+
+SNAPSHOT_PATH = os.getenv("AUTOCOMPLETE_SNAPSHOT", os.path.join(BASE_DIR, "autocomplete.json"))
+# Seconds between checks for journal lines written by other processes
+REFRESH_SECONDS = float(os.getenv("AUTOCOMPLETE_REFRESH_SECONDS", "1"))
+# Journal size that triggers folding it into the snapshot
+COMPACT_BYTES = int(os.getenv("AUTOCOMPLETE_COMPACT_BYTES", str(4 * 1024 * 1024)))
+# Short prefixes match huge ranges; their top-k lists are precomputed
+CACHED_PREFIX_CHARS = 3
+# Entries kept per precomputed list, enough for limit=50 after dropping repeated labels
+TOPK_DEPTH = 64
+
+KINDS = {"entity": "e", "document": "d"}
+KIND_NAMES = {v: k for k, v in KINDS.items()}
+
+
+def normalize(value: str) -> str:
+    return " ".join(re.findall(r"\w+", (value or "").lower()))
+
+
+def _word_starts(value: str) -> List[str]:
+    words = normalize(value).split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+class _View:
+    """One generation of the index. Never modified once published, so lookups need no lock."""
+    __slots__ = ("entries", "keys", "topk")
+
+    def __init__(self, entries: dict = None, keys: list = None, topk: dict = None):
+        # (kind code, id) -> (label, alt, weight)
+        self.entries = entries or {}
+        # ("<key>\0<kind code><id>", (kind code, id)), sorted
+        self.keys = keys or []
+        # prefix of up to CACHED_PREFIX_CHARS -> heaviest refs, best first
+        self.topk = topk or {}
+
+
+class PrefixIndex:
+    """Sorted-array prefix index with weighted top-k completion."""
+
+    def __init__(self, snapshot_path: str = SNAPSHOT_PATH):
+        self.snapshot_path = snapshot_path
+        self.journal_path = os.path.splitext(snapshot_path)[0] + ".journal"
+
+        # Serializes writers (load, refresh, compact); lookups read self._view
+        self._mutex = threading.RLock()
+        self._view = _View()
+        self._refresher = None
+
+        self._loaded = False
+        self._snapshot_mtime = None
+        self._journal_ino = None
+        self._journal_offset = 0
+        self._checked_at = 0.0
+
+    # -- lookups --------------------------------------------------------------
+
+    def complete(self, prefix: str, limit: int = 8) -> List[dict]:
+        """Top completions as [{"text", "kind", "weight"}], heaviest first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        view = self._view
+
+        if len(prefix) <= CACHED_PREFIX_CHARS:
+            ranked = view.topk.get(prefix, [])
+            results = self._distinct(view, ranked, limit)
+            # A short list holds every entry under the prefix
+            if len(results) >= limit or len(ranked) < TOPK_DEPTH:
+                return results
+        ranked = self._ranked(view.keys, view.entries, prefix, max(limit * 3, TOPK_DEPTH))
+        return self._distinct(view, ranked, limit)
+
+    @staticmethod
+    def _distinct(view: _View, ranked: list, limit: int) -> List[dict]:
+        seen = set()
+        results = []
+        for ref in ranked:
+            label, _, weight = view.entries[ref]
+            if label not in seen:
+                seen.add(label)
+                results.append({"text": label, "kind": KIND_NAMES[ref[0]], "weight": weight})
+                if len(results) >= limit:
+                    break
+        return results
+
+    @staticmethod
+    def _ranked(keys: list, entries: dict, prefix: str, depth: int) -> list:
+        """The `depth` heaviest refs with a key under `prefix` (ties by ref)."""
+        lo = bisect.bisect_left(keys, (prefix,))
+        hi = bisect.bisect_left(keys, (prefix + "\uffff",))
+        refs = {keys[i][1] for i in range(lo, hi)}
+        return heapq.nsmallest(depth, refs, key=lambda ref: (-entries[ref][2], ref))
+
+    def __len__(self):
+        return len(self._view.entries)
+
+    # -- updates --------------------------------------------------------------
+
+    @staticmethod
+    def _keys_for(ref: tuple, entry: tuple) -> set:
+        suffix = f"\0{ref[0]}{ref[1]}"
+        keys = set(_word_starts(entry[0]))
+        if entry[1]:
+            keys.update(_word_starts(entry[1]))
+        return {k + suffix for k in keys if k}
+
+    @staticmethod
+    def _prefixes(entry: tuple) -> set:
+        """The short prefixes with precomputed top-k lists that this entry appears under."""
+        words = set(_word_starts(entry[0]))
+        if entry[1]:
+            words.update(_word_starts(entry[1]))
+        return {w[:n] for w in words for n in range(1, min(len(w), CACHED_PREFIX_CHARS) + 1)}
+
+    def _build_topk(self, entries: dict) -> dict:
+        by_prefix = {}
+        for ref, entry in entries.items():
+            for p in self._prefixes(entry):
+                by_prefix.setdefault(p, []).append(ref)
+        rank = lambda ref: (-entries[ref][2], ref)
+        return {p: heapq.nsmallest(TOPK_DEPTH, refs, key=rank) for p, refs in by_prefix.items()}
+
+    def _apply_batch(self, records: List[dict]):
+        """
+        Apply journal records to a copy of the current view and publish it.
+        New keys are sorted into the array in one merge, and only the top-k
+        lists of prefixes the changed entries appear under are updated.
+        """
+        view = self._view
+        entries = dict(view.entries)
+        before = {}
+        for record in records:
+            op = record.get("op")
+            if op == "add":
+                ref = (KINDS[record["kind"]], record["id"])
+                current = entries.get(ref)
+                weight = max(current[2] if current else 0, record.get("weight", 0))
+                entry = (record["label"], record.get("alt"), weight)
+            elif op == "mention":
+                ref = (KINDS["entity"], record["id"])
+                current = entries.get(ref)
+                if not current:
+                    continue
+                entry = (current[0], current[1], max(0, current[2] + record.get("n", 1)))
+            else:
+                continue
+            before.setdefault(ref, view.entries.get(ref))
+            entries[ref] = entry
+        if not before:
+            return
+
+        removed, added = set(), []
+        for ref, old in before.items():
+            new = entries[ref]
+            if old and old[:2] == new[:2]:
+                continue
+            old_keys = self._keys_for(ref, old) if old else set()
+            new_keys = self._keys_for(ref, new)
+            removed.update((k, ref) for k in old_keys - new_keys)
+            added.extend((k, ref) for k in new_keys - old_keys)
+        keys = view.keys
+        if removed:
+            keys = [item for item in keys if item not in removed]
+        if added:
+            # Two sorted runs: the sort is a single linear merge
+            keys = keys + sorted(added)
+            keys.sort()
+
+        topk = self._update_topk(view.topk, keys, entries, before)
+        self._view = _View(entries, keys, topk)
+
+    def _update_topk(self, topk: dict, keys: list, entries: dict, before: dict) -> dict:
+        touched = {}
+        for ref, old in before.items():
+            new = entries[ref]
+            now = self._prefixes(new)
+            was = self._prefixes(old) if old else set()
+            for p in now | was:
+                touched.setdefault(p, []).append((ref, p in now, old is not None and new[2] < old[2]))
+
+        topk = dict(topk)
+        rank = lambda ref: (-entries[ref][2], ref)
+        for p, changes in touched.items():
+            ranked = topk.get(p, [])
+            listed = set(ranked)
+            if len(ranked) >= TOPK_DEPTH and any(ref in listed and (not applies or lighter)
+                                                 for ref, applies, lighter in changes):
+                # A listed entry left or lost weight; one outside the list may now rank higher
+                topk[p] = self._ranked(keys, entries, p, TOPK_DEPTH)
+                continue
+            refs = listed.union(ref for ref, applies, _ in changes if applies)
+            refs.difference_update(ref for ref, applies, _ in changes if not applies)
+            if refs:
+                topk[p] = heapq.nsmallest(TOPK_DEPTH, refs, key=rank)
+            else:
+                topk.pop(p, None)
+        return topk
+
+    def _replace_all(self, rows: list):
+        entries = {}
+        keyed = []
+        for kind, ref_id, label, alt, weight in rows:
+            ref = (KINDS[kind], ref_id)
+            entry = (label, alt, weight)
+            entries[ref] = entry
+            keyed.extend((key, ref) for key in self._keys_for(ref, entry))
+        keyed.sort()
+        self._view = _View(entries, keyed, self._build_topk(entries))
+
+    # -- persistence ----------------------------------------------------------
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        with open(self.snapshot_path + ".lock", "a+") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def append(self, records: List[dict]):
+        """Journal updates for every process serving completions (called by ingesters)."""
+        if not records:
+            return
+        payload = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        with self._file_lock():
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(payload)
+
+    def _rows(self) -> list:
+        return [
+            [KIND_NAMES[kind], ref_id, label, alt, weight]
+            for (kind, ref_id), (label, alt, weight) in self._view.entries.items()
+        ]
+
+    def _write_snapshot(self, rows: list):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"built_at": time.time(), "entries": rows}, f, separators=(",", ":"))
+        os.replace(tmp, self.snapshot_path)
+
+    def _reset_journal(self):
+        tmp = self.journal_path + ".tmp"
+        open(tmp, "w").close()
+        os.replace(tmp, self.journal_path)
+
+    def load(self, build=None):
+        """
+        Load the snapshot, or build it with `build()` (rows of
+        [kind, id, label, alt, weight]) when there is none yet.
+        """
+        with self._mutex:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                    self._replace_all(json.load(f)["entries"])
+                self._snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+            elif build is not None:
+                with self._file_lock():
+                    rows = build()
+                    self._replace_all(rows)
+                    self._write_snapshot(rows)
+                    self._reset_journal()
+                self._snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+            self._journal_ino = None
+            self._journal_offset = 0
+            self._loaded = True
+            self._checked_at = 0.0
+        self.refresh()
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(REFRESH_SECONDS)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Autocomplete refresh failed: {e}")
+
+    def refresh(self):
+        """
+        Apply journal lines written since the last check; compact a large
+        journal. Runs on the refresher thread, not in lookups.
+        """
+        now = time.time()
+        if not self._loaded or now - self._checked_at < REFRESH_SECONDS:
+            return
+        with self._mutex:
+            self._checked_at = now
+            if os.path.exists(self.snapshot_path) and \
+                    os.stat(self.snapshot_path).st_mtime_ns != self._snapshot_mtime:
+                # Another process compacted: its snapshot already has every journal line
+                self.load()
+                return
+            try:
+                stat = os.stat(self.journal_path)
+            except FileNotFoundError:
+                return
+            if stat.st_ino != self._journal_ino:
+                self._journal_ino = stat.st_ino
+                self._journal_offset = 0
+            if stat.st_size > self._journal_offset:
+                with open(self.journal_path, "r", encoding="utf-8") as f:
+                    f.seek(self._journal_offset)
+                    chunk = f.read()
+                # A line still being written has no newline yet; leave it for next time
+                complete = chunk[:chunk.rfind("\n") + 1]
+                self._apply_batch([json.loads(line) for line in complete.splitlines() if line.strip()])
+                self._journal_offset += len(complete.encode("utf-8"))
+            if self._journal_offset > COMPACT_BYTES:
+                self.compact()
+
+    def compact(self):
+        """Fold the journal into a new snapshot."""
+        with self._mutex, self._file_lock():
+            # Lines appended since the last refresh are still owed to this process
+            stat = os.stat(self.journal_path) if os.path.exists(self.journal_path) else None
+            if stat and stat.st_ino == self._journal_ino and stat.st_size > self._journal_offset:
+                with open(self.journal_path, "r", encoding="utf-8") as f:
+                    f.seek(self._journal_offset)
+                    self._apply_batch([json.loads(line) for line in f.read().splitlines() if line.strip()])
+            self._write_snapshot(self._rows())
+            self._reset_journal()
+            self._snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+            self._journal_ino = os.stat(self.journal_path).st_ino
+            self._journal_offset = 0
+
+
+def build_rows() -> list:
+    """Every entity (weighted by page mentions) and document filename in the database."""
+    try:
+        from backend.database import SessionLocal
+        from backend.models import Entity, PageEntity, Document
+    except ImportError:
+        from database import SessionLocal
+        from models import Entity, PageEntity, Document
+    from sqlalchemy import func
+
+    db = SessionLocal()
+    try:
+        mentions = dict(
+            db.query(PageEntity.entity_id, func.count(PageEntity.id)).group_by(PageEntity.entity_id).all()
+        )
+        rows = [
+            ["entity", e.id, e.name, e.normalized_name if e.normalized_name != e.name else None, mentions.get(e.id, 0)]
+            for e in db.query(Entity.id, Entity.name, Entity.normalized_name).yield_per(10000)
+            if e.name
+        ]
+        rows.extend(
+            ["document", d.id, d.filename, None, 0]
+            for d in db.query(Document.id, Document.filename).yield_per(10000)
+            if d.filename
+        )
+        return rows
+    finally:
+        db.close()
+
+
+def journal_records(changes: dict) -> List[dict]:
+    """Journal lines for the entities, documents and mentions in a corpus_events commit."""
+    records = []
+    for e in changes.get("entities", {}).values():
+        alt = e.normalized_name if e.normalized_name != e.name else None
+        records.append({"op": "add", "kind": "entity", "id": e.id, "label": e.name, "alt": alt})
+    for d in changes.get("documents", {}).values():
+        records.append({"op": "add", "kind": "document", "id": d.id, "label": d.filename})
+    for entity_id, count in changes.get("entity_mentions", {}).items():
+        if count:
+            records.append({"op": "mention", "id": entity_id, "n": count})
+    return records
+
+
+index = PrefixIndex()
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_index() -> PrefixIndex:
+    """
+    The shared index. The first call starts loading (or building) it in the
+    background; completions are empty until it is ready.
+    """
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                _loader = threading.Thread(target=index.load, kwargs={"build": build_rows}, daemon=True)
+                _loader.start()
+    return index
@@ -0,0 +1,241 @@
+"""
+Bulk Loader
+Writes pages and page-entity links without ORM objects, for imports of whole
+releases. Postgres streams rows with COPY FROM STDIN (CSV), SQLite uses
+executemany with loader pragmas. Both run on the session's own connection and
+transaction, so a load commits or rolls back with the ORM writes around it
+(the document rows, new entities) and is handed to corpus_events on commit
+like any other write.
+
+IDs are assigned up front and returned: from the table's sequence on
+Postgres; on SQLite the first row is inserted normally and the rest follow its
+rowid, which is safe because the transaction holds the write lock.
+
+With defer_indexes=True the secondary indexes of pages and page_entities and
+the full-text triggers are dropped for the load and rebuilt by finish(), which
+must run before the commit. The drop is part of the transaction, so a failed
+load leaves them in place. On Postgres it also locks the tables until commit.
+
+    with BulkLoader(db, defer_indexes=True) as loader:
+        page_ids = loader.add_pages(rows)
+        loader.add_page_entities(links)
+    db.commit()
+"""
+import io
+from typing import List
+from sqlalchemy.orm import Session
+
+try:
+    from backend import corpus_events
+    from backend.search_schema import SQLITE_FTS_TABLE
+except ImportError:
+    import corpus_events
+    from search_schema import SQLITE_FTS_TABLE
+
+PAGE_COLUMNS = ("document_id", "page_num", "text_content", "text_quality", "media_type")
+PAGE_ENTITY_COLUMNS = ("page_id", "entity_id", "frequency")
+DEFAULTS = {"frequency": 1}
+DEFERRED_TABLES = ("pages", "page_entities")
+# Applied to the loading connection and restored by finish(): a 256MB page
+# cache keeps index pages hot across executemany batches. synchronous and
+# temp_store can't change inside a transaction; one large transaction only
+# syncs at commit anyway.
+SQLITE_LOAD_PRAGMAS = {"cache_size": "-262144"}
+# Rows per COPY stream / executemany call
+CHUNK_ROWS = 5000
+
+
+def _csv_field(value) -> str:
+    """
+    One field of a CSV COPY row. NULL is an unquoted \\N and every string is
+    quoted, so neither '' nor a literal '\\N' is read back as NULL.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        # NUL can't be stored in Postgres text
+        return '"' + value.replace("\x00", "").replace('"', '""') + '"'
+    return str(value)
+
+
+class BulkLoader:
+    """Batched page and page_entities inserts on a session's connection."""
+
+    def __init__(self, db: Session, defer_indexes: bool = False):
+        self.db = db
+        # ORM writes queued so far must reach the database before the rows that reference them
+        db.flush()
+        self.dialect = db.bind.dialect.name
+        self.raw = db.connection().connection.driver_connection
+        self.defer_indexes = defer_indexes
+        self._deferred = []
+        self._fts_trigger = None
+        self._pragmas = {}
+        # Highest page id before the load; pages above it need full-text entries
+        self._start_id = None
+        self._finished = False
+        if self.dialect == "sqlite":
+            # The sqlite3 module only opens a transaction before DML, so DDL would
+            # otherwise autocommit; IMMEDIATE also takes the write lock up front
+            if not self.raw.in_transaction:
+                self.raw.execute("BEGIN IMMEDIATE")
+            self._set_pragmas()
+        if defer_indexes:
+            self._drop_deferred()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self._restore_pragmas()
+        return False
+
+    # -- loading --------------------------------------------------------------
+
+    def add_pages(self, rows: List[dict]) -> List[int]:
+        """Insert page dicts (document_id, page_num, text_content, ...); returns their new ids in order."""
+        ids = self._load("pages", PAGE_COLUMNS, rows)
+        corpus_events.note_pages(self.db, [dict(row, id=page_id) for row, page_id in zip(rows, ids)])
+        return ids
+
+    def add_page_entities(self, rows: List[dict]) -> List[int]:
+        """Insert page_entities dicts (page_id, entity_id[, frequency]); returns their new ids in order."""
+        ids = self._load("page_entities", PAGE_ENTITY_COLUMNS, rows)
+        corpus_events.note_page_entities(self.db, rows)
+        return ids
+
+    def _load(self, table: str, columns: tuple, rows: List[dict]) -> List[int]:
+        if not rows:
+            return []
+        values = [tuple(row.get(c, DEFAULTS.get(c)) for c in columns) for row in rows]
+        if self.dialect == "postgresql":
+            return self._copy(table, columns, values)
+        if self.dialect == "sqlite":
+            return self._executemany(table, columns, values)
+        raise ValueError(f"Bulk loading is not supported on {self.dialect}")
+
+    def _copy(self, table: str, columns: tuple, values: list) -> List[int]:
+        cur = self.raw.cursor()
+        try:
+            cur.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                (table, len(values))
+            )
+            ids = [row[0] for row in cur.fetchall()]
+            sql = f"COPY {table} (id, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+            for start in range(0, len(values), CHUNK_ROWS):
+                buf = io.StringIO()
+                for page_id, row in zip(ids[start:start + CHUNK_ROWS], values[start:start + CHUNK_ROWS]):
+                    buf.write(",".join([str(page_id)] + [_csv_field(v) for v in row]) + "\n")
+                buf.seek(0)
+                if hasattr(cur, "copy_expert"):  # psycopg2
+                    cur.copy_expert(sql, buf)
+                else:  # psycopg 3
+                    with cur.copy(sql) as copy:
+                        copy.write(buf.getvalue())
+        finally:
+            cur.close()
+        return ids
+
+    def _executemany(self, table: str, columns: tuple, values: list) -> List[int]:
+        cur = self.raw.cursor()
+        try:
+            placeholders = ", ".join("?" for _ in columns)
+            cur.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", values[0])
+            first = cur.lastrowid
+            ids = list(range(first, first + len(values)))
+            sql = f"INSERT INTO {table} (id, {', '.join(columns)}) VALUES (?, {placeholders})"
+            for start in range(1, len(values), CHUNK_ROWS):
+                cur.executemany(sql, [
+                    (row_id,) + row
+                    for row_id, row in zip(ids[start:start + CHUNK_ROWS], values[start:start + CHUNK_ROWS])
+                ])
+        finally:
+            cur.close()
+        return ids
+
+    # -- deferred maintenance -------------------------------------------------
+
+    def _drop_deferred(self):
+        cur = self.raw.cursor()
+        try:
+            cur.execute("SELECT coalesce(max(id), 0) FROM pages")
+            self._start_id = cur.fetchone()[0]
+            if self.dialect == "postgresql":
+                # Constraint-backed indexes (primary keys, unique constraints) stay
+                cur.execute("""
+                    SELECT i.indexname, i.indexdef FROM pg_indexes i
+                    WHERE i.tablename = ANY(%s) AND i.schemaname = current_schema()
+                      AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)
+                """, (list(DEFERRED_TABLES),))
+                self._deferred = cur.fetchall()
+                for name, _ in self._deferred:
+                    cur.execute(f'DROP INDEX "{name}"')
+                cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'pages_search_vector_trigger'")
+                if cur.fetchone():
+                    self._fts_trigger = "pages_search_vector_trigger"
+                    cur.execute(f"ALTER TABLE pages DISABLE TRIGGER {self._fts_trigger}")
+            elif self.dialect == "sqlite":
+                marks = ", ".join("?" for _ in DEFERRED_TABLES)
+                cur.execute(
+                    f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({marks})",
+                    DEFERRED_TABLES
+                )
+                self._deferred = cur.fetchall()
+                for name, _ in self._deferred:
+                    cur.execute(f'DROP INDEX "{name}"')
+                cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'pages_fts_ai'")
+                found = cur.fetchone()
+                if found:
+                    self._fts_trigger = found[0]
+                    cur.execute("DROP TRIGGER pages_fts_ai")
+        finally:
+            cur.close()
+
+    def finish(self):
+        """Rebuild deferred indexes and catch the full-text index up on the loaded pages."""
+        if self._finished:
+            return
+        self._finished = True
+        cur = self.raw.cursor()
+        try:
+            # Dropping the indexes locked out other writers, so every page above
+            # _start_id was written by this transaction without full-text maintenance
+            if self._fts_trigger and self.dialect == "postgresql":
+                cur.execute(f"ALTER TABLE pages ENABLE TRIGGER {self._fts_trigger}")
+                # A no-op update of text_content runs the vector trigger, with its size guard
+                cur.execute("UPDATE pages SET text_content = text_content WHERE id > %s", (self._start_id,))
+            elif self._fts_trigger:
+                cur.execute(
+                    f"INSERT INTO {SQLITE_FTS_TABLE}(rowid, text_content) SELECT id, text_content FROM pages WHERE id > ?",
+                    (self._start_id,)
+                )
+                cur.execute(self._fts_trigger)
+            for _, ddl in self._deferred:
+                cur.execute(ddl)
+        finally:
+            cur.close()
+            self._restore_pragmas()
+
+    def _set_pragmas(self):
+        cur = self.raw.cursor()
+        try:
+            for name, value in SQLITE_LOAD_PRAGMAS.items():
+                self._pragmas[name] = cur.execute(f"PRAGMA {name}").fetchone()[0]
+                cur.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cur.close()
+
+    def _restore_pragmas(self):
+        if not self._pragmas:
+            return
+        cur = self.raw.cursor()
+        try:
+            for name, value in self._pragmas.items():
+                cur.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cur.close()
+        self._pragmas = {}
@@ -0,0 +1,155 @@
+"""
+Corpus Events
+Collects pages, narratives and flight logs written through SessionLocal sessions
+and hands them to the search layer once the transaction commits. New entities,
+documents and entity mentions go to the autocomplete journal the same way, and
+new pages are matched against the saved watch queries (percolator). Every ingester
+(ingestion/main.py, the scrapers, the archive importer, /admin/upload-documents)
+uses SessionLocal, so none of them has to call the indexer directly.
+"""
+from types import SimpleNamespace
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+try:
+    from backend.models import Page, PageEntity, AINarrative, FlightLog, Entity, Document
+except ImportError:
+    from models import Page, PageEntity, AINarrative, FlightLog, Entity, Document
+
+PENDING_KEY = "corpus_pending"
+
+
+def install(session_factory):
+    event.listen(session_factory, "after_flush", _collect)
+    event.listen(session_factory, "after_commit", _dispatch)
+    event.listen(session_factory, "after_rollback", _discard)
+
+
+def _pending(session) -> dict:
+    if PENDING_KEY not in session.info:
+        session.info[PENDING_KEY] = {
+            "pages": {}, "deleted_pages": set(), "entity_pages": set(), "narratives": {}, "flights": {},
+            "entities": {}, "documents": {}, "entity_mentions": {},
+        }
+    return session.info[PENDING_KEY]
+
+
+def _snapshot(obj, columns) -> SimpleNamespace:
+    # Committed objects are expired and can't be refreshed from inside after_commit
+    return SimpleNamespace(**{c: getattr(obj, c) for c in columns})
+
+
+def _changed(obj, column) -> bool:
+    return attributes.get_history(obj, column).has_changes()
+
+
+def _collect(session, flush_context):
+    new_pages = [o for o in session.new if isinstance(o, Page)]
+    changed_pages = [
+        o for o in session.dirty
+        if isinstance(o, Page) and attributes.get_history(o, "text_content").has_changes()
+    ]
+    deleted_pages = [o.id for o in session.deleted if isinstance(o, Page)]
+    entity_pages = [o.page_id for o in list(session.new) + list(session.deleted) if isinstance(o, PageEntity)]
+    narratives = [o for o in list(session.new) + list(session.dirty) if isinstance(o, AINarrative)]
+    flights = [o for o in list(session.new) + list(session.dirty) if isinstance(o, FlightLog)]
+    entities = [o for o in session.new if isinstance(o, Entity)] + [
+        o for o in session.dirty
+        if isinstance(o, Entity) and (_changed(o, "name") or _changed(o, "normalized_name"))
+    ]
+    documents = [o for o in session.new if isinstance(o, Document)] + [
+        o for o in session.dirty if isinstance(o, Document) and _changed(o, "filename")
+    ]
+    mentions = [(o.entity_id, 1) for o in session.new if isinstance(o, PageEntity)] + \
+               [(o.entity_id, -1) for o in session.deleted if isinstance(o, PageEntity)]
+
+    if not (new_pages or changed_pages or deleted_pages or entity_pages or narratives or flights
+            or entities or documents):
+        return
+
+    pending = _pending(session)
+    for page in new_pages + changed_pages:
+        pending["pages"][page.id] = {
+            "id": page.id,
+            "document_id": page.document_id,
+            "page_num": page.page_num,
+            "text_content": page.text_content,
+            "replace": page in changed_pages or page.id in pending["pages"],
+        }
+    pending["entity_pages"].update(p for p in entity_pages if p is not None)
+    for page_id in deleted_pages:
+        pending["pages"].pop(page_id, None)
+        pending["deleted_pages"].add(page_id)
+    for n in narratives:
+        pending["narratives"][n.id] = _snapshot(n, ("id", "title", "content", "narrative_type"))
+    for f in flights:
+        pending["flights"][f.id] = _snapshot(f, ("id", "tail_number", "origin", "destination", "passengers", "doc_reference"))
+    for e in entities:
+        pending["entities"][e.id] = _snapshot(e, ("id", "name", "normalized_name"))
+    for d in documents:
+        pending["documents"][d.id] = _snapshot(d, ("id", "filename"))
+    for entity_id, delta in mentions:
+        if entity_id is not None:
+            pending["entity_mentions"][entity_id] = pending["entity_mentions"].get(entity_id, 0) + delta
+
+
+def note_entities(session, rows):
+    """Record entities inserted with Core statements, which the flush hooks don't see."""
+    if not rows:
+        return
+    pending = _pending(session)
+    for row in rows:
+        pending["entities"][row.id] = _snapshot(row, ("id", "name", "normalized_name"))
+
+
+def note_pages(session, records):
+    """Record new pages inserted without the ORM (see bulk_load), as dicts with the Page columns."""
+    pending = _pending(session)
+    for r in records:
+        pending["pages"][r["id"]] = {
+            "id": r["id"],
+            "document_id": r.get("document_id"),
+            "page_num": r.get("page_num"),
+            "text_content": r.get("text_content"),
+            "replace": False,
+        }
+
+
+def note_page_entities(session, links):
+    """Record page-entity links inserted without the ORM, as dicts with page_id and entity_id."""
+    pending = _pending(session)
+    for link in links:
+        pending["entity_pages"].add(link["page_id"])
+        pending["entity_mentions"][link["entity_id"]] = pending["entity_mentions"].get(link["entity_id"], 0) + 1
+
+
+def _dispatch(session):
+    changes = session.info.pop(PENDING_KEY, None)
+    if not changes:
+        return
+    try:
+        import search
+        import search_cache
+        import autocomplete
+        import percolator
+    except ImportError:
+        from backend import search, search_cache, autocomplete, percolator
+    try:
+        search.sync_corpus(changes)
+    except Exception as e:
+        # Indexing must never fail an ingest that already committed
+        print(f"Search index update failed: {e}")
+    # Cached results in every worker predate this commit
+    search_cache.bump_generation()
+    try:
+        autocomplete.index.append(autocomplete.journal_records(changes))
+    except Exception as e:
+        print(f"Autocomplete journal update failed: {e}")
+    if changes.get("pages") or changes.get("entity_pages"):
+        try:
+            percolator.percolate(changes)
+        except Exception as e:
+            print(f"Watch query matching failed: {e}")
+
+
+def _discard(session):
+    session.info.pop(PENDING_KEY, None)
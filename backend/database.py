@@ -1,10 +1,14 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 try:
     from backend.models import Base
+    from backend.search_schema import ensure_search_schema
+    from backend import corpus_events
 except ImportError:
     from models import Base
+    from search_schema import ensure_search_schema
+    import corpus_events
 
 # Default to a local Postgres if possible, fallback to SQLite for immediate testing
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -16,12 +20,31 @@ try:
     else:
         engine = create_engine(DATABASE_URL)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    corpus_events.install(SessionLocal)
 except Exception as e:
     print(f"Error creating database engine: {e}")
     raise
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all skips existing tables; indexes declared on them since are built
+    # by scripts/migrate_indexes.py, without blocking writes on a live database
+    missing = missing_indexes()
+    if missing:
+        print(f"Warning: missing indexes {', '.join(index.name for index in missing)}. "
+              "Run scripts/migrate_indexes.py to build them.")
+    ensure_search_schema(engine)
+
+def missing_indexes() -> list:
+    """Indexes declared on the models that existing tables don't have yet."""
+    inspector = inspect(engine)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
 
 def get_db():
     db = SessionLocal()
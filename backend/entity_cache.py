@@ -0,0 +1,155 @@
+"""
+Entity Cache
+Resolves entity mentions to entities.id without a query per mention. IDs are
+cached by (normalized name, type), warmed from the entities table once per
+database, and names the cache doesn't know are inserted together:
+INSERT ... ON CONFLICT DO NOTHING RETURNING on Postgres and SQLite, followed
+by one SELECT for the names another writer inserted first.
+
+Used by ingestion/main.py for spaCy entities and by /api/analyze-document for
+AI-extracted ones. IDs inserted by a transaction that rolls back are dropped
+from the cache again.
+"""
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from sqlalchemy import event, select
+
+try:
+    from backend.models import Entity
+    from backend import corpus_events
+except ImportError:
+    from models import Entity
+    import corpus_events
+
+# Rows per INSERT, well under SQLite's bound-parameter limit
+INSERT_CHUNK = 500
+NEW_KEYS = "entity_cache_new"
+
+
+def normalize_name(name: str) -> str:
+    """The normalized_name column: whitespace collapsed, upper-cased."""
+    return " ".join(name.split()).upper()
+
+
+class EntityCache:
+    """
+    (normalized name, type) -> (entity id, country code). `country_code`,
+    if given, is called as country_code(name, type) for new entities.
+    """
+
+    def __init__(self, country_code: Callable[[str, str], Optional[str]] = None):
+        self.country_code = country_code
+        self._mutex = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[int, Optional[str]]] = {}
+        self._warmed = None
+
+    def warm(self, db):
+        """Load every entity once per database."""
+        url = str(db.bind.url)
+        if self._warmed == url:
+            return
+        entries = {}
+        rows = db.execute(
+            select(Entity.id, Entity.name, Entity.normalized_name, Entity.type, Entity.country_code).order_by(Entity.id)
+        )
+        for row in rows:
+            # Case variants stored as separate rows resolve to the oldest one
+            entries.setdefault((row.normalized_name or normalize_name(row.name), row.type), (row.id, row.country_code))
+        with self._mutex:
+            self._entries = entries
+            self._warmed = url
+
+    def resolve(self, db, mentions: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[int, Optional[str]]]:
+        """
+        {(name, type): (entity id, country code)} for the given mentions,
+        inserting the entities that don't exist yet. Blank names are skipped.
+        """
+        self.warm(db)
+        out, missing = {}, {}
+        with self._mutex:
+            for name, ent_type in mentions:
+                if not name or not name.strip():
+                    continue
+                key = (normalize_name(name), ent_type)
+                entry = self._entries.get(key)
+                if entry:
+                    out[(name, ent_type)] = entry
+                else:
+                    missing.setdefault(key, []).append(name)
+        if not missing:
+            return out
+
+        found = self._insert(db, {key: names[0].strip() for key, names in missing.items()})
+        new_keys = db.info.setdefault(NEW_KEYS, set())
+        if not db.info.get(NEW_KEYS + "_listening"):
+            event.listen(db, "after_commit", self._committed)
+            event.listen(db, "after_rollback", self._rolled_back)
+            db.info[NEW_KEYS + "_listening"] = True
+        with self._mutex:
+            for key, entry in found.items():
+                self._entries[key] = entry
+                new_keys.add(key)
+        for key, names in missing.items():
+            if key in found:
+                for name in names:
+                    out[(name, key[1])] = found[key]
+        return out
+
+    def _insert(self, db, missing: Dict[Tuple[str, str], str]) -> Dict[Tuple[str, str], Tuple[int, Optional[str]]]:
+        rows = []
+        for (normalized, ent_type), name in missing.items():
+            rows.append({
+                "name": name, "type": ent_type, "normalized_name": normalized,
+                "country_code": self.country_code(name, ent_type) if self.country_code else None,
+            })
+
+        found = {}
+        dialect = db.bind.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            inserted = []
+            for start in range(0, len(rows), INSERT_CHUNK):
+                stmt = insert(Entity).values(rows[start:start + INSERT_CHUNK]) \
+                    .on_conflict_do_nothing(index_elements=["name", "type"]) \
+                    .returning(Entity.id, Entity.name, Entity.normalized_name, Entity.type, Entity.country_code)
+                inserted.extend(db.execute(stmt).all())
+            for row in inserted:
+                found[(row.normalized_name, row.type)] = (row.id, row.country_code)
+            # Core inserts bypass the session, so tell the autocomplete journal directly
+            corpus_events.note_entities(db, inserted)
+        else:
+            for row in rows:
+                if not db.query(Entity.id).filter_by(name=row["name"], type=row["type"]).first():
+                    db.add(Entity(**row))
+            db.flush()
+
+        # Names another writer inserted since the cache was warmed
+        rest = {key: name for key, name in missing.items() if key not in found}
+        names = list({name for name in rest.values()})
+        for start in range(0, len(names), INSERT_CHUNK):
+            rows = db.execute(
+                select(Entity.id, Entity.name, Entity.type, Entity.country_code)
+                .where(Entity.name.in_(names[start:start + INSERT_CHUNK]))
+            )
+            for row in rows:
+                key = (normalize_name(row.name), row.type)
+                if rest.get(key) == row.name:
+                    found[key] = (row.id, row.country_code)
+        return found
+
+    def _committed(self, session):
+        session.info.pop(NEW_KEYS, None)
+
+    def _rolled_back(self, session):
+        keys = session.info.pop(NEW_KEYS, None)
+        if keys:
+            with self._mutex:
+                for key in keys:
+                    self._entries.pop(key, None)
+
+
+# Shared instance for the API
+cache = EntityCache()
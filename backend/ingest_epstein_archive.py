@@ -3,7 +3,9 @@ import os
 import sqlite3
 import shutil
 from datetime import datetime
+from collections import Counter
 from models import Document, Page
+from pii import masker, mask_counts
 from database import SessionLocal, engine
 from sqlalchemy.orm import Session
 
@@ -11,6 +13,8 @@ from sqlalchemy.orm import Session
 ARCHIVE_BASE = "https://archive.org/download/combined-all-epstein-files"
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "files")
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vault_epstein.db")
+# The djvu dumps run to many megabytes; PII is masked as they are read
+READ_CHUNK = 1024 * 1024
 
 # The 11 Main Datasets from Archive.org
 DATASETS = [
@@ -105,8 +109,10 @@ def ingest_dataset(db: Session, ds):
     
     if download_file(txt_url, txt_local_path):
         try:
+            masked = Counter()
             with open(txt_local_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+                content = "".join(masker.mask_chunks(iter(lambda: f.read(READ_CHUNK), ""), masked))
+            print(f"   [PII] Masked {mask_counts(masked)}")
                 
             # Create DB Entry
             existing_doc = db.query(Document).filter(Document.filename == ds['name']).first()
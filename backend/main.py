@@ -4,12 +4,18 @@ from sqlalchemy.orm import Session
 from sqlalchemy import func
 import crud, models, database
 import search as search_module
+import suggest
+import entity_cache
+import autocomplete
+import pii
+from collections import Counter
 from typing import List, Optional
 import PyPDF2
 import io
+import json
 from ai_service import get_ai_service
 import os
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 import countries_data
 from dotenv import load_dotenv
 
@@ -19,6 +25,11 @@ app = FastAPI(title="DOJ Document Explorer API")
 
 database.init_db()
 
+@app.on_event("startup")
+def load_autocomplete():
+    # Loads the snapshot (or builds it on first run) in the background
+    autocomplete.get_index()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -76,31 +87,193 @@ async def read_page(page_id: int, db: Session = Depends(database.get_db)):
         raise HTTPException(status_code=404, detail="Page not found")
     return page
 
-@app.get("/search")
-async def search(q: str, country: Optional[str] = None, db: Session = Depends(database.get_db)):
+@app.get("/page/{page_id}/similar")
+async def similar_pages(page_id: int, dataset: Optional[str] = None, limit: int = 10,
+                        db: Session = Depends(database.get_db)):
+    if not search_module.semantic_ready():
+        raise HTTPException(status_code=503, detail="Semantic index not built. Run scripts/build_semantic_index.py")
+    if not crud.get_page(db, page_id):
+        raise HTTPException(status_code=404, detail="Page not found")
+    filters = _search_filters(None, dataset, None, None, None)
+    limit = max(1, min(limit, 100))
+    results = search_module.similar_pages(page_id, db=db, filters=filters, limit=limit)
+    return search_module.hydrate_hits(db, results)
+
+def _search_filters(country, dataset, doc_type, page_from, page_to) -> dict:
     filters = {}
     if country:
         filters["countries"] = [country]
-    results = search_module.search_pages(q, db=db, filters=filters)
-    for hit in results:
-        source = hit.get("_source", {})
-        doc_id = source.get("document_id")
-        if doc_id:
-            doc = db.get(models.Document, doc_id)
-            hit["external_url"] = doc.external_url if doc else None
-            hit["dataset"] = doc.dataset if doc else "GENERAL"
-        else:
-            hit["external_url"] = None
-            hit["dataset"] = "GENERAL"
-        
-        # New: Extract related entities for this page
-        page_id = source.get("page_id")
-        if page_id:
-            entities = db.query(models.Entity).join(models.PageEntity).filter(models.PageEntity.page_id == page_id).all()
-            hit["entities"] = [{"name": e.name, "type": e.type, "id": e.id} for e in entities]
-        else:
-             hit["entities"] = []
-    return results
+    if dataset:
+        filters["datasets"] = [dataset]
+    if doc_type:
+        filters["doc_types"] = [doc_type]
+    if page_from is not None:
+        filters["page_min"] = page_from
+    if page_to is not None:
+        filters["page_max"] = page_to
+    return filters
+
+@app.get("/search")
+async def search(
+    q: str,
+    country: Optional[str] = None,
+    dataset: Optional[str] = None,
+    doc_type: Optional[str] = None,
+    page_from: Optional[int] = None,
+    page_to: Optional[int] = None,
+    limit: int = 10,
+    mode: str = "keyword",
+    ignore_case: bool = False,
+    collapse_duplicates: bool = False,
+    db: Session = Depends(database.get_db)
+):
+    if mode in search_module.GREP_MODES:
+        return _grep_response(q, mode, _search_filters(country, dataset, doc_type, page_from, page_to), limit, ignore_case)
+    if mode not in search_module.SEARCH_MODES:
+        modes = search_module.SEARCH_MODES + search_module.GREP_MODES
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(modes)}")
+    if mode != "keyword" and not search_module.semantic_ready():
+        raise HTTPException(status_code=503, detail="Semantic index not built. Run scripts/build_semantic_index.py")
+    try:
+        search_module.search_query.parse(q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filters = _search_filters(country, dataset, doc_type, page_from, page_to)
+    limit = max(1, min(limit, 100))
+    results = search_module.search_pages(q, db=db, filters=filters, limit=limit, mode=mode,
+                                         collapse_duplicates=collapse_duplicates)
+    return search_module.hydrate_hits(db, results)
+
+def _grep_response(q: str, mode: str, filters: dict, limit: int, ignore_case: bool) -> StreamingResponse:
+    """mode=regex|literal: hits stream back as newline-delimited JSON while pages are still being scanned."""
+    if not search_module.grep_ready():
+        raise HTTPException(status_code=503, detail="Grep index not built. Run scripts/build_search_index.py")
+    limit = max(1, min(limit, search_module.GREP_MAX_HITS))
+    try:
+        batches = search_module.grep_pages(q, filters=filters, limit=limit,
+                                           literal=mode == "literal", ignore_case=ignore_case)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def lines():
+        try:
+            for hits in batches:
+                for hit in hits:
+                    yield json.dumps(hit) + "\n"
+        except TimeoutError as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/search/page")
+async def search_page(
+    q: str,
+    cursor: Optional[str] = None,
+    country: Optional[str] = None,
+    dataset: Optional[str] = None,
+    doc_type: Optional[str] = None,
+    page_from: Optional[int] = None,
+    page_to: Optional[int] = None,
+    limit: int = 10,
+    db: Session = Depends(database.get_db)
+):
+    """Paginated search: pass next_cursor from one response to get the next page."""
+    filters = _search_filters(country, dataset, doc_type, page_from, page_to)
+    limit = max(1, min(limit, 100))
+    try:
+        result = search_module.search_pages_paged(q, db=db, filters=filters, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result["hits"] = search_module.hydrate_hits(db, result["hits"])
+    return result
+
+@app.get("/search/documents")
+async def search_documents(
+    q: str,
+    country: Optional[str] = None,
+    dataset: Optional[str] = None,
+    doc_type: Optional[str] = None,
+    page_from: Optional[int] = None,
+    page_to: Optional[int] = None,
+    limit: int = 10,
+    per_document: int = 3,
+    db: Session = Depends(database.get_db)
+):
+    """Search results collapsed by document: the best pages of each matching document and its match count."""
+    try:
+        search_module.search_query.parse(q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filters = _search_filters(country, dataset, doc_type, page_from, page_to)
+    limit = max(1, min(limit, 100))
+    per_document = max(1, min(per_document, 10))
+    groups = search_module.search_pages_grouped(q, db=db, filters=filters, groups=limit, per_group=per_document)
+    search_module.hydrate_hits(db, [hit for group in groups for hit in group["hits"]])
+    return groups
+
+@app.get("/watch-queries")
+async def list_watch_queries(db: Session = Depends(database.get_db)):
+    """Saved watch queries and how many pages each has matched"""
+    counts = dict(
+        db.query(models.QueryMatch.saved_query_id, func.count(models.QueryMatch.id))
+        .group_by(models.QueryMatch.saved_query_id).all()
+    )
+    return [
+        {"id": w.id, "name": w.name, "query": w.query, "created_at": w.created_at, "matches": counts.get(w.id, 0)}
+        for w in db.query(models.SavedQuery).order_by(models.SavedQuery.id)
+    ]
+
+@app.post("/watch-queries")
+async def create_watch_query(name: str, q: str, db: Session = Depends(database.get_db)):
+    """Save a query in /search syntax; every page ingested from now on is matched against it"""
+    try:
+        search_module.search_query.parse(q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    saved = models.SavedQuery(name=name, query=q)
+    db.add(saved)
+    db.commit()
+    return {"id": saved.id, "name": saved.name, "query": saved.query}
+
+@app.delete("/watch-queries/{query_id}")
+async def delete_watch_query(query_id: int, db: Session = Depends(database.get_db)):
+    saved = db.get(models.SavedQuery, query_id)
+    if not saved:
+        raise HTTPException(status_code=404, detail="Watch query not found")
+    db.delete(saved)
+    db.commit()
+    return {"deleted": query_id}
+
+@app.get("/watch-queries/matches")
+async def watch_query_matches(
+    query_id: Optional[int] = None,
+    since_id: int = 0,
+    limit: int = 50,
+    db: Session = Depends(database.get_db)
+):
+    """Pages matched by watch queries, oldest first. Poll with the last id seen as since_id."""
+    rows = db.query(
+        models.QueryMatch, models.SavedQuery.name, models.Page.page_num, models.Document.filename
+    ).join(models.SavedQuery, models.SavedQuery.id == models.QueryMatch.saved_query_id) \
+        .join(models.Page, models.Page.id == models.QueryMatch.page_id) \
+        .outerjoin(models.Document, models.Document.id == models.QueryMatch.document_id) \
+        .filter(models.QueryMatch.id > since_id)
+    if query_id is not None:
+        rows = rows.filter(models.QueryMatch.saved_query_id == query_id)
+    rows = rows.order_by(models.QueryMatch.id).limit(max(1, min(limit, 500)))
+    return [
+        {
+            "id": m.id,
+            "query_id": m.saved_query_id,
+            "query_name": name,
+            "page_id": m.page_id,
+            "page_num": page_num,
+            "document_id": m.document_id,
+            "document_title": filename or "Unknown",
+            "matched_at": m.matched_at,
+        }
+        for m, name, page_num, filename in rows
+    ]
 
 @app.post("/upload")
 async def upload_file(db: Session = Depends(database.get_db)):
@@ -124,7 +297,7 @@ async def upload_file(db: Session = Depends(database.get_db)):
         p = models.Page(
             document_id=new_doc.id,
             page_num=i+1,
-            text_content=txt,
+            text_content=pii.mask_pii(txt),
             media_type="page_image"
         )
         db.add(p)
@@ -254,32 +427,19 @@ async def analyze_document(doc_id: int, db: Session = Depends(database.get_db)):
         for l in analysis.get('locations', []):
              all_entities.append({"name": l, "type": "LOC"})
              
-        for ent_data in all_entities:
-            # Check if exists
-            existing = db.query(models.Entity).filter(
-                models.Entity.name == ent_data['name'], 
-                models.Entity.type == ent_data['type']
-            ).first()
-            
-            if existing:
-                name_to_id[ent_data['name']] = existing.id
-            else:
-                new_ent = models.Entity(name=ent_data['name'], type=ent_data['type'])
-                db.add(new_ent)
-                db.flush()
-                name_to_id[ent_data['name']] = new_ent.id
-                
-            # Link to Page (first page of doc for now, or we could be more specific)
-            if pages:
-                page_id = pages[0].id
-                # Check if PageEntity exists
-                pe = db.query(models.PageEntity).filter(
-                    models.PageEntity.page_id == page_id,
-                    models.PageEntity.entity_id == name_to_id[ent_data['name']]
-                ).first()
-                if not pe:
-                    new_pe = models.PageEntity(page_id=page_id, entity_id=name_to_id[ent_data['name']])
-                    db.add(new_pe)
+        resolved = entity_cache.cache.resolve(db, [(e['name'], e['type']) for e in all_entities])
+        for (name, _), (entity_id, _) in resolved.items():
+            name_to_id[name] = entity_id
+
+        # Link to Page (first page of doc for now, or we could be more specific)
+        if pages and name_to_id:
+            page_id = pages[0].id
+            linked = {eid for (eid,) in db.query(models.PageEntity.entity_id).filter(
+                models.PageEntity.page_id == page_id,
+                models.PageEntity.entity_id.in_(set(name_to_id.values()))
+            )}
+            for entity_id in sorted(set(name_to_id.values()) - linked):
+                db.add(models.PageEntity(page_id=page_id, entity_id=entity_id))
 
         # 2. Insert Relationships
         for rel in analysis.get('relationships', []):
@@ -390,20 +550,25 @@ async def search_countries(q: str = ""):
     return [{"code": code, **info} for code, info in countries_data.COUNTRY_DATA.items()]
 
 @app.get("/api/suggestions")
-async def get_suggestions(q: str, db: Session = Depends(database.get_db)):
-    """Get search suggestions based on query"""
+async def get_suggestions(q: str, limit: int = 8, scores: bool = False, db: Session = Depends(database.get_db)):
+    """Get search suggestions: in-memory prefix completions first, then trigram matches"""
     if len(q) < 2:
         return []
-    
-    # Search documents titles
-    docs = db.query(models.Document.filename).filter(models.Document.filename.ilike(f"%{q}%")).limit(3).all()
-    doc_titles = [d.filename for d in docs]
-    
-    # Search entities
-    entities = db.query(models.Entity.name).filter(models.Entity.name.ilike(f"%{q}%")).limit(5).all()
-    entity_names = [e.name for e in entities]
-    
-    return list(set(doc_titles + entity_names))
+
+    limit = max(1, min(limit, 50))
+    suggestions = [
+        {"text": c["text"], "kind": c["kind"], "score": 1.0, "weight": c["weight"]}
+        for c in autocomplete.get_index().complete(q, limit=limit)
+    ]
+    if len(suggestions) < limit:
+        # Misspellings and mid-word matches need the database
+        seen = {s["text"] for s in suggestions}
+        for s in suggest.suggest(db, q, limit=limit):
+            if s["text"] not in seen and len(suggestions) < limit:
+                suggestions.append(s)
+    if scores:
+        return suggestions
+    return [s["text"] for s in suggestions]
 
 @app.get("/document/{doc_id}")
 async def get_document(doc_id: int, db: Session = Depends(database.get_db)):
@@ -528,6 +693,7 @@ async def upload_documents(
             try:
                 pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
                 pages_extracted = 0
+                masked = Counter()
                 
                 for page_num, pdf_page in enumerate(pdf_reader.pages, 1):
                     try:
@@ -536,7 +702,7 @@ async def upload_documents(
                             page = models.Page(
                                 document_id=document.id,
                                 page_num=page_num,
-                                text_content=text[:10000],
+                                text_content=pii.masker.mask(text, masked)[0][:10000],
                                 text_quality=0.7,
                                 media_type='pdf_page'
                             )
@@ -549,6 +715,7 @@ async def upload_documents(
                 uploaded.append({
                     "filename": file.filename,
                     "pages": pages_extracted,
+                    "masked": dict(masked),
                     "document_id": document.id
                 })
                 
@@ -577,3 +744,8 @@ async def get_document_stats(db: Session = Depends(database.get_db)):
         "total_relationships": db.query(models.Relationship).count(),
         "datasets": [{"name": d[0] or "Unknown", "count": d[1]} for d in datasets]
     }
+
+@app.get("/admin/search-cache-stats")
+async def get_search_cache_stats():
+    """Search result cache counters, for sizing SEARCH_CACHE_SIZE / SEARCH_CACHE_TTL"""
+    return search_module.search_cache.cache.stats()
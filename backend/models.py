@@ -30,8 +30,8 @@ class Page(Base):
     text_quality = Column(Float) # OCR confidence
     media_type = Column(String(50)) # page_image, transcript_stub
     
-    # Full-Text Search will use text_content directly
-    # For Postgres, we can add a GIN index on text_content
+    # Full-Text Search: on Postgres a trigger-maintained `search_vector` tsvector
+    # column with a GIN index is added by search_schema.ensure_search_schema
     
     document = relationship("Document", back_populates="pages")
     entities = relationship("PageEntity", back_populates="page")
@@ -48,15 +48,15 @@ class Entity(Base):
     name = Column(String(255), nullable=False)
     type = Column(String(50)) # PERSON, ORG, GPE, LOC
     normalized_name = Column(String(255))
-    country_code = Column(String(10)) # For normalized countries
+    country_code = Column(String(10), index=True) # For normalized countries
     
     __table_args__ = (UniqueConstraint('name', 'type', name='_name_type_uc'),)
 
 class PageEntity(Base):
     __tablename__ = "page_entities"
     id = Column(Integer, primary_key=True)
-    page_id = Column(Integer, ForeignKey("pages.id"))
-    entity_id = Column(Integer, ForeignKey("entities.id"))
+    page_id = Column(Integer, ForeignKey("pages.id"), index=True)
+    entity_id = Column(Integer, ForeignKey("entities.id"), index=True)
     frequency = Column(Integer, default=1)
     
     page = relationship("Page", back_populates="entities")
@@ -116,3 +116,25 @@ class Relationship(Base):
     evidence_page_id = Column(Integer, ForeignKey("pages.id"))
     confidence_score = Column(Float, default=0.5)  # AI confidence in this relationship
 
+
+class SavedQuery(Base):
+    __tablename__ = "saved_queries"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False)
+    query = Column(Text, nullable=False)  # /search syntax, matched against new pages by percolator.py
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    matches = relationship("QueryMatch", back_populates="saved_query", cascade="all, delete-orphan")
+
+class QueryMatch(Base):
+    __tablename__ = "query_matches"
+    id = Column(Integer, primary_key=True)
+    saved_query_id = Column(Integer, ForeignKey("saved_queries.id"), index=True)
+    page_id = Column(Integer, ForeignKey("pages.id"), index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"))
+    matched_at = Column(DateTime, default=datetime.utcnow)
+
+    saved_query = relationship("SavedQuery", back_populates="matches")
+
+    __table_args__ = (UniqueConstraint('saved_query_id', 'page_id', name='_query_page_uc'),)
@@ -0,0 +1,378 @@
+"""
+Near-Duplicate Pages
+The same release reaches the vault from justice.gov, DocumentCloud, Pinpoint
+and the archive.org dumps, so many pages exist several times with small OCR
+or formatting differences. Each page gets a MinHash signature of its word
+shingles and a duplicate cluster: the id of the first indexed page it nearly
+duplicates, or its own id.
+
+Signatures are computed for a whole batch of pages at once with numpy. An LSH
+banding index finds candidates without a scan: the signature is cut into
+bands, and pages sharing any band hash are candidates, which are then checked
+against the estimated Jaccard similarity. Each band's hashes are kept sorted
+on disk and looked up by binary search; rows added since the last sort are
+compared directly until the next merge.
+"""
+import os
+import json
+import time
+import zlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Iterable, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+from search_index import tokenize
+
+NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))
+BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+# Estimated Jaccard similarity at which two pages are the same page
+SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", "0.8"))
+SHINGLE_WORDS = 5
+# Shorter pages (blank scans, cover sheets) all look alike and are never clustered
+MIN_WORDS = 20
+# Rows past the sorted band tables are merged in once there are this many (or 1/8 of the sorted rows)
+TAIL_ROWS = 50000
+# Shingles hashed per numpy pass, which bounds memory to ~NUM_PERM x this many uint64s
+HASH_CHUNK = 200000
+MERSENNE = (1 << 61) - 1
+SEED = 1
+
+
+def available() -> bool:
+    return np is not None
+
+
+class MinHasher:
+    """MinHash over hashed word shingles with NUM_PERM universal hash functions."""
+
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = SEED):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        # a*x + b mod a Mersenne prime; x < 2**32 and a, b < 2**29 keep products inside uint64
+        self.a = rng.randint(1, 1 << 29, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 29, size=(num_perm, 1), dtype=np.uint64)
+
+    @staticmethod
+    def shingles(text: str) -> List[int]:
+        words = tokenize(text)
+        if len(words) < MIN_WORDS:
+            return []
+        return sorted({
+            zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+            for i in range(len(words) - SHINGLE_WORDS + 1)
+        })
+
+    def signatures(self, texts: List[str]):
+        """(len(texts), num_perm) uint32 signatures; all-ones rows for pages too short to compare."""
+        out = np.full((len(texts), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        batch, rows = [], []
+
+        def flush():
+            if not batch:
+                return
+            lengths = np.array([len(s) for s in batch])
+            x = np.concatenate([np.asarray(s, dtype=np.uint64) for s in batch])[None, :]
+            hashed = ((self.a * x + self.b) % MERSENNE) & 0xFFFFFFFF
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            out[rows] = np.minimum.reduceat(hashed, starts, axis=1).T.astype(np.uint32)
+            batch.clear()
+            rows.clear()
+
+        pending = 0
+        for i, text in enumerate(texts):
+            shingles = self.shingles(text or "")
+            if not shingles:
+                continue
+            if pending + len(shingles) > HASH_CHUNK:
+                flush()
+                pending = 0
+            batch.append(shingles)
+            rows.append(i)
+            pending += len(shingles)
+        flush()
+        return out
+
+
+def band_hashes(signatures, bands: int = BANDS):
+    """(rows, bands) uint64: one hash per band of each signature."""
+    rows, num_perm = signatures.shape
+    width = num_perm // bands
+    parts = signatures[:, :width * bands].reshape(rows, bands, width).astype(np.uint64)
+    # Odd multipliers; uint64 overflow wraps, which is fine for hashing
+    multipliers = (np.arange(width, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+    with np.errstate(over="ignore"):
+        return (parts * multipliers).sum(axis=2, dtype=np.uint64)
+
+
+def _comparable(signature) -> bool:
+    return not (signature == np.iinfo(np.uint32).max).all()
+
+
+class DuplicateIndex:
+    """
+    Append-only signature store keyed by page id, with LSH band tables.
+
+    Files in `root`: sigs.u32 (capacity x NUM_PERM), bands.u64 (capacity x
+    BANDS), ids.i64 (page id per row, -1 once replaced or deleted),
+    clusters.i64 (cluster per row), sorted_keys.u64 / sorted_rows.i64 (BANDS x
+    sorted rows, each band ordered by hash), and state.json with the counts.
+    Writers hold a file lock; readers reopen the maps when state.json changes.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._mutex = threading.RLock()
+        self._hasher = None
+        self._state = None
+        self._state_mtime = None
+        self._sigs = self._bands = self._ids = self._clusters = None
+        self._sorted_keys = self._sorted_rows = None
+        self._row_of = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def exists(self) -> bool:
+        return available() and os.path.exists(self._path("state.json"))
+
+    @contextmanager
+    def _write_lock(self):
+        with self._mutex:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._path("write.lock"), "a+") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _write_state(self, state: dict):
+        tmp = self._path("state.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self._path("state.json"))
+
+    def create(self):
+        """Start an empty index if there is none yet."""
+        if not available() or self.exists():
+            return
+        with self._write_lock():
+            self._write_state({
+                "index_id": f"{os.getpid()}-{time.time_ns()}", "count": 0, "capacity": 0,
+                "num_perm": NUM_PERM, "bands": BANDS, "sorted": 0, "sorted_id": None,
+            })
+        self.refresh()
+
+    # -- reading --------------------------------------------------------------
+
+    def refresh(self):
+        """Reopen the maps if another process appended, deleted or merged rows."""
+        if not self.exists():
+            return
+        mtime = os.stat(self._path("state.json")).st_mtime_ns
+        with self._mutex:
+            if mtime == self._state_mtime:
+                return
+            with open(self._path("state.json"), "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if self._hasher is None or self._hasher.num_perm != state["num_perm"]:
+                self._hasher = MinHasher(state["num_perm"])
+            capacity, perms, bands = state["capacity"], state["num_perm"], state["bands"]
+            if capacity:
+                self._sigs = np.memmap(self._path("sigs.u32"), dtype=np.uint32, mode="r", shape=(capacity, perms))
+                self._bands = np.memmap(self._path("bands.u64"), dtype=np.uint64, mode="r", shape=(capacity, bands))
+                self._ids = np.memmap(self._path("ids.i64"), dtype=np.int64, mode="r", shape=(capacity,))
+                self._clusters = np.memmap(self._path("clusters.i64"), dtype=np.int64, mode="r", shape=(capacity,))
+            else:
+                self._sigs = self._bands = self._ids = self._clusters = None
+            if state["sorted"]:
+                shape = (bands, state["sorted"])
+                self._sorted_keys = np.memmap(self._path(f"sorted_keys.{state['sorted_id']}.u64"),
+                                              dtype=np.uint64, mode="r", shape=shape)
+                self._sorted_rows = np.memmap(self._path(f"sorted_rows.{state['sorted_id']}.i64"),
+                                              dtype=np.int64, mode="r", shape=shape)
+            else:
+                self._sorted_keys = self._sorted_rows = None
+            self._row_of = None
+            self._state = state
+            self._state_mtime = mtime
+
+    def version(self) -> str:
+        self.refresh()
+        return str(self._state_mtime or "")
+
+    def count(self) -> int:
+        self.refresh()
+        return self._state["count"] if self._state else 0
+
+    def _similar_rows(self, signature, bands, limit_row: int, sigs, band_table, ids) -> List[Tuple[int, float]]:
+        if not _comparable(signature):
+            return []
+        state = self._state
+        found = []
+        sorted_count = min(state["sorted"], limit_row)
+        for b in range(len(bands)) if sorted_count else ():
+            keys = self._sorted_keys[b]
+            lo, hi = np.searchsorted(keys, bands[b], "left"), np.searchsorted(keys, bands[b], "right")
+            if hi > lo:
+                found.append(np.asarray(self._sorted_rows[b][lo:hi]))
+        tail = np.asarray(band_table[state["sorted"]:limit_row])
+        if len(tail):
+            found.append(state["sorted"] + np.nonzero((tail == bands).any(axis=1))[0])
+        if not found:
+            return []
+        rows = np.unique(np.concatenate(found))
+        rows = rows[(rows < limit_row)]
+        rows = rows[np.asarray(ids[rows]) >= 0]
+        if not len(rows):
+            return []
+        similarity = (np.asarray(sigs[rows]) == signature).mean(axis=1)
+        keep = similarity >= SIMILARITY
+        return sorted(zip(rows[keep].tolist(), similarity[keep].tolist()), key=lambda rs: (-rs[1], rs[0]))
+
+    def find(self, text: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """[(page_id, estimated similarity)] of indexed pages nearly duplicating `text`, most similar first."""
+        self.refresh()
+        with self._mutex:
+            if not self._state or not self._state["count"]:
+                return []
+            signature = self._hasher.signatures([text])
+            similar = self._similar_rows(signature[0], band_hashes(signature, self._state["bands"])[0],
+                                         self._state["count"], self._sigs, self._bands, self._ids)
+            return [(int(self._ids[row]), sim) for row, sim in similar[:limit]]
+
+    def clusters(self, page_ids: Iterable[int]) -> Dict[int, int]:
+        """{page_id: duplicate cluster} for the indexed pages among `page_ids`."""
+        self.refresh()
+        with self._mutex:
+            if not self._state or not self._state["count"]:
+                return {}
+            count = self._state["count"]
+            if self._row_of is None:
+                ids = np.asarray(self._ids[:count])
+                live = np.nonzero(ids >= 0)[0]
+                order = np.argsort(ids[live], kind="stable")
+                self._row_of = (ids[live][order], live[order])
+            sorted_ids, rows = self._row_of
+            wanted = np.asarray(list(page_ids), dtype=np.int64)
+            if not len(wanted) or not len(sorted_ids):
+                return {}
+            pos = np.clip(np.searchsorted(sorted_ids, wanted), 0, len(sorted_ids) - 1)
+            hit = sorted_ids[pos] == wanted
+            return {int(pid): int(self._clusters[rows[p]]) for pid, p in zip(wanted[hit], pos[hit])}
+
+    # -- writing --------------------------------------------------------------
+
+    def _open_for_write(self, state: dict, needed: int):
+        """Writable maps with room for `needed` rows, growing the files by doubling."""
+        capacity, perms, bands = state["capacity"], state["num_perm"], state["bands"]
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            for name, itemsize in (("sigs.u32", 4 * perms), ("bands.u64", 8 * bands), ("ids.i64", 8), ("clusters.i64", 8)):
+                with open(self._path(name), "ab") as f:
+                    f.truncate(capacity * itemsize)
+            state["capacity"] = capacity
+        return (
+            np.memmap(self._path("sigs.u32"), dtype=np.uint32, mode="r+", shape=(capacity, perms)),
+            np.memmap(self._path("bands.u64"), dtype=np.uint64, mode="r+", shape=(capacity, bands)),
+            np.memmap(self._path("ids.i64"), dtype=np.int64, mode="r+", shape=(capacity,)),
+            np.memmap(self._path("clusters.i64"), dtype=np.int64, mode="r+", shape=(capacity,)),
+        )
+
+    def add(self, pages: List[Tuple[int, str]]) -> Dict[int, int]:
+        """
+        Sign and append (page_id, text) pairs and return {page_id: cluster}.
+        A page joins the cluster of its most similar earlier page (within the
+        batch too); earlier rows for the same pages are retired.
+        """
+        if not pages or not self.exists():
+            return {}
+        self.refresh()
+        signatures = self._hasher.signatures([text for _, text in pages])
+        with self._write_lock():
+            self.refresh()
+            state = dict(self._state)
+            bands = band_hashes(signatures, state["bands"])
+            page_ids = np.array([pid for pid, _ in pages], dtype=np.int64)
+            count = state["count"]
+
+            sigs, band_table, ids, clusters = self._open_for_write(state, count + len(pages))
+            if count:
+                ids[:count][np.isin(ids[:count], page_ids)] = -1
+            end = count + len(pages)
+            sigs[count:end] = signatures
+            band_table[count:end] = bands
+            ids[count:end] = page_ids
+
+            assigned = {}
+            for i, page_id in enumerate(page_ids.tolist()):
+                row = count + i
+                similar = self._similar_rows(signatures[i], bands[i], row, sigs, band_table, ids)
+                cluster = int(clusters[similar[0][0]]) if similar else page_id
+                clusters[row] = cluster
+                assigned[page_id] = cluster
+            for m in (sigs, band_table, ids, clusters):
+                m.flush()
+            state["count"] = end
+            if end - state["sorted"] > max(TAIL_ROWS, state["sorted"] // 8):
+                self._merge_tail(state, band_table)
+            self._write_state(state)
+        return assigned
+
+    def _merge_tail(self, state: dict, band_table):
+        """Fold the unsorted rows into new sorted band tables (linear merge, no full re-sort)."""
+        sorted_count, count, bands = state["sorted"], state["count"], state["bands"]
+        tail_rows = np.arange(sorted_count, count, dtype=np.int64)
+        tail_keys = np.asarray(band_table[sorted_count:count])
+        sorted_id = f"{time.time_ns()}"
+        keys_out = np.memmap(self._path(f"sorted_keys.{sorted_id}.u64"), dtype=np.uint64, mode="w+", shape=(bands, count))
+        rows_out = np.memmap(self._path(f"sorted_rows.{sorted_id}.i64"), dtype=np.int64, mode="w+", shape=(bands, count))
+        for b in range(bands):
+            order = np.argsort(tail_keys[:, b], kind="stable")
+            new_keys, new_rows = tail_keys[order, b], tail_rows[order]
+            if sorted_count:
+                old_keys = np.asarray(self._sorted_keys[b])
+                at = np.searchsorted(old_keys, new_keys, "right")
+                keys_out[b] = np.insert(old_keys, at, new_keys)
+                rows_out[b] = np.insert(np.asarray(self._sorted_rows[b]), at, new_rows)
+            else:
+                keys_out[b], rows_out[b] = new_keys, new_rows
+        keys_out.flush()
+        rows_out.flush()
+        previous = state.get("sorted_id")
+        state["sorted"], state["sorted_id"] = count, sorted_id
+        if previous:
+            # Readers still holding the old tables keep them until they refresh
+            for name in (f"sorted_keys.{previous}.u64", f"sorted_rows.{previous}.i64"):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def delete(self, page_ids: Iterable[int]):
+        page_ids = np.array(list(page_ids), dtype=np.int64)
+        if not len(page_ids) or not self.exists():
+            return
+        with self._write_lock():
+            self.refresh()
+            state = dict(self._state)
+            if not state["count"]:
+                return
+            _, _, ids, _ = self._open_for_write(state, state["count"])
+            hit = np.isin(ids[:state["count"]], page_ids)
+            if hit.any():
+                ids[:state["count"]][hit] = -1
+                ids.flush()
+                self._write_state(state)
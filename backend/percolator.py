@@ -0,0 +1,189 @@
+"""
+Percolator
+Saved watch queries (names, tail numbers, addresses, ...) matched against
+pages as they are committed, instead of re-running each one over the corpus.
+
+Queries use the /search syntax and are compiled once per change to the
+saved_queries table. Compiling indexes every query under the words it can't
+match without (its anchors), so a new page is matched against all of them in
+one pass over its distinct words: only queries anchored on one of them are
+evaluated, on the page's word positions. corpus_events calls percolate()
+after every commit; matches are recorded in query_matches.
+"""
+import threading
+from datetime import datetime
+from typing import Dict, List, Iterable
+from sqlalchemy import func
+from search_query import parse, query_terms, compare, Query, Term, Phrase, Near, And, Or, Not, Field
+from search_index import tokenize, positional_match
+
+try:
+    from backend.database import SessionLocal
+    from backend.models import SavedQuery, QueryMatch, Page, Document, PageEntity, Entity
+except ImportError:
+    from database import SessionLocal
+    from models import SavedQuery, QueryMatch, Page, Document, PageEntity, Entity
+
+
+def _anchored(node) -> bool:
+    """True when every match of node contains one of its positive words."""
+    if isinstance(node, (Term, Phrase, Near)):
+        return True
+    if isinstance(node, And):
+        return any(_anchored(c) for c in node.children)
+    if isinstance(node, Or):
+        return all(_anchored(c) for c in node.children)
+    return False
+
+
+def _uses_entities(node) -> bool:
+    if isinstance(node, Field):
+        return node.name in ("entity", "country")
+    if isinstance(node, (And, Or)):
+        return any(_uses_entities(c) for c in node.children)
+    if isinstance(node, Not):
+        return _uses_entities(node.child)
+    return False
+
+
+def evaluate(node, positions: Dict[str, List[int]], fields: dict) -> bool:
+    """Match a parsed query node against one page's word positions and fields."""
+    if node is None:
+        return True
+    if isinstance(node, Term):
+        return node.text in positions
+    if isinstance(node, (Phrase, Near)):
+        return positional_match(node, lambda term: positions.get(term, []))
+    if isinstance(node, And):
+        return all(evaluate(c, positions, fields) for c in node.children)
+    if isinstance(node, Or):
+        return any(evaluate(c, positions, fields) for c in node.children)
+    if isinstance(node, Not):
+        return not evaluate(node.child, positions, fields)
+    if node.name == "country":
+        return node.value.upper() in fields.get("countries", ())
+    if node.name == "entity":
+        return node.value.lower() in fields.get("entities", ())
+    if node.name == "page":
+        return compare(node.op, fields.get("page_num"), node.value)
+    return compare(node.op, fields.get(node.name), node.value)
+
+
+class Percolator:
+    """The saved queries compiled for matching, reloaded when the table changes."""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._version = None
+        self._queries: Dict[int, Query] = {}
+        # word -> ids of the queries anchored on it
+        self._by_term: Dict[str, List[int]] = {}
+        # Queries that can match without any particular word (e.g. "a OR -b")
+        self._unanchored: List[int] = []
+        self.needs_entities = False
+
+    def load(self, db):
+        version = tuple(db.query(func.count(SavedQuery.id), func.max(SavedQuery.updated_at)).one())
+        with self._mutex:
+            if version == self._version:
+                return
+            queries, by_term, unanchored = {}, {}, []
+            for saved in db.query(SavedQuery.id, SavedQuery.query):
+                try:
+                    q = parse(saved.query)
+                except ValueError as e:
+                    print(f"Skipping saved query {saved.id}: {e}")
+                    continue
+                queries[saved.id] = q
+                node = And((q.text, q.where)) if q.where is not None else q.text
+                if _anchored(node):
+                    for term in query_terms(q.text):
+                        by_term.setdefault(term, []).append(saved.id)
+                else:
+                    unanchored.append(saved.id)
+            self._queries, self._by_term, self._unanchored = queries, by_term, unanchored
+            self.needs_entities = any(_uses_entities(q.where) for q in queries.values())
+            self._version = version
+
+    def __len__(self):
+        return len(self._queries)
+
+    def match(self, text: str, fields: dict) -> List[int]:
+        """Ids of the saved queries the page matches."""
+        positions: Dict[str, List[int]] = {}
+        for i, token in enumerate(tokenize(text)):
+            positions.setdefault(token, []).append(i)
+        with self._mutex:
+            queries, by_term = self._queries, self._by_term
+            candidates = set(self._unanchored)
+        for token in positions:
+            candidates.update(by_term.get(token, ()))
+        return sorted(
+            qid for qid in candidates
+            if evaluate(queries[qid].text, positions, fields) and evaluate(queries[qid].where, positions, fields)
+        )
+
+
+percolator = Percolator()
+
+
+def _page_rows(db, page_ids: Iterable[int]) -> list:
+    return [
+        dict(row._mapping) for row in db.query(
+            Page.id, Page.document_id, Page.page_num, Page.text_content, Document.dataset, Document.doc_type
+        ).outerjoin(Document, Document.id == Page.document_id).filter(Page.id.in_(list(page_ids)))
+    ]
+
+
+def _attach_entities(db, records: List[dict]):
+    # country: and entity: clauses are answered from the page's entity links
+    by_page = {r["id"]: r for r in records}
+    for r in records:
+        r["countries"], r["entities"] = set(), set()
+    rows = db.query(PageEntity.page_id, Entity.name, Entity.normalized_name, Entity.country_code) \
+        .join(Entity, Entity.id == PageEntity.entity_id).filter(PageEntity.page_id.in_(list(by_page)))
+    for row in rows:
+        r = by_page[row.page_id]
+        r["entities"].update(n.lower() for n in (row.name, row.normalized_name) if n)
+        if row.country_code:
+            r["countries"].add(row.country_code.upper())
+
+
+def percolate(changes: dict) -> int:
+    """
+    Match a committed transaction's new and changed pages against every saved
+    query and record the new matches. Pages whose entity links changed are
+    re-checked when some query filters on entity: or country:. Returns the
+    number of matches recorded.
+    """
+    db = SessionLocal()
+    try:
+        percolator.load(db)
+        if not len(percolator):
+            return 0
+        page_ids = set(changes.get("pages", {}))
+        if percolator.needs_entities:
+            page_ids |= set(changes.get("entity_pages", ()))
+        page_ids -= set(changes.get("deleted_pages", ()))
+        if not page_ids:
+            return 0
+
+        records = _page_rows(db, page_ids)
+        if percolator.needs_entities:
+            _attach_entities(db, records)
+        found = {(qid, r["id"]): r for r in records for qid in percolator.match(r["text_content"] or "", r)}
+        if not found:
+            return 0
+
+        existing = set(db.query(QueryMatch.saved_query_id, QueryMatch.page_id)
+                       .filter(QueryMatch.page_id.in_(list({page_id for _, page_id in found}))))
+        now = datetime.utcnow()
+        new = [
+            QueryMatch(saved_query_id=qid, page_id=page_id, document_id=r["document_id"], matched_at=now)
+            for (qid, page_id), r in found.items() if (qid, page_id) not in existing
+        ]
+        db.add_all(new)
+        db.commit()
+        return len(new)
+    finally:
+        db.close()
@@ -0,0 +1,121 @@
+"""
+PII Masking
+One masking engine for every ingestion path: the PDF ingester, the scrapers,
+the admin upload and the archive.org importer all store text that went
+through it, so pages never hold raw emails, phone numbers or addresses.
+
+The category patterns are compiled once into a single alternation with a
+named group per category, so each text is scanned and rewritten in one pass
+and the category of every match is known (counts come for free). At any
+position the categories are tried in order, emails first, so the result is
+the old separate passes' wherever PII tokens don't run into each other (an
+email glued to a phone number with no separator is masked as the two, where
+the email pass used to take both). Categories that can only start on a few
+characters share one lookahead on them, which lets the scan skip the rest of
+the alternation at most positions (digits are rare in OCR text);
+scripts/benchmark_pii.py measures it and checks the output against the old passes.
+
+mask_chunks() masks text that arrives in pieces (multi-megabyte djvu dumps,
+streamed responses) with bounded memory. It assumes no PII token is longer
+than `tail` characters, which is far beyond any real address or email.
+
+    masked, counts = masker.mask(text)      # counts: Counter({"EMAIL": 2})
+    text = mask_pii(text)
+"""
+import re
+from collections import Counter
+from itertools import groupby
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# (category, pattern, first characters or None), in match priority order.
+# Groups inside patterns must be non-capturing.
+PATTERNS = [
+    ("EMAIL", r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+', None),
+    ("PHONE", r'(?:\+?\d{1,3}[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}', r'[+(\d]'),
+    # Simple address masking - can be more aggressive if needed
+    ("ADDRESS", r'\d{1,5}\s\w.\s(?:\w\s?){1,3}\s(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr)', r'[+(\d]'),
+]
+# Characters carried between chunks in mask_chunks()
+CHUNK_TAIL = 4096
+
+
+class PIIMasker:
+    """Replaces every match with "[CATEGORY]" in one pass over the text."""
+
+    def __init__(self, patterns: List[Tuple[str, str, Optional[str]]] = PATTERNS, tail: int = CHUNK_TAIL):
+        self.pattern = re.compile(self._alternation(patterns))
+        self.replacements = {name: f"[{name}]" for name, _, _ in patterns}
+        self.tail = tail
+
+    @staticmethod
+    def _alternation(patterns) -> str:
+        """Named groups joined by "|"; neighbours with the same first characters go behind one lookahead."""
+        branches = []
+        for first, group in groupby(patterns, key=lambda p: p[2]):
+            alternatives = "|".join(f"(?P<{name}>{pattern})" for name, pattern, _ in group)
+            branches.append(f"(?={first})(?:{alternatives})" if first else alternatives)
+        return "|".join(branches)
+
+    def mask(self, text: str, counts: Counter = None) -> Tuple[str, Counter]:
+        """The masked text and replacements per category (added to `counts` if given)."""
+        counts = Counter() if counts is None else counts
+        if not text:
+            return text, counts
+        replacements = self.replacements
+
+        def replace(match):
+            name = match.lastgroup
+            counts[name] += 1
+            return replacements[name]
+
+        return self.pattern.sub(replace, text), counts
+
+    def mask_chunks(self, chunks: Iterable[str], counts: Counter = None) -> Iterator[str]:
+        """
+        Mask a text given as consecutive chunks; yields masked pieces whose
+        concatenation equals mask() of the whole text. The last `tail`
+        characters are held back until the next chunk shows whether a match
+        continues into it. Counts are added to `counts` as pieces are yielded.
+        """
+        counts = Counter() if counts is None else counts
+        buf, pos = "", 0
+        for chunk in chunks:
+            buf += chunk
+            if len(buf) - pos <= self.tail:
+                continue
+            piece, pos = self._mask_until(buf, pos, len(buf) - self.tail, counts)
+            yield piece
+            buf, pos = buf[pos:], 0
+        if len(buf) > pos:
+            piece, _ = self._mask_until(buf, pos, len(buf), counts)
+            yield piece
+
+    def _mask_until(self, buf: str, pos: int, stop: int, counts: Counter) -> Tuple[str, int]:
+        """Mask matches in buf that start in [pos, stop); returns the masked text and where it ends."""
+        pieces = []
+        end = pos
+        for match in self.pattern.finditer(buf, pos):
+            if match.start() >= stop:
+                break
+            pieces.append(buf[end:match.start()])
+            pieces.append(self.replacements[match.lastgroup])
+            counts[match.lastgroup] += 1
+            end = match.end()
+        # A match that started before stop may run past it
+        stop = max(stop, end)
+        pieces.append(buf[end:stop])
+        return "".join(pieces), stop
+
+
+# Shared instance for every ingester
+masker = PIIMasker()
+
+
+def mask_pii(text: str) -> str:
+    """Masks emails, phones, and basic addresses in text."""
+    return masker.mask(text)[0]
+
+
+def mask_counts(counts: Counter) -> str:
+    """"3 EMAIL, 1 PHONE" for ingestion logs."""
+    return ", ".join(f"{count} {name}" for name, count in counts.most_common()) or "nothing"
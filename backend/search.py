@@ -1,13 +1,238 @@
 import os
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from models import Page, Document
-from database import SessionLocal
+import re
+import json
+import base64
+from typing import List, Iterable, Optional
+from sqlalchemy import func, text, select, literal, literal_column, table, or_, and_, not_
+from sqlalchemy.orm import Session, joinedload, defer
+from models import Page, Document, Entity, PageEntity, AINarrative, FlightLog
+from database import SessionLocal, BASE_DIR
+from search_schema import search_vector, sqlite_fts_available, SQLITE_FTS_TABLE
+import search_query
+from search_index import SegmentIndex
+from search_shards import ShardedIndex
+from search_grep import GrepIndex, compile_pattern
+from semantic import SemanticIndex
+from near_duplicates import DuplicateIndex
+import search_cache
 
-def search_pages(query: str, db: Session = None, filters: dict = None, limit: int = 10):
+# "index" serves queries from the embedded index once it has been built
+# (scripts/build_search_index.py); "database" always queries Postgres/SQLite.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "index").lower()
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", os.path.join(BASE_DIR, "search_index"))
+SEARCH_MODES = ("keyword", "semantic", "hybrid")
+# Streamed pattern searches over the grep index (see grep_pages)
+GREP_MODES = ("regex", "literal")
+GREP_MAX_HITS = 1000
+# collapse_duplicates fetches this many hits per requested one before collapsing
+DUPLICATE_OVERFETCH = 3
+# Reciprocal rank fusion constant for hybrid mode; larger flattens the rank curve
+HYBRID_RRF_K = int(os.getenv("SEARCH_HYBRID_RRF_K", "60"))
+
+
+class SearchBackend:
+    """Interface for page search engines."""
+    name = "base"
+
+    def is_ready(self) -> bool:
+        return True
+
+    def cache_token(self) -> str:
+        """Part of the result-cache key that changes when this backend's data does."""
+        return ""
+
+    def search(self, db: Session, query: str, filters: dict, limit: int, after: tuple = None) -> List[tuple]:
+        """
+        Return [(page, score)] ordered by score descending, then page id
+        ascending. Pages come without text_content loaded. `after` is a (score, page_id) keyset position:
+        only hits that sort strictly after it are returned.
+        """
+        raise NotImplementedError
+
+    def estimate_total(self, db: Session, query: str, filters: dict) -> tuple:
+        """Cheap hit count as (value, relation); relation is "eq", "gte" or "estimate"."""
+        raise NotImplementedError
+
+    def search_grouped(self, db: Session, query: str, filters: dict, groups: int, per_group: int) -> List[tuple]:
+        """
+        Hits collapsed by document: [(document_id, match_count, [(page, score)])]
+        for the `groups` documents with the best pages, each with its
+        `per_group` best pages, best first.
+        """
+        raise NotImplementedError
+
+    def index_pages(self, records: List[dict]):
+        """Add or replace pages given as dicts from page_record()."""
+        pass
+
+    def delete_pages(self, page_ids: Iterable[int]):
+        pass
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """Full-text search inside the OLTP database; triggers keep it current."""
+    name = "database"
+
+    def search(self, db: Session, query: str, filters: dict, limit: int, after: tuple = None) -> List[tuple]:
+        dialect = db.bind.dialect.name
+        if dialect == "postgresql":
+            return _search_postgres(db, query, filters, limit, after)
+        elif dialect == "sqlite" and sqlite_fts_available(db.bind):
+            return _search_sqlite_fts(db, query, filters, limit, after)
+        return _search_like(db, query, filters, limit, after)
+
+    def estimate_total(self, db: Session, query: str, filters: dict) -> tuple:
+        dialect = db.bind.dialect.name
+        if dialect == "postgresql":
+            return _estimate_postgres(db, query, filters)
+        elif dialect == "sqlite" and sqlite_fts_available(db.bind):
+            return _count_capped(db, _sqlite_fts_ids(query, filters))
+        return _count_capped(db, _like_ids(query, filters))
+
+    def search_grouped(self, db: Session, query: str, filters: dict, groups: int, per_group: int) -> List[tuple]:
+        dialect = db.bind.dialect.name
+        if dialect == "postgresql":
+            tsquery = _tsquery(query)
+            scored = (
+                select(Page.id, Page.document_id, func.ts_rank_cd(search_vector, tsquery, 1).label("score"))
+                .where(search_vector.op('@@')(tsquery), *_page_clauses(query, filters))
+            )
+        elif dialect == "sqlite" and sqlite_fts_available(db.bind):
+            if not _fts5_match(query):
+                return []
+            bm25 = literal_column(f"bm25({SQLITE_FTS_TABLE})")
+            scored = _sqlite_fts_ids(query, filters, Page.document_id, (-bm25).label("score"))
+        else:
+            scored = _like_ids(query, filters).add_columns(Page.document_id, literal(1.0).label("score"))
+        return _collapse(db, scored.subquery(), groups, per_group)
+
+
+class IndexSearchBackend(SearchBackend):
+    """Embedded segment index on local disk, sharded (see search_shards); the database only hydrates hits."""
+    name = "index"
+
+    def __init__(self, root: str):
+        self.index = ShardedIndex(root)
+
+    def is_ready(self) -> bool:
+        return self.index.exists()
+
+    def cache_token(self) -> str:
+        # Index writes land on the flush timer, after the corpus generation was bumped
+        return self.index.version()
+
+    def search(self, db: Session, query: str, filters: dict, limit: int, after: tuple = None) -> List[tuple]:
+        parsed = search_query.parse(query)
+        results = self.index.search(parsed, limit=limit, filters=filters, after=after,
+                                    key_sets=_field_key_sets(db, parsed.where))
+        if not results:
+            return []
+        pages = _load_pages(db, [key for _, key in results])
+        return [(pages[key], score) for score, key in results if key in pages]
+
+    def estimate_total(self, db: Session, query: str, filters: dict) -> tuple:
+        parsed = search_query.parse(query)
+        return self.index.estimate_total(parsed, filters=filters, key_sets=_field_key_sets(db, parsed.where))
+
+    def search_grouped(self, db: Session, query: str, filters: dict, groups: int, per_group: int) -> List[tuple]:
+        parsed = search_query.parse(query)
+        grouped = self.index.search_grouped(parsed, "document_id", groups=groups, per_group=per_group,
+                                            filters=filters, key_sets=_field_key_sets(db, parsed.where))
+        pages = _load_pages(db, [key for _, _, hits in grouped for _, key in hits])
+        return [
+            (doc_id, count, [(pages[key], score) for score, key in hits if key in pages])
+            for doc_id, count, hits in grouped
+        ]
+
+    def index_pages(self, records: List[dict]):
+        if not self.index.exists():
+            return
+        self.index.add_many(
+            (r["id"], r["text_content"], _page_fields(r), r.get("replace", False)) for r in records
+        )
+
+    def delete_pages(self, page_ids: Iterable[int]):
+        if self.index.exists():
+            self.index.delete(page_ids)
+
+
+_database_backend = DatabaseSearchBackend()
+_index_backend = IndexSearchBackend(os.path.join(SEARCH_INDEX_DIR, "pages"))
+_narrative_index = SegmentIndex(os.path.join(SEARCH_INDEX_DIR, "narratives"))
+_flight_index = SegmentIndex(os.path.join(SEARCH_INDEX_DIR, "flights"))
+_semantic_index = SemanticIndex(os.path.join(SEARCH_INDEX_DIR, "semantic"))
+_grep_index = GrepIndex(os.path.join(SEARCH_INDEX_DIR, "grep"))
+_duplicate_index = DuplicateIndex(os.path.join(SEARCH_INDEX_DIR, "dedup"))
+
+
+def get_search_backend() -> SearchBackend:
+    """The configured backend, or the database while the index has not been built."""
+    if SEARCH_BACKEND == "index" and _index_backend.is_ready():
+        return _index_backend
+    return _database_backend
+
+
+def semantic_ready() -> bool:
+    """True once scripts/build_semantic_index.py has built the embedding index."""
+    return _semantic_index.exists()
+
+def grep_ready() -> bool:
+    """True once scripts/build_search_index.py has exported page text for regex search."""
+    return _grep_index.exists()
+
+def duplicates_ready() -> bool:
+    """True once scripts/build_search_index.py has signed the pages for near-duplicate detection."""
+    return _duplicate_index.exists()
+
+def duplicate_pages(text: str, limit: int = 10) -> List[tuple]:
+    """
+    [(page_id, similarity)] of indexed pages that nearly duplicate `text`,
+    most similar first. Lets ingesters check a page before inserting it.
+    """
+    if not text or not _duplicate_index.exists():
+        return []
+    return _duplicate_index.find(text, limit=limit)
+
+def duplicate_clusters(page_ids: Iterable[int]) -> dict:
+    """{page_id: duplicate cluster id} for the signed pages among page_ids."""
+    if not _duplicate_index.exists():
+        return {}
+    return _duplicate_index.clusters(page_ids)
+
+def grep_pages(pattern: str, filters: dict = None, limit: int = 100, literal: bool = False, ignore_case: bool = False):
+    """
+    Regex (or literal) search over the grep index. The pattern is checked
+    right away (ValueError); the returned generator then yields batches of
+    hits as the workers verify them, scored by match count. Each batch is
+    hydrated with its own session, so streaming outlives the request's.
+    """
+    regex = compile_pattern(pattern, literal=literal, ignore_case=ignore_case)
+    filters = normalize_filters(filters)
+
+    def batches():
+        for found in _grep_index.grep(regex, filters=filters, limit=limit,
+                                      context=SNIPPET_CHARS // 2, preview=PREVIEW_CHARS):
+            db = SessionLocal()
+            try:
+                pages = _load_pages(db, [key for key, *_ in found])
+                hits = [_build_hit(pages[key], count, (snippet, highlights, preview))
+                        for key, count, snippet, highlights, preview in found if key in pages]
+                yield hydrate_hits(db, hits)
+            finally:
+                db.close()
+
+    return batches()
+
+def search_pages(query: str, db: Session = None, filters: dict = None, limit: int = 10, mode: str = "keyword",
+                 collapse_duplicates: bool = False):
     """
-    Search pages using a database-agnostic LIKE search (fallback) 
-    or optimized Full-Text Search if on Postgres.
+    Search pages with the configured backend: the embedded index, or the best
+    full-text engine of the database (tsvector on Postgres, FTS5 on SQLite,
+    and a LIKE scan as last resort).
+    mode="semantic" ranks by embedding similarity instead, and mode="hybrid"
+    fuses the keyword and semantic rankings.
+    collapse_duplicates keeps only the best hit of each near-duplicate cluster;
+    each kept hit carries the number of copies it stands for.
     """
     should_close = False
     if db is None:
@@ -15,57 +240,32 @@ def search_pages(query: str, db: Session = None, filters: dict = None, limit: in
         should_close = True
 
     try:
-        # Check if we are on Postgres to use TSearch, else fallback to LIKE
-        dialect = db.bind.dialect.name
-        
-        if dialect == "postgresql":
-            # Postgres optimized search
-            search_query = func.plainto_tsquery('english', query)
-            # Note: We'd use the search_vector if we add it back, 
-            # for now we search text_content directly
-            q = db.query(Page).filter(func.to_tsvector('english', Page.text_content).op('@@')(search_query))
-            q = q.order_by(func.ts_rank(func.to_tsvector('english', Page.text_content), search_query).desc())
-        else:
-            # SQLite / Generic fallback
-            q = db.query(Page).filter(Page.text_content.ilike(f"%{query}%"))
-        
-        results = q.limit(limit).all()
-        
-        hits = []
-        for page in results:
-            # Extract basic snippet
-            text = page.text_content
-            snippet = text[:200]
-            
-            # If query is simple word, try to find it for better context
-            if query and len(query) > 2:
-                lower_text = text.lower()
-                lower_query = query.lower()
-                try:
-                    start_idx = lower_text.find(lower_query)
-                    if start_idx != -1:
-                        # Grab context around match
-                        start = max(0, start_idx - 60)
-                        end = min(len(text), start_idx + len(query) + 80)
-                        snippet = ("..." if start > 0 else "") + text[start:end] + ("..." if end < len(text) else "")
-                        # Highlight match (simple simulation)
-                        # In frontend we can use <mark> matching the query
-                except:
-                    pass
-
-            hits.append({
-                "_id": f"page_{page.id}",
-                "_score": 1.0, 
-                "_source": {
-                    "text": snippet,  # Return snippet instead of full text for list view
-                    "full_text_preview": text[:1000],
-                    "page_id": page.id,
-                    "document_id": page.document_id,
-                    "document_title": page.document.filename if page.document else "Unknown",
-                    "page_num": page.page_num
-                }
-            })
-        return hits
+        search_query.parse(query)
+        backend = get_search_backend()
+        filters = normalize_filters(filters)
+
+        collapse = collapse_duplicates and _duplicate_index.exists()
+        depth = limit * DUPLICATE_OVERFETCH if collapse else limit
+
+        def run():
+            if mode == "semantic":
+                matches = _semantic_matches(db, query, filters, depth)
+            elif mode == "hybrid":
+                matches = _hybrid_matches(backend, db, query, filters, depth)
+            else:
+                matches = backend.search(db, query, filters, depth)
+            if not collapse:
+                return _build_hits(db, matches, query)
+            matches, copies = _collapse_duplicates(matches, limit)
+            hits = _build_hits(db, matches, query)
+            for hit in hits:
+                hit["duplicate_cluster"], hit["duplicates"] = copies[hit["_source"]["page_id"]]
+            return hits
+
+        kind = "pages" if mode == "keyword" else f"pages:{mode}:{_semantic_index.version()}"
+        if collapse:
+            kind = f"{kind}:dedup:{_duplicate_index.version()}"
+        return _cached(backend, (kind, query, filters, limit), run)
     except Exception as e:
         print(f"Search failed: {e}")
         return []
@@ -73,8 +273,738 @@ def search_pages(query: str, db: Session = None, filters: dict = None, limit: in
         if should_close:
             db.close()
 
-# Mock functions for compatibility
-def index_page(*args, **kwargs): pass
-def index_narrative(*args, **kwargs): pass
-def index_flight(*args, **kwargs): pass
-def create_index(): pass
+def _collapse_duplicates(matches: List[tuple], limit: int) -> tuple:
+    """
+    Keep the best-scoring page of each duplicate cluster, up to `limit`.
+    Returns (matches, {page_id: (cluster, copies among the hits)}).
+    """
+    clusters = _duplicate_index.clusters([page.id for page, _ in matches])
+    kept, copies = [], {}
+    for page, score in matches:
+        cluster = clusters.get(page.id, page.id)
+        if cluster in copies:
+            copies[cluster][1] += 1
+            continue
+        copies[cluster] = [page.id, 1]
+        kept.append((page, score))
+    kept = kept[:limit]
+    return kept, {page_id: (cluster, n) for cluster, (page_id, n) in copies.items()}
+
+def search_pages_grouped(query: str, db: Session = None, filters: dict = None,
+                         groups: int = 10, per_group: int = 3) -> List[dict]:
+    """
+    Keyword search collapsed by document, so one huge matching document can't
+    crowd out the rest. Returns up to `groups` entries of
+    {"document_id", "document_title", "_score", "matches", "hits"}: the
+    document's best score, how many of its pages matched, and its best
+    `per_group` pages as regular search hits.
+    """
+    should_close = False
+    if db is None:
+        db = SessionLocal()
+        should_close = True
+
+    try:
+        search_query.parse(query)
+        backend = get_search_backend()
+        filters = normalize_filters(filters)
+
+        def run():
+            grouped = backend.search_grouped(db, query, filters, groups, per_group)
+            hits = iter(_build_hits(db, [m for _, _, matches in grouped for m in matches], query))
+            out = []
+            for doc_id, count, matches in grouped:
+                doc_hits = [next(hits) for _ in matches]
+                if not doc_hits:
+                    continue
+                out.append({
+                    "document_id": doc_id,
+                    "document_title": doc_hits[0]["_source"]["document_title"],
+                    "_score": doc_hits[0]["_score"],
+                    "matches": count,
+                    "hits": doc_hits,
+                })
+            return out
+
+        return _cached(backend, ("grouped", query, filters, groups, per_group), run)
+    except Exception as e:
+        print(f"Search failed: {e}")
+        return []
+    finally:
+        if should_close:
+            db.close()
+
+def encode_cursor(score: float, page_id: int) -> str:
+    """Opaque keyset cursor for the position right after a hit."""
+    raw = json.dumps([score, page_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor; raises ValueError for malformed cursors."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, page_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(score), int(page_id)
+    except Exception:
+        raise ValueError("Invalid search cursor")
+
+def search_pages_paged(query: str, db: Session = None, filters: dict = None,
+                       limit: int = 10, cursor: Optional[str] = None) -> dict:
+    """
+    One page of search results with keyset pagination.
+    Returns {"hits", "next_cursor", "total": {"value", "relation"}}; pass
+    next_cursor back to get the following page. Raises ValueError for a bad
+    cursor or a query that can't be run (see search_query.parse).
+    """
+    after = decode_cursor(cursor) if cursor else None
+    search_query.parse(query)
+
+    should_close = False
+    if db is None:
+        db = SessionLocal()
+        should_close = True
+
+    try:
+        backend = get_search_backend()
+        filters = normalize_filters(filters)
+
+        def run():
+            # One extra row tells us whether another page exists
+            matches = backend.search(db, query, filters, limit + 1, after=after)
+            has_more = len(matches) > limit
+            matches = matches[:limit]
+            hits = _build_hits(db, matches, query)
+            total, relation = backend.estimate_total(db, query, filters)
+            last = matches[-1] if matches else None
+            return {
+                "hits": hits,
+                "next_cursor": encode_cursor(last[1], last[0].id) if has_more else None,
+                "total": {"value": total, "relation": relation},
+            }
+
+        return _cached(backend, ("paged", query, filters, limit, cursor), run)
+    except Exception as e:
+        print(f"Search failed: {e}")
+        return {"hits": [], "next_cursor": None, "total": {"value": 0, "relation": "eq"}}
+    finally:
+        if should_close:
+            db.close()
+
+def _semantic_matches(db: Session, query: str, filters: dict, limit: int) -> List[tuple]:
+    # Filters aren't stored with the vectors, so over-fetch and let the database filter
+    clauses = _page_clauses(query, filters)
+    nearest = _semantic_index.search(" ".join(_query_words(query)), limit=limit * 4 if clauses else limit)
+    return _nearest_pages(db, nearest, clauses, limit)
+
+def _nearest_pages(db: Session, nearest: List[tuple], clauses: list, limit: int) -> List[tuple]:
+    # [(page_id, score)] from the vector index -> [(page, score)] passing the filter clauses
+    if not nearest:
+        return []
+    ids = [pid for pid, _ in nearest]
+    if clauses:
+        allowed = {pid for pid, in db.execute(select(Page.id).where(Page.id.in_(ids), *clauses))}
+        nearest = [(pid, score) for pid, score in nearest if pid in allowed]
+    nearest = nearest[:limit]
+    pages = _load_pages(db, [pid for pid, _ in nearest])
+    return [(pages[pid], score) for pid, score in nearest if pid in pages]
+
+def similar_pages(page_id: int, db: Session = None, filters: dict = None, limit: int = 10) -> List[dict]:
+    """
+    "More like this": the pages whose stored embeddings are nearest to the
+    given page's, best first. Near-duplicate copies of the page are left out.
+    Hits carry the start of the page as snippet.
+    """
+    should_close = False
+    if db is None:
+        db = SessionLocal()
+        should_close = True
+
+    try:
+        filters = normalize_filters(filters)
+
+        def run():
+            clauses = _filter_clauses(filters)
+            copies = set()
+            if _duplicate_index.exists():
+                cluster = _duplicate_index.clusters([page_id]).get(page_id)
+                if cluster is not None:
+                    copies = {cluster}
+            depth = limit * 4 if clauses or copies else limit
+            nearest = _semantic_index.similar(page_id, limit=depth)
+            if copies:
+                clusters = _duplicate_index.clusters([pid for pid, _ in nearest])
+                nearest = [(pid, score) for pid, score in nearest if clusters.get(pid) not in copies]
+            matches = _nearest_pages(db, nearest, clauses, limit)
+            previews = {
+                pid: ((text or "")[:SNIPPET_CHARS], [], preview or "")
+                for pid, text, preview in db.execute(
+                    select(Page.id, func.substr(Page.text_content, 1, SNIPPET_CHARS),
+                           func.substr(Page.text_content, 1, PREVIEW_CHARS))
+                    .where(Page.id.in_([page.id for page, _ in matches]))
+                )
+            }
+            return [_build_hit(page, score, previews.get(page.id, ("", [], ""))) for page, score in matches]
+
+        kind = f"similar:{_semantic_index.version()}:{_duplicate_index.version()}"
+        return _cached(get_search_backend(), (kind, page_id, filters, limit), run, query_text=False)
+    finally:
+        if should_close:
+            db.close()
+
+def _hybrid_matches(backend: SearchBackend, db: Session, query: str, filters: dict, limit: int) -> List[tuple]:
+    # Reciprocal rank fusion: BM25 and cosine scores aren't on comparable scales, ranks are
+    depth = limit * 2
+    fused = {}
+    pages = {}
+    for ranking in (backend.search(db, query, filters, depth), _semantic_matches(db, query, filters, depth)):
+        for rank, (page, _) in enumerate(ranking):
+            pages[page.id] = page
+            fused[page.id] = fused.get(page.id, 0.0) + 1.0 / (HYBRID_RRF_K + rank + 1)
+    best = sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [(pages[pid], score) for pid, score in best]
+
+def _cached(backend: SearchBackend, key_parts: tuple, run, query_text: bool = True):
+    """
+    Serve run() through the query cache. The raw query text is only used to
+    compute the result; the key uses its parsed form (with query_text=False
+    the second key part is not search text and is used as is). Failed
+    searches raise out of run() and are never cached.
+    """
+    cache = search_cache.cache
+    if not cache.enabled:
+        return run()
+    kind, query, *rest = key_parts
+    try:
+        key = search_cache.make_key(kind, backend.name, backend.cache_token(),
+                                    search_query.canonical(query) if query_text else query, *rest)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        generation = cache.generation()
+    except Exception as e:
+        print(f"Search cache unavailable: {e}")
+        return run()
+
+    value = run()
+    try:
+        cache.put(key, value, generation)
+    except Exception as e:
+        print(f"Search cache unavailable: {e}")
+    return value
+
+def normalize_filters(filters: dict) -> dict:
+    """
+    Canonical filter dict shared by every backend:
+    countries / datasets / doc_types (lists) and page_min / page_max (ints).
+    """
+    filters = filters or {}
+    out = {}
+    if filters.get("countries"):
+        out["countries"] = sorted({c.upper() for c in filters["countries"] if c})
+    for key in ("datasets", "doc_types"):
+        if filters.get(key):
+            out[key] = sorted(set(filters[key]))
+    for key in ("page_min", "page_max"):
+        if filters.get(key) is not None:
+            out[key] = int(filters[key])
+    return out
+
+def _filter_clauses(filters: dict) -> list:
+    # Predicates on Page that the database applies before ranking and LIMIT
+    clauses = []
+    if filters.get("countries"):
+        clauses.append(
+            select(PageEntity.id)
+            .join(Entity, Entity.id == PageEntity.entity_id)
+            .where(PageEntity.page_id == Page.id, Entity.country_code.in_(filters["countries"]))
+            .exists()
+        )
+    if filters.get("datasets") or filters.get("doc_types"):
+        docs = select(Document.id)
+        if filters.get("datasets"):
+            docs = docs.where(Document.dataset.in_(filters["datasets"]))
+        if filters.get("doc_types"):
+            docs = docs.where(Document.doc_type.in_(filters["doc_types"]))
+        clauses.append(Page.document_id.in_(docs))
+    if filters.get("page_min") is not None:
+        clauses.append(Page.page_num >= filters["page_min"])
+    if filters.get("page_max") is not None:
+        clauses.append(Page.page_num <= filters["page_max"])
+    return clauses
+
+# Exact counts stop here; beyond it the total is reported as a lower bound
+COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", "10000"))
+
+# Relative cost of checking a field clause on a candidate page: a column of the
+# row itself, a lookup in documents, or a join through the page's mentions
+FIELD_COSTS = {"page": 0, "dataset": 1, "doc_type": 1, "country": 2, "entity": 2}
+
+def _query_text(query: str):
+    # FTS5 and the LIKE fallback evaluate And operands left to right: rarest-looking first
+    return search_query.order_by_selectivity(search_query.parse(query).text, search_query.heuristic_selectivity)
+
+def _query_words(query: str) -> List[str]:
+    return search_query.query_terms(search_query.parse(query).text)
+
+def _tsquery(query: str):
+    # Phrases, NEAR and boolean operators need to_tsquery; plain words keep plainto_tsquery
+    node = _query_text(query)
+    if node is None or search_query.is_plain(node):
+        return func.plainto_tsquery('english', " ".join(search_query.query_terms(node)))
+    return func.to_tsquery('english', search_query.to_tsquery(node))
+
+def _fts5_match(query: str) -> str:
+    node = _query_text(query)
+    return search_query.to_fts5(node) if node is not None else ""
+
+def _like_clause(node):
+    if isinstance(node, search_query.And):
+        return and_(*(_like_clause(c) for c in node.children))
+    if isinstance(node, search_query.Or):
+        return or_(*(_like_clause(c) for c in node.children))
+    if isinstance(node, search_query.Not):
+        return not_(_like_clause(node.child))
+    return and_(*(Page.text_content.ilike(p) for p in search_query.like_patterns(node)))
+
+def _like_clauses(query: str) -> list:
+    node = _query_text(query)
+    if node is None:
+        return [Page.text_content.ilike(f"%{query}%")]
+    return [_like_clause(node)]
+
+def _entity_match(name: str):
+    # normalized_name is the upper-cased name
+    return or_(Entity.normalized_name == name.upper(), func.lower(Entity.name) == name.lower())
+
+def _field_clause(node):
+    if isinstance(node, search_query.And):
+        return and_(*(_field_clause(c) for c in node.children))
+    if isinstance(node, search_query.Or):
+        return or_(*(_field_clause(c) for c in node.children))
+    if isinstance(node, search_query.Not):
+        return not_(_field_clause(node.child))
+    if node.name == "page":
+        if node.op == "..":
+            low, high = node.value
+            bounds = ([Page.page_num >= low] if low is not None else []) + \
+                     ([Page.page_num <= high] if high is not None else [])
+            return and_(*bounds)
+        return search_query.COMPARISONS[node.op](Page.page_num, node.value)
+    if node.name in ("dataset", "doc_type"):
+        return Page.document_id.in_(select(Document.id).where(getattr(Document, node.name) == node.value))
+    mentions = (
+        select(PageEntity.id)
+        .join(Entity, Entity.id == PageEntity.entity_id)
+        .where(PageEntity.page_id == Page.id)
+    )
+    if node.name == "country":
+        return mentions.where(Entity.country_code == node.value).exists()
+    return mentions.where(_entity_match(node.value)).exists()
+
+def _page_clauses(query: str, filters: dict) -> list:
+    """The query's field clauses (cheapest first) and the request filters, as predicates on Page."""
+    where = search_query.order_by_selectivity(
+        search_query.parse(query).where, lambda field: FIELD_COSTS.get(field.name, len(FIELD_COSTS))
+    )
+    clauses = []
+    if where is not None:
+        clauses = [_field_clause(c) for c in (where.children if isinstance(where, search_query.And) else (where,))]
+    return clauses + _filter_clauses(filters)
+
+def _field_key_sets(db: Session, where) -> dict:
+    # Mentions aren't stored in the embedded index; it gets entity: clauses as page id sets
+    return {
+        field: {pid for pid, in db.execute(
+            select(PageEntity.page_id).join(Entity, Entity.id == PageEntity.entity_id).where(_entity_match(field.value))
+        )}
+        for field in search_query.fields(where) if field.name == "entity"
+    }
+
+def _search_postgres(db: Session, query: str, filters: dict, limit: int, after: tuple = None):
+    # Postgres optimized search against the stored, GIN-indexed tsvector
+    tsquery = _tsquery(query)
+    # ts_rank_cd with normalization 1 divides by 1 + log(length), like BM25's length norm
+    rank = func.ts_rank_cd(search_vector, tsquery, 1).label("rank")
+    q = db.query(Page, rank).options(defer(Page.text_content), joinedload(Page.document))
+    q = q.filter(search_vector.op('@@')(tsquery)).filter(*_page_clauses(query, filters))
+    if after:
+        score, page_id = after
+        q = q.filter(or_(rank < score, and_(rank == score, Page.id > page_id)))
+    q = q.order_by(rank.desc(), Page.id)
+    return [(page, float(score)) for page, score in q.limit(limit).all()]
+
+def _estimate_postgres(db: Session, query: str, filters: dict) -> tuple:
+    # The planner's row estimate costs one EXPLAIN, no matter how many pages match
+    stmt = select(Page.id).where(search_vector.op('@@')(_tsquery(query)), *_page_clauses(query, filters))
+    compiled = stmt.compile(dialect=db.bind.dialect)
+    plan = db.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"]), "estimate"
+
+def _count_capped(db: Session, ids_stmt) -> tuple:
+    counted = db.execute(select(func.count()).select_from(ids_stmt.limit(COUNT_CAP).subquery())).scalar()
+    return counted, ("gte" if counted >= COUNT_CAP else "eq")
+
+def _sqlite_fts_ids(query: str, filters: dict, *columns):
+    stmt = (
+        select(Page.id, *columns)
+        .select_from(table(SQLITE_FTS_TABLE))
+        .join(Page, Page.id == literal_column(f"{SQLITE_FTS_TABLE}.rowid"))
+        .where(text(f"{SQLITE_FTS_TABLE} MATCH :match").bindparams(match=_fts5_match(query) or '""'))
+        .where(*_page_clauses(query, filters))
+    )
+    return stmt
+
+def _search_sqlite_fts(db: Session, query: str, filters: dict, limit: int, after: tuple = None):
+    # FTS5 external-content table: bm25() is lower-is-better
+    if not _fts5_match(query):
+        return []
+
+    rank = literal_column(f"bm25({SQLITE_FTS_TABLE})").label("rank")
+    stmt = _sqlite_fts_ids(query, filters, rank)
+    if after:
+        score, page_id = after
+        stmt = stmt.where(or_(rank > -score, and_(rank == -score, Page.id > page_id)))
+    rows = db.execute(stmt.order_by(rank, Page.id).limit(limit)).all()
+
+    pages = _load_pages(db, [r.id for r in rows])
+    return [(pages[r.id], -r.rank) for r in rows if r.id in pages]
+
+def _like_ids(query: str, filters: dict):
+    return select(Page.id).where(*_like_clauses(query), *_page_clauses(query, filters))
+
+def _search_like(db: Session, query: str, filters: dict, limit: int, after: tuple = None):
+    # Generic fallback: unindexed substring scan, unranked so ordered by id
+    q = db.query(Page).options(defer(Page.text_content), joinedload(Page.document))
+    q = q.filter(*_like_clauses(query)).filter(*_page_clauses(query, filters))
+    if after:
+        q = q.filter(Page.id > after[1])
+    q = q.order_by(Page.id)
+    return [(page, 1.0) for page in q.limit(limit).all()]
+
+def _collapse(db: Session, scored, groups: int, per_group: int) -> List[tuple]:
+    """
+    Collapse a subquery of (id, document_id, score) rows with window functions,
+    in one statement: rank pages within their document, count and take the
+    best score per document, then keep the best `per_group` pages of the top
+    `groups` documents.
+    """
+    by_doc = dict(partition_by=scored.c.document_id)
+    ranked = select(
+        scored.c.id, scored.c.document_id, scored.c.score,
+        func.row_number().over(order_by=(scored.c.score.desc(), scored.c.id), **by_doc).label("slot"),
+        func.count().over(**by_doc).label("matches"),
+        func.max(scored.c.score).over(**by_doc).label("best"),
+    ).subquery()
+    kept = select(
+        ranked.c.id, ranked.c.document_id, ranked.c.score, ranked.c.matches,
+        func.dense_rank().over(order_by=(ranked.c.best.desc(), ranked.c.document_id)).label("doc_rank"),
+    ).where(ranked.c.slot <= per_group).subquery()
+    rows = db.execute(
+        select(kept.c.id, kept.c.document_id, kept.c.score, kept.c.matches)
+        .where(kept.c.doc_rank <= groups)
+        .order_by(kept.c.doc_rank, kept.c.score.desc(), kept.c.id)
+    ).all()
+
+    pages = _load_pages(db, [r.id for r in rows])
+    grouped = []
+    for r in rows:
+        if not grouped or grouped[-1][0] != r.document_id:
+            grouped.append((r.document_id, r.matches, []))
+        if r.id in pages:
+            grouped[-1][2].append((pages[r.id], float(r.score)))
+    return grouped
+
+def _load_pages(db: Session, page_ids: List[int]) -> dict:
+    # One query for the hit pages and their documents instead of a lazy load per hit
+    if not page_ids:
+        return {}
+    q = db.query(Page).options(defer(Page.text_content), joinedload(Page.document)).filter(Page.id.in_(page_ids))
+    return {p.id: p for p in q}
+
+def hydrate_hits(db: Session, hits: List[dict]) -> List[dict]:
+    """
+    Attach document links and page entities to search hits using two IN
+    queries for the whole result list.
+    """
+    doc_ids = {h["_source"]["document_id"] for h in hits if h["_source"].get("document_id")}
+    page_ids = {h["_source"]["page_id"] for h in hits if h["_source"].get("page_id")}
+
+    docs = {}
+    if doc_ids:
+        rows = db.query(Document.id, Document.external_url, Document.dataset).filter(Document.id.in_(doc_ids))
+        docs = {d.id: d for d in rows}
+
+    entities = {}
+    if page_ids:
+        rows = db.query(PageEntity.page_id, Entity.id, Entity.name, Entity.type) \
+            .join(Entity, Entity.id == PageEntity.entity_id) \
+            .filter(PageEntity.page_id.in_(page_ids))
+        for row in rows:
+            page_entities = entities.setdefault(row.page_id, {})
+            page_entities.setdefault(row.id, {"name": row.name, "type": row.type, "id": row.id})
+
+    for hit in hits:
+        source = hit.get("_source", {})
+        doc = docs.get(source.get("document_id"))
+        hit["external_url"] = doc.external_url if doc else None
+        hit["dataset"] = doc.dataset if doc else "GENERAL"
+        hit["entities"] = list(entities.get(source.get("page_id"), {}).values())
+    return hits
+
+# Snippets are cut by the database, so page text never leaves it. Matched
+# terms come back wrapped in these markers and are turned into offsets.
+HIGHLIGHT_START, HIGHLIGHT_END = "\x01", "\x02"
+SNIPPET_CHARS = 200
+PREVIEW_CHARS = 1000
+# ts_headline re-parses the text it is given, so very large pages are cut first
+HEADLINE_MAX_CHARS = 100000
+HEADLINE_OPTIONS = (
+    f'StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_END}", '
+    'MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=" ... "'
+)
+
+def page_snippets(db: Session, page_ids: List[int], query: str) -> dict:
+    """
+    {page_id: (snippet, highlights, preview)} for the given hits, in one query.
+    highlights are [start, end) character offsets of matched terms in snippet.
+    """
+    if not page_ids:
+        return {}
+    dialect = db.bind.dialect.name
+    rows = {}
+    if dialect == "postgresql":
+        rows = _snippets_postgres(db, page_ids, query)
+    elif dialect == "sqlite" and sqlite_fts_available(db.bind) and _fts5_match(query):
+        rows = _snippets_sqlite_fts(db, page_ids, query)
+    # Pages the full-text engine can't highlight (e.g. LIKE hits) get a window around the first match
+    missing = [pid for pid in page_ids if pid not in rows]
+    if missing:
+        rows.update(_snippets_window(db, missing, query))
+
+    out = {}
+    for pid, (marked, preview) in rows.items():
+        snippet, highlights = split_highlights(marked or "")
+        if not highlights:
+            highlights = term_highlights(snippet, query)
+        out[pid] = (snippet, highlights, preview or "")
+    return out
+
+def _snippets_postgres(db: Session, page_ids: List[int], query: str) -> dict:
+    headline = func.ts_headline(
+        'english', func.left(Page.text_content, HEADLINE_MAX_CHARS),
+        _tsquery(query), HEADLINE_OPTIONS
+    )
+    stmt = select(Page.id, headline, func.left(Page.text_content, PREVIEW_CHARS)).where(Page.id.in_(page_ids))
+    return {pid: (marked, preview) for pid, marked, preview in db.execute(stmt)}
+
+def _snippets_sqlite_fts(db: Session, page_ids: List[int], query: str) -> dict:
+    snippet = literal_column(f"snippet({SQLITE_FTS_TABLE}, 0, char(1), char(2), '...', 32)")
+    stmt = _sqlite_fts_ids(query, {}, snippet, func.substr(Page.text_content, 1, PREVIEW_CHARS))
+    stmt = stmt.where(Page.id.in_(page_ids))
+    return {pid: (marked, preview) for pid, marked, preview in db.execute(stmt)}
+
+def _snippets_window(db: Session, page_ids: List[int], query: str) -> dict:
+    # instr() is 1-based and 0 when absent, which lands the window at the start
+    terms = _query_words(query)
+    found = func.instr(func.lower(Page.text_content), terms[0] if terms else (query or "").lower())
+    start = func.max(1, found - 60)
+    stmt = select(
+        Page.id, start, func.length(Page.text_content),
+        func.substr(Page.text_content, start, SNIPPET_CHARS),
+        func.substr(Page.text_content, 1, PREVIEW_CHARS),
+    ).where(Page.id.in_(page_ids))
+    rows = {}
+    for pid, first, length, window, preview in db.execute(stmt):
+        window = window or ""
+        if first and first > 1:
+            window = "..." + window
+        if length and (first or 1) - 1 + SNIPPET_CHARS < length:
+            window += "..."
+        rows[pid] = (window, preview)
+    return rows
+
+def split_highlights(marked: str) -> tuple:
+    """Strip highlight markers, returning (text, [[start, end], ...])."""
+    parts = []
+    highlights = []
+    length = 0
+    start = None
+    for piece in re.split(f"([{HIGHLIGHT_START}{HIGHLIGHT_END}])", marked):
+        if piece == HIGHLIGHT_START:
+            start = length
+        elif piece == HIGHLIGHT_END:
+            if start is not None and length > start:
+                highlights.append([start, length])
+            start = None
+        else:
+            parts.append(piece)
+            length += len(piece)
+    return "".join(parts), highlights
+
+def term_highlights(snippet: str, query: str) -> list:
+    # Only ever runs over a few hundred characters
+    terms = sorted(_query_words(query), key=len, reverse=True)
+    if not terms:
+        return []
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE)
+    return [[m.start(), m.end()] for m in pattern.finditer(snippet)]
+
+def _build_hits(db: Session, matches: List[tuple], query: str) -> List[dict]:
+    snippets = page_snippets(db, [page.id for page, _ in matches], query)
+    return [_build_hit(page, score, snippets.get(page.id, ("", [], ""))) for page, score in matches]
+
+def _build_hit(page: Page, score: float, snippet: tuple) -> dict:
+    text, highlights, preview = snippet
+    return {
+        "_id": f"page_{page.id}",
+        "_score": score,
+        "_source": {
+            "text": text,  # Return snippet instead of full text for list view
+            "highlights": highlights,
+            "full_text_preview": preview,
+            "page_id": page.id,
+            "document_id": page.document_id,
+            "document_title": page.document.filename if page.document else "Unknown",
+            "page_num": page.page_num
+        }
+    }
+
+# Indexing API, called by corpus_events after every commit and by scripts/build_search_index.py
+
+def page_record(page: Page, replace: bool = False) -> dict:
+    """Snapshot of the page columns the search index needs."""
+    return {
+        "id": page.id,
+        "document_id": page.document_id,
+        "page_num": page.page_num,
+        "text_content": page.text_content,
+        "replace": replace,
+    }
+
+def _page_fields(record: dict) -> dict:
+    # Stored with each indexed page so filters are checked inside the index
+    return {
+        "document_id": record.get("document_id"),
+        "page_num": record.get("page_num"),
+        "dataset": record.get("dataset"),
+        "doc_type": record.get("doc_type"),
+        "countries": record.get("countries") or [],
+    }
+
+def attach_page_fields(records: List[dict]):
+    """
+    Fill in document and country fields for page records, with one query for
+    documents and one for page countries. Records coming from ingest hooks
+    only carry page columns.
+    """
+    doc_ids = {r["document_id"] for r in records if r.get("document_id") and "dataset" not in r}
+    page_ids = [r["id"] for r in records if "countries" not in r]
+    if not doc_ids and not page_ids:
+        return
+
+    db = SessionLocal()
+    try:
+        docs = {}
+        if doc_ids:
+            docs = {d.id: d for d in db.query(Document.id, Document.dataset, Document.doc_type).filter(Document.id.in_(doc_ids))}
+        countries = {}
+        if page_ids:
+            rows = db.query(PageEntity.page_id, Entity.country_code).distinct() \
+                .join(Entity, Entity.id == PageEntity.entity_id) \
+                .filter(PageEntity.page_id.in_(page_ids), Entity.country_code.isnot(None))
+            for row in rows:
+                countries.setdefault(row.page_id, []).append(row.country_code)
+    finally:
+        db.close()
+
+    for r in records:
+        doc = docs.get(r.get("document_id"))
+        if doc and "dataset" not in r:
+            r["dataset"] = doc.dataset
+            r["doc_type"] = doc.doc_type
+        if "countries" not in r:
+            r["countries"] = sorted(countries.get(r["id"], []))
+
+def index_pages(records: List[dict]):
+    attach_page_fields(records)
+    _index_backend.index_pages(records)
+
+def reindex_pages(page_ids: Iterable[int]):
+    """Re-read pages from the database and replace them in the index."""
+    page_ids = list(page_ids)
+    if not page_ids or not _index_backend.is_ready():
+        return
+    db = SessionLocal()
+    try:
+        records = [page_record(p, replace=True) for p in db.query(Page).filter(Page.id.in_(page_ids))]
+    finally:
+        db.close()
+    index_pages(records)
+
+def index_page(page, replace: bool = False):
+    index_pages([page if isinstance(page, dict) else page_record(page, replace=replace)])
+
+def delete_pages(page_ids: Iterable[int]):
+    _index_backend.delete_pages(page_ids)
+
+def narrative_text(narrative) -> str:
+    return " ".join(filter(None, [narrative.title, narrative.content]))
+
+def flight_text(flight) -> str:
+    return " ".join(filter(None, [flight.tail_number, flight.origin, flight.destination, flight.passengers]))
+
+def index_narrative(narrative: AINarrative):
+    if _narrative_index.exists():
+        _narrative_index.add(narrative.id, narrative_text(narrative),
+                             {"narrative_type": narrative.narrative_type}, replace=True)
+
+def index_flight(flight: FlightLog):
+    if _flight_index.exists():
+        _flight_index.add(flight.id, flight_text(flight),
+                          {"tail_number": flight.tail_number, "doc_reference": flight.doc_reference}, replace=True)
+
+def search_narratives(query: str, limit: int = 10) -> List[tuple]:
+    """[(narrative_id, score)] from the narrative index."""
+    return [(key, score) for score, key, _, _ in _narrative_index.search(query, limit=limit)]
+
+def search_flights(query: str, limit: int = 10) -> List[tuple]:
+    """[(flight_id, score)] from the flight index."""
+    return [(key, score) for score, key, _, _ in _flight_index.search(query, limit=limit)]
+
+def embed_pages(records: List[dict]):
+    """Add or replace pages in the semantic index, if it has been built."""
+    if records and _semantic_index.exists():
+        _semantic_index.add([(r["id"], r["text_content"]) for r in records])
+
+def sign_pages(records: List[dict]):
+    """Add or replace pages in the near-duplicate index, if it has been built."""
+    if records and _duplicate_index.exists():
+        _duplicate_index.add([(r["id"], r["text_content"]) for r in records])
+
+def sync_corpus(changes: dict):
+    """Apply a committed transaction's page/narrative/flight changes to the indexes."""
+    if changes.get("deleted_pages"):
+        delete_pages(changes["deleted_pages"])
+        if _semantic_index.exists():
+            _semantic_index.delete(changes["deleted_pages"])
+        if _duplicate_index.exists():
+            _duplicate_index.delete(changes["deleted_pages"])
+    if changes.get("pages"):
+        index_pages(list(changes["pages"].values()))
+        embed_pages(list(changes["pages"].values()))
+        sign_pages(list(changes["pages"].values()))
+    # Entity links change a page's country field
+    relinked = set(changes.get("entity_pages", ())) - set(changes.get("pages", {})) - set(changes.get("deleted_pages", ()))
+    if relinked:
+        reindex_pages(relinked)
+    for narrative in changes.get("narratives", {}).values():
+        index_narrative(narrative)
+    for flight in changes.get("flights", {}).values():
+        index_flight(flight)
+
+def create_index():
+    """Create empty page, narrative, flight and near-duplicate indexes; ingest hooks start filling them."""
+    for index in (_index_backend.index, _narrative_index, _flight_index, _duplicate_index):
+        index.create()
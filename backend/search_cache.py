@@ -0,0 +1,186 @@
+"""
+Search Cache
+Query result cache for search_pages: an in-process LRU with a TTL, plus an
+optional SQLite file shared by every uvicorn worker on the host.
+
+Entries are tagged with the corpus generation, a counter kept in the same
+SQLite file. corpus_events bumps it after every committed ingest, which makes
+all older entries misses in every process at once. Ingest paths that bypass
+SessionLocal should call bump_generation() themselves.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from backend.database import BASE_DIR
+except ImportError:
+    from database import BASE_DIR
+
+# SEARCH_CACHE_SIZE=0 turns the cache off
+CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))
+CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+# Holds the generation counter and, when SEARCH_CACHE_SHARED=1, the shared entries
+CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", os.path.join(BASE_DIR, "search_cache.db"))
+CACHE_SHARED = os.getenv("SEARCH_CACHE_SHARED", "0") == "1"
+# Bound on the shared table; oldest entries go first
+SHARED_MAX_ROWS = int(os.getenv("SEARCH_CACHE_SHARED_ROWS", "20000"))
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO generation (id, value) VALUES (1, 0)",
+    """CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY, generation INTEGER NOT NULL, expires REAL NOT NULL, value TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_entries_expires ON entries (expires)",
+]
+
+
+class QueryCache:
+    """
+    LRU + TTL map from a query key to a JSON-serializable result.
+    Values are stored serialized, so callers always get a fresh copy they may mutate.
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, ttl: float = CACHE_TTL,
+                 path: str = CACHE_PATH, shared: bool = CACHE_SHARED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.shared = shared
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._local = threading.local()
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    # -- shared file ----------------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections can't cross threads; FastAPI runs sync code in a pool
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for ddl in _SCHEMA:
+                conn.execute(ddl)
+            self._local.conn = conn
+        return conn
+
+    def generation(self) -> int:
+        return self._conn().execute("SELECT value FROM generation WHERE id = 1").fetchone()[0]
+
+    def bump_generation(self) -> int:
+        """Invalidate every cached result, in this and every other process."""
+        conn = self._conn()
+        conn.execute("UPDATE generation SET value = value + 1 WHERE id = 1")
+        if self.shared:
+            conn.execute("DELETE FROM entries")
+        with self._lock:
+            self._entries.clear()
+            self.counters["invalidations"] += 1
+        return self.generation()
+
+    # -- lookups --------------------------------------------------------------
+
+    def get(self, key: str):
+        """Cached value for key, or None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        generation = self.generation()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires, value = entry
+                if entry_generation == generation and expires > now:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return json.loads(value)
+                del self._entries[key]
+
+        if self.shared:
+            row = self._conn().execute(
+                "SELECT value, expires FROM entries WHERE key = ? AND generation = ? AND expires > ?",
+                (key, generation, now)
+            ).fetchone()
+            if row:
+                self._remember(key, generation, row[1], row[0])
+                with self._lock:
+                    self.counters["shared_hits"] += 1
+                return json.loads(row[0])
+
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key: str, value, generation: int):
+        """
+        Store value under the generation read *before* it was computed, so a
+        result that raced an ingest is never served under the new generation.
+        """
+        if not self.enabled:
+            return
+        expires = time.time() + self.ttl
+        payload = json.dumps(value)
+        self._remember(key, generation, expires, payload)
+        if self.shared:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, generation, expires, value) VALUES (?, ?, ?, ?)",
+                (key, generation, expires, payload)
+            )
+            conn.execute(
+                "DELETE FROM entries WHERE expires <= ? OR key IN "
+                "(SELECT key FROM entries ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (time.time(), SHARED_MAX_ROWS)
+            )
+
+    def _remember(self, key: str, generation: int, expires: float, payload: str):
+        with self._lock:
+            self._entries[key] = (generation, expires, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["shared_hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_rate": round((counters["hits"] + counters["shared_hits"]) / lookups, 4) if lookups else 0.0,
+            "entries": size,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "shared": self.shared,
+            "generation": self.generation(),
+        }
+
+
+cache = QueryCache()
+
+
+def make_key(*parts) -> str:
+    return json.dumps(parts, sort_keys=True, separators=(",", ":"))
+
+
+def bump_generation() -> Optional[int]:
+    try:
+        return cache.bump_generation()
+    except Exception as e:
+        print(f"Search cache invalidation failed: {e}")
+        return None
@@ -0,0 +1,608 @@
+"""
+Grep Index
+Regex and literal search over a memory-mapped export of page text, for
+patterns no tokenizer can answer: tail numbers, case numbers ("20 Cr. 330"),
+Bates IDs (EFTA000\\d+) and partly redacted strings.
+
+Every regex is reduced to a boolean query over the trigrams any match must
+contain (Russ Cox's "Regular Expression Matching with a Trigram Index"). The
+trigram index narrows the pages to candidates and the real regex then verifies
+them against the exported text. The export is split into blocks, and each
+block is pruned and verified as its own task in a worker process, so hits
+stream back block by block while the rest are still being scanned. User
+regexes only ever run in those workers: a request that times out kills the
+workers running its own tasks, and other requests' greps carry on.
+
+Layout of a grep index directory (written by scripts/build_search_index.py):
+    manifest.json       blocks and an index id (replaced atomically)
+    blk_NNNNNN.text     page text, UTF-8, back to back
+    blk_NNNNNN.docs     count, keys (int64), text offsets (uint64, count + 1)
+    blk_NNNNNN.tri      JSON trigram dictionary: trigram -> [offset, count]
+    blk_NNNNNN.post     trigram postings: block-local page ordinals (uint32)
+    blk_NNNNNN.meta     JSON per-page stored fields (columnar), as in search_index
+
+The export is a snapshot: pages deleted since the last build are dropped when
+hits are hydrated, but new and edited text is only seen after a rebuild.
+"""
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from array import array
+from typing import Dict, List, Optional, NamedTuple
+from search_index import field_filter, _native
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+BLOCK_PAGES = int(os.getenv("SEARCH_GREP_BLOCK_PAGES", "20000"))
+GREP_WORKERS = int(os.getenv("SEARCH_GREP_WORKERS", str(min(32, os.cpu_count() or 1))))
+# A pathological regex can backtrack for minutes; the request's workers are killed after this
+GREP_TIMEOUT = float(os.getenv("SEARCH_GREP_TIMEOUT", "30"))
+MAX_PATTERN_CHARS = 300
+# Match spans reported per page
+MAX_SPANS = 50
+# Alternative strings tracked for a part of a regex before it is treated as "anything"
+MAX_EXACT = 64
+
+# Characters re.IGNORECASE matches against a letter whose lower() is different
+_FOLD = str.maketrans({"\u017f": "s", "\u0131": "i", "\u03c2": "\u03c3"})
+
+
+def fold(text: str) -> str:
+    """The case folding the trigram index is built on."""
+    return text.lower().translate(_FOLD)
+
+
+def trigrams(text: str) -> set:
+    text = fold(text)
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# -- regex -> trigram query ------------------------------------------------
+#
+# A query is None (no constraint), a trigram string, or ("and" | "or", children).
+
+def _and(a, b):
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    children = []
+    for n in (a, b):
+        children.extend(n[1] if isinstance(n, tuple) and n[0] == "and" else (n,))
+    return ("and", tuple(dict.fromkeys(children)))
+
+
+def _or(nodes):
+    children = []
+    for n in nodes:
+        if n is None:
+            return None
+        children.extend(n[1] if isinstance(n, tuple) and n[0] == "or" else (n,))
+    children = tuple(dict.fromkeys(children))
+    return children[0] if len(children) == 1 else ("or", children)
+
+
+def _strings_query(strings) -> Optional[tuple]:
+    # Any of the strings: each contributes the AND of its trigrams
+    alternatives = []
+    for s in strings:
+        grams = sorted(trigrams(s))
+        if not grams:
+            return None
+        node = None
+        for g in grams:
+            node = _and(node, g)
+        alternatives.append(node)
+    return _or(alternatives) if alternatives else None
+
+
+class _Info(NamedTuple):
+    exact: Optional[frozenset]  # every string this part can match, when known and small
+    prefix: frozenset           # otherwise: strings every match starts with ...
+    suffix: frozenset           # ... and ends with
+    match: object               # trigram query the text must satisfy
+
+
+_EMPTY = _Info(frozenset([""]), frozenset([""]), frozenset([""]), None)
+_UNKNOWN = _Info(None, frozenset([""]), frozenset([""]), None)
+
+
+def _join(left, right) -> Optional[frozenset]:
+    if len(left) * len(right) > MAX_EXACT:
+        return None
+    return frozenset(x + y for x in left for y in right)
+
+
+def _exact(strings) -> _Info:
+    return _Info(frozenset(strings), frozenset(strings), frozenset(strings), None)
+
+
+def _settle(info: _Info):
+    # The whole trigram query of a part, its exact strings, prefixes and suffixes included
+    node = info.match
+    for strings in (info.exact, info.prefix, info.suffix):
+        if strings is not None:
+            node = _and(node, _strings_query(strings))
+    return node
+
+
+def _concat(a: _Info, b: _Info) -> _Info:
+    if a.exact is not None and b.exact is not None:
+        joined = _join(a.exact, b.exact)
+        if joined is not None:
+            return _Info(joined, joined, joined, _and(a.match, b.match))
+    match = _and(a.match, b.match)
+    # Text around the boundary: one of a's suffixes directly followed by one of b's prefixes
+    boundary = _join(a.suffix, b.prefix)
+    if boundary is not None:
+        match = _and(match, _strings_query(boundary))
+    else:
+        match = _and(match, _and(_strings_query(a.suffix), _strings_query(b.prefix)))
+    prefix = (_join(a.exact, b.prefix) if a.exact is not None else None) or a.prefix
+    suffix = (_join(a.suffix, b.exact) if b.exact is not None else None) or b.suffix
+    return _Info(None, prefix, suffix, match)
+
+
+def _union(sets) -> frozenset:
+    union = frozenset().union(*sets)
+    return union if len(union) <= MAX_EXACT else frozenset([""])
+
+
+def _class_chars(items) -> Optional[set]:
+    chars = set()
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            chars.add(fold(chr(av)))
+        elif op is sre_constants.RANGE and av[1] - av[0] < MAX_EXACT:
+            chars.update(fold(chr(c)) for c in range(av[0], av[1] + 1))
+        else:
+            return None  # negated, \w, \d or a wide range
+    return chars if len(chars) <= MAX_EXACT else None
+
+
+def _analyze(items) -> _Info:
+    info = _EMPTY
+    for op, av in items:
+        info = _concat(info, _node(op, av))
+    return info
+
+
+def _node(op, av) -> _Info:
+    c = sre_constants
+    if op is c.LITERAL:
+        return _exact([fold(chr(av))])
+    if op is c.IN:
+        chars = _class_chars(av)
+        return _exact(chars) if chars else _UNKNOWN
+    if op is c.SUBPATTERN:
+        return _analyze(av[-1])
+    if op is getattr(c, "ATOMIC_GROUP", None):
+        return _analyze(av)
+    if op is c.BRANCH:
+        infos = [_analyze(branch) for branch in av[1]]
+        if all(i.exact is not None and i.match is None for i in infos):
+            union = frozenset().union(*(i.exact for i in infos))
+            if len(union) <= MAX_EXACT:
+                return _exact(union)
+        return _Info(None, _union(i.prefix for i in infos), _union(i.suffix for i in infos),
+                     _or([_settle(i) for i in infos]))
+    if op in (c.MAX_REPEAT, c.MIN_REPEAT, getattr(c, "POSSESSIVE_REPEAT", c.MAX_REPEAT)):
+        low, high, sub = av
+        if low == 0:
+            return _UNKNOWN
+        info = _analyze(sub)
+        if low == high == 1:
+            return info
+        # At least one copy is present; what joins the copies is not tracked
+        return _Info(None, info.prefix, info.suffix, _settle(info))
+    if op in (c.AT, c.ASSERT, c.ASSERT_NOT):
+        return _EMPTY  # zero width
+    return _UNKNOWN
+
+
+def regex_query(pattern: str, flags: int = 0):
+    """The trigram query every match of `pattern` satisfies (None: any page can match)."""
+    return _settle(_analyze(sre_parse.parse(pattern, flags)))
+
+
+def compile_pattern(pattern: str, literal: bool = False, ignore_case: bool = False) -> "re.Pattern":
+    """Validate a grep pattern; raises ValueError for one that is too long or malformed."""
+    if not pattern or len(pattern) > MAX_PATTERN_CHARS:
+        raise ValueError(f"Pattern must be 1 to {MAX_PATTERN_CHARS} characters")
+    try:
+        return re.compile(re.escape(pattern) if literal else pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise ValueError(f"Invalid regex: {e}")
+
+
+# -- blocks ----------------------------------------------------------------
+
+def write_block(root: str, name: str, pages: List[tuple]):
+    """Write a block from (key, text, fields) tuples, in key order."""
+    pages = sorted(pages, key=lambda p: p[0])
+    base = os.path.join(root, name)
+
+    postings: Dict[str, list] = {}
+    offsets = array("Q", [0])
+    with open(base + ".text.tmp", "wb") as f:
+        for ordinal, (_key, text, _fields) in enumerate(pages):
+            for gram in trigrams(text or ""):
+                postings.setdefault(gram, []).append(ordinal)
+            data = (text or "").encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+    tri = {}
+    with open(base + ".post.tmp", "wb") as f:
+        offset = 0
+        for gram in sorted(postings):
+            ordinals = postings[gram]
+            f.write(_native(array("I", ordinals)).tobytes())
+            tri[gram] = [offset, len(ordinals)]
+            offset += 4 * len(ordinals)
+
+    with open(base + ".docs.tmp", "wb") as f:
+        f.write(struct.pack("<I", len(pages)))
+        f.write(_native(array("q", (p[0] for p in pages))).tobytes())
+        f.write(_native(offsets).tobytes())
+
+    field_names = sorted({k for p in pages for k in (p[2] or {})})
+    with open(base + ".meta.tmp", "w", encoding="utf-8") as f:
+        json.dump({k: [(p[2] or {}).get(k) for p in pages] for k in field_names}, f)
+    with open(base + ".tri.tmp", "w", encoding="utf-8") as f:
+        json.dump(tri, f)
+
+    for ext in (".text", ".post", ".docs", ".meta", ".tri"):
+        os.replace(base + ext + ".tmp", base + ext)
+    return {"name": name, "docs": len(pages)}
+
+
+class Block:
+    """Read-only view of one block; exposes `fields` and `distinct` like a Segment so field_filter applies."""
+
+    def __init__(self, root: str, name: str):
+        self.name = name
+        base = os.path.join(root, name)
+        with open(base + ".tri", "r", encoding="utf-8") as f:
+            self.trigrams = json.load(f)
+        with open(base + ".meta", "r", encoding="utf-8") as f:
+            self.fields = json.load(f)
+        with open(base + ".docs", "rb") as f:
+            (count,) = struct.unpack("<I", f.read(4))
+            self.keys = _native(array("q"))
+            self.keys.frombytes(f.read(8 * count))
+            self.offsets = _native(array("Q"))
+            self.offsets.frombytes(f.read(8 * (count + 1)))
+        self._files = [open(base + ext, "rb") for ext in (".text", ".post")]
+        self._text, self._post = (
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+            for f in self._files
+        )
+        self._distinct = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def distinct(self, name: str) -> set:
+        if name not in self._distinct:
+            values = set()
+            for v in self.fields.get(name) or ():
+                values.update(v) if isinstance(v, list) else values.add(v)
+            self._distinct[name] = values
+        return self._distinct[name]
+
+    def text(self, ordinal: int) -> str:
+        return self._text[self.offsets[ordinal]:self.offsets[ordinal + 1]].decode("utf-8", errors="replace")
+
+    def postings(self, gram: str) -> array:
+        ordinals = _native(array("I"))
+        entry = self.trigrams.get(gram)
+        if entry:
+            ordinals.frombytes(self._post[entry[0]:entry[0] + 4 * entry[1]])
+        return ordinals
+
+    def candidates(self, node) -> Optional[set]:
+        """Ordinals satisfying a trigram query; None when it doesn't constrain."""
+        if node is None:
+            return None
+        if isinstance(node, str):
+            return set(self.postings(node))
+        if node[0] == "or":
+            return set().union(*(self.candidates(child) for child in node[1]))
+        result = None
+        # Intersect the rarest trigrams first; an empty set ends the scan
+        children = sorted(node[1], key=lambda n: self.trigrams.get(n, (0, 0))[1] if isinstance(n, str) else len(self))
+        for child in children:
+            found = self.candidates(child)
+            if found is not None:
+                result = found if result is None else result & found
+                if not result:
+                    break
+        return result
+
+    def close(self):
+        for m in (self._text, self._post):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+
+_worker_blocks: Dict[tuple, Block] = {}
+
+
+def _open_block(root: str, index_id: str, name: str) -> Block:
+    # Kept open between tasks; a rebuilt index (new id) replaces its predecessor's blocks
+    block = _worker_blocks.get((root, index_id, name))
+    if block is None:
+        for key in [k for k in _worker_blocks if k[0] == root and k[1] != index_id]:
+            _worker_blocks.pop(key).close()
+        block = _worker_blocks[(root, index_id, name)] = Block(root, name)
+    return block
+
+
+def grep_block(root: str, index_id: str, name: str, pattern: str, flags: int, filters: dict,
+               limit: int, context: int, preview: int) -> List[tuple]:
+    """
+    Pool task: prune one block by trigrams and verify the candidates. Returns
+    up to `limit` hits as (key, match count, snippet, highlights, preview),
+    the snippet being `context` characters either side of the first match.
+    """
+    block = _open_block(root, index_id, name)
+    regex = re.compile(pattern, flags)
+    candidates = block.candidates(regex_query(pattern, flags))
+    ordinals = range(len(block)) if candidates is None else sorted(candidates)
+    accept = field_filter(block, filters or {})
+    if accept is False:
+        return []
+
+    hits = []
+    for ordinal in ordinals:
+        if accept is not None and not accept(ordinal):
+            continue
+        text = block.text(ordinal)
+        spans = []
+        for m in regex.finditer(text):
+            if m.end() > m.start():
+                spans.append(m.span())
+                if len(spans) >= MAX_SPANS:
+                    break
+        if not spans:
+            continue
+        start = max(0, spans[0][0] - context)
+        end = min(len(text), spans[0][1] + context)
+        highlights = [[s - start, e - start] for s, e in spans if s >= start and e <= end]
+        hits.append((block.keys[ordinal], len(spans), text[start:end], highlights, text[:preview]))
+        if len(hits) >= limit:
+            break
+    return hits
+
+
+def _worker_main(conn):
+    """Worker process: run grep_block for each task received until the connection closes."""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(("ok", grep_block(*task)))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+class _Worker:
+    """One grep worker process, busy with at most one task at a time."""
+
+    def __init__(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("spawn").Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class GrepIndex:
+    """A directory of grep blocks; written once by the index builder, then searched."""
+
+    def __init__(self, root: str, block_pages: int = BLOCK_PAGES, workers: int = GREP_WORKERS):
+        self.root = root
+        self.block_pages = block_pages
+        self.workers = workers
+
+        self._mutex = threading.RLock()
+        self._manifest = None
+        self._manifest_mtime = None
+        self._buffer: List[tuple] = []
+        # Workers are spawned on demand, up to `workers`, and shared by all requests
+        self._available = threading.Condition(self._mutex)
+        self._idle: List[_Worker] = []
+        self._live = 0
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root, "manifest.json")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+        self._manifest = manifest
+
+    def create(self):
+        os.makedirs(self.root, exist_ok=True)
+        if not self.exists():
+            self._write_manifest({"index_id": f"{os.getpid()}-{time.time_ns()}", "blocks": []})
+
+    def manifest(self) -> dict:
+        if not self.exists():
+            return {"index_id": "", "blocks": []}
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        with self._mutex:
+            if mtime != self._manifest_mtime:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+                self._manifest_mtime = mtime
+            return self._manifest
+
+    def version(self) -> str:
+        manifest = self.manifest()
+        return f"{manifest['index_id']}:{len(manifest['blocks'])}"
+
+    # -- writing (index builder) ----------------------------------------------
+
+    def add(self, key: int, text: str, fields: dict = None):
+        self._buffer.append((key, text or "", fields or {}))
+        if len(self._buffer) >= self.block_pages:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        manifest = dict(self.manifest())
+        name = f"blk_{len(manifest['blocks']) + 1:06d}"
+        entry = write_block(self.root, name, self._buffer)
+        self._buffer = []
+        manifest["blocks"] = manifest["blocks"] + [entry]
+        self._write_manifest(manifest)
+
+    # -- searching ------------------------------------------------------------
+
+    def _acquire(self, wait_seconds: float) -> Optional[_Worker]:
+        """An idle worker, a new one while fewer than `workers` run, or None after `wait_seconds`."""
+        with self._available:
+            end = time.time() + wait_seconds
+            while not self._idle and self._live >= self.workers:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self._available.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._live += 1
+        try:
+            return _Worker()
+        except Exception:
+            with self._available:
+                self._live -= 1
+                self._available.notify()
+            raise
+
+    def _release(self, worker: _Worker):
+        with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    def _discard(self, worker: _Worker):
+        worker.kill()
+        with self._available:
+            self._live -= 1
+            self._available.notify()
+
+    def _reclaim(self, workers: List[_Worker], deadline: float):
+        """Let tasks a finished grep left running end, then reuse their workers; kill them at the deadline."""
+        for worker in workers:
+            try:
+                if worker.conn.poll(max(0.0, deadline - time.time())):
+                    worker.conn.recv()
+                    self._release(worker)
+                    continue
+            except (EOFError, OSError):
+                pass
+            self._discard(worker)
+
+    def grep(self, regex: "re.Pattern", filters: dict = None, limit: int = 100,
+             context: int = 100, preview: int = 1000, timeout: float = GREP_TIMEOUT):
+        """
+        Yield lists of hits (see grep_block) block by block, as they are
+        verified, until `limit` hits. Each worker gets one block at a time,
+        so stopping early leaves little work behind. Raises TimeoutError once
+        `timeout` seconds pass, after killing the workers still running this
+        grep's blocks.
+        """
+        manifest = self.manifest()
+        pending = [b["name"] for b in reversed(manifest["blocks"])]
+        deadline = time.time() + timeout
+        busy: Dict[object, _Worker] = {}
+        found = 0
+        expired = False
+
+        def submit(worker: _Worker):
+            busy[worker.conn] = worker
+            worker.conn.send((self.root, manifest["index_id"], pending.pop(), regex.pattern, regex.flags,
+                              filters, limit - found, context, preview))
+
+        try:
+            while pending or busy:
+                # Take more workers while they are free; wait for one only when none is busy
+                while pending and len(busy) < self.workers:
+                    worker = self._acquire(0 if busy else max(0.0, deadline - time.time()))
+                    if worker is None:
+                        break
+                    submit(worker)
+                ready = wait(list(busy), timeout=max(0.0, deadline - time.time())) if busy else []
+                if not ready:
+                    expired = True
+                    raise TimeoutError(f"Grep timed out after {timeout:.0f}s")
+
+                for conn in ready:
+                    worker = busy.pop(conn)
+                    try:
+                        status, result = conn.recv()
+                    except (EOFError, OSError):
+                        self._discard(worker)
+                        raise RuntimeError("Grep worker exited unexpectedly")
+                    if status == "error":
+                        self._release(worker)
+                        raise result
+                    hits = result[:limit - found]
+                    found += len(hits)
+                    # Keep the worker busy while the consumer handles these hits
+                    if pending and found < limit:
+                        submit(worker)
+                    else:
+                        self._release(worker)
+                    if hits:
+                        yield hits
+                    if found >= limit:
+                        return
+        finally:
+            if busy:
+                if expired:
+                    for worker in busy.values():
+                        self._discard(worker)
+                else:
+                    threading.Thread(target=self._reclaim, args=(list(busy.values()), deadline),
+                                     daemon=True).start()
+
+    def close(self):
+        self.flush()
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._live -= len(idle)
+        for worker in idle:
+            worker.stop()
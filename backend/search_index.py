@@ -0,0 +1,1193 @@
+"""
+Embedded Search Index
+A file-backed inverted index made of immutable segments.
+
+Each segment holds, per term, the matching document ordinals, term frequencies
+and delta-encoded token positions. Postings are read straight out of a
+memory-mapped .post file; only the term dictionary and the small per-document
+columns are loaded into memory. New documents are buffered and written as new
+segments, deletes are recorded as tombstones, and small segments are merged
+in a background thread.
+
+Layout of an index directory:
+    manifest.json       live segments, counters (replaced atomically)
+    write.lock          cross-process writer lock
+    seg_NNNNNN.post     postings: per term a header, ordinals, tfs, position offsets, positions
+    seg_NNNNNN.terms    JSON term dictionary: term -> [offset, df, max_tf, min_len]
+    seg_NNNNNN.docs     binary doc table: count, keys (int64), lengths (uint32)
+    seg_NNNNNN.meta     JSON per-document stored fields (columnar)
+    seg_NNNNNN.del      JSON list of deleted ordinals
+"""
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import time
+import heapq
+import struct
+import atexit
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Iterable
+from search_query import (
+    parse, query_terms, conjuncts, compare, order_by_selectivity,
+    Query, Term, Phrase, Near, And, Or, Not, Field,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+TERM_HEADER = struct.Struct("<IIII")  # df, max_tf, min_len, positions byte length
+
+MERGE_FACTOR = int(os.getenv("SEARCH_INDEX_MERGE_FACTOR", "8"))
+FLUSH_DOCS = int(os.getenv("SEARCH_INDEX_FLUSH_DOCS", "2000"))
+FLUSH_SECONDS = float(os.getenv("SEARCH_INDEX_FLUSH_SECONDS", "5"))
+
+BM25_K1 = float(os.getenv("SEARCH_BM25_K1", "1.2"))
+BM25_B = float(os.getenv("SEARCH_BM25_B", "0.75"))
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; a token's list index is its position."""
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+def _native(a: array) -> array:
+    # Segment files are little-endian regardless of the host
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _encode_varints(values: Iterable[int]) -> bytes:
+    out = bytearray()
+    for v in values:
+        while v >= 0x80:
+            out.append((v & 0x7F) | 0x80)
+            v >>= 7
+        out.append(v)
+    return bytes(out)
+
+
+def _decode_varints(buf) -> List[int]:
+    values = []
+    v = shift = 0
+    for b in buf:
+        v |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append(v)
+            v = shift = 0
+    return values
+
+
+def encode_positions(positions: List[int]) -> bytes:
+    """Delta-encode ascending token positions as varints."""
+    prev = 0
+    deltas = []
+    for p in positions:
+        deltas.append(p - prev)
+        prev = p
+    return _encode_varints(deltas)
+
+
+def decode_positions(buf) -> List[int]:
+    positions = []
+    total = 0
+    for d in _decode_varints(buf):
+        total += d
+        positions.append(total)
+    return positions
+
+
+class Postings:
+    """Decoded postings of one term in one segment."""
+    __slots__ = ("ordinals", "tfs", "pos_offsets", "pos_blob", "max_tf", "min_len")
+
+    def __init__(self, ordinals, tfs, pos_offsets, pos_blob, max_tf, min_len):
+        self.ordinals = ordinals
+        self.tfs = tfs
+        self.pos_offsets = pos_offsets
+        self.pos_blob = pos_blob
+        self.max_tf = max_tf
+        self.min_len = min_len
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def positions(self, i: int) -> List[int]:
+        return decode_positions(self.pos_blob[self.pos_offsets[i]:self.pos_offsets[i + 1]])
+
+    def raw_positions(self, i: int) -> bytes:
+        return bytes(self.pos_blob[self.pos_offsets[i]:self.pos_offsets[i + 1]])
+
+
+class Segment:
+    """Read-only view of one segment on disk."""
+
+    def __init__(self, root: str, name: str):
+        self.root = root
+        self.name = name
+        base = os.path.join(root, name)
+
+        with open(base + ".terms", "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        with open(base + ".meta", "r", encoding="utf-8") as f:
+            self.fields = json.load(f)
+
+        with open(base + ".docs", "rb") as f:
+            (count,) = struct.unpack("<I", f.read(4))
+            self.keys = _native(array("q"))
+            self.keys.frombytes(f.read(8 * count))
+            self.lengths = _native(array("I"))
+            self.lengths.frombytes(f.read(4 * count))
+        self.total_length = sum(self.lengths)
+
+        self._file = open(base + ".post", "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        self._key_index = None
+        self._distinct = {}
+        self.deleted = set()
+        self.load_tombstones()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def live_count(self) -> int:
+        return len(self.keys) - len(self.deleted)
+
+    def load_tombstones(self):
+        path = os.path.join(self.root, self.name + ".del")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.deleted = set(json.load(f))
+        else:
+            self.deleted = set()
+
+    def ordinal_of(self, key: int) -> Optional[int]:
+        if self._key_index is None:
+            self._key_index = {k: i for i, k in enumerate(self.keys)}
+        return self._key_index.get(key)
+
+    def field(self, name: str, ordinal: int):
+        column = self.fields.get(name)
+        return column[ordinal] if column is not None else None
+
+    def distinct(self, name: str) -> set:
+        """Distinct values of a stored field (list fields are flattened); cached."""
+        if name not in self._distinct:
+            values = set()
+            for v in self.fields.get(name) or ():
+                if isinstance(v, list):
+                    values.update(v)
+                else:
+                    values.add(v)
+            self._distinct[name] = values
+        return self._distinct[name]
+
+    def postings(self, term: str) -> Optional[Postings]:
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        offset = entry[0]
+        df, max_tf, min_len, pos_len = TERM_HEADER.unpack_from(self._mm, offset)
+        offset += TERM_HEADER.size
+
+        ordinals = _native(array("I"))
+        ordinals.frombytes(self._mm[offset:offset + 4 * df])
+        offset += 4 * df
+        tfs = _native(array("I"))
+        tfs.frombytes(self._mm[offset:offset + 4 * df])
+        offset += 4 * df
+        pos_offsets = _native(array("I"))
+        pos_offsets.frombytes(self._mm[offset:offset + 4 * (df + 1)])
+        offset += 4 * (df + 1)
+        pos_blob = memoryview(self._mm)[offset:offset + pos_len] if pos_len else b""
+        return Postings(ordinals, tfs, pos_offsets, pos_blob, max_tf, min_len)
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            try:
+                self._mm.close()
+            except BufferError:
+                # A caller still holds a memoryview; the map goes away with it
+                pass
+        self._file.close()
+
+
+def write_segment(root: str, name: str, docs: List[tuple]):
+    """
+    Write a segment from (key, length, fields, {term: (tf, encoded_positions)}) tuples.
+    Documents are stored in key order so ordinals follow keys.
+    """
+    docs = sorted(docs, key=lambda d: d[0])
+    base = os.path.join(root, name)
+
+    postings: Dict[str, list] = {}
+    for ordinal, (_key, _length, _fields, term_positions) in enumerate(docs):
+        for term, (tf, blob) in term_positions.items():
+            postings.setdefault(term, []).append((ordinal, tf, blob))
+
+    lengths = [d[1] for d in docs]
+    terms = {}
+    with open(base + ".post.tmp", "wb") as f:
+        offset = 0
+        for term in sorted(postings):
+            plist = postings[term]
+            df = len(plist)
+            ordinals = array("I", (p[0] for p in plist))
+            tfs = array("I", (p[1] for p in plist))
+            pos_offsets = array("I", [0])
+            for p in plist:
+                pos_offsets.append(pos_offsets[-1] + len(p[2]))
+            blob = b"".join(p[2] for p in plist)
+            max_tf = max(tfs)
+            min_len = min(lengths[p[0]] for p in plist)
+
+            chunk = (
+                TERM_HEADER.pack(df, max_tf, min_len, len(blob))
+                + _native(ordinals).tobytes()
+                + _native(tfs).tobytes()
+                + _native(pos_offsets).tobytes()
+                + blob
+            )
+            f.write(chunk)
+            terms[term] = [offset, df, max_tf, min_len]
+            offset += len(chunk)
+
+    with open(base + ".docs.tmp", "wb") as f:
+        f.write(struct.pack("<I", len(docs)))
+        f.write(_native(array("q", (d[0] for d in docs))).tobytes())
+        f.write(_native(array("I", lengths)).tobytes())
+
+    field_names = sorted({k for d in docs for k in (d[2] or {})})
+    columns = {k: [(d[2] or {}).get(k) for d in docs] for k in field_names}
+    with open(base + ".meta.tmp", "w", encoding="utf-8") as f:
+        json.dump(columns, f)
+    with open(base + ".terms.tmp", "w", encoding="utf-8") as f:
+        json.dump(terms, f)
+
+    for ext in (".post", ".docs", ".meta", ".terms"):
+        os.replace(base + ext + ".tmp", base + ext)
+
+    return {"name": name, "docs": len(docs), "deleted": 0, "length": sum(lengths)}
+
+
+def bm25_idf(df: int, n: int) -> float:
+    return math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+
+
+def bm25_term(tf: int, length: int, idf: float, avg_length: float) -> float:
+    """BM25 contribution of one term; grows with tf and shrinks with length."""
+    norm = BM25_K1 * (1.0 - BM25_B + BM25_B * length / avg_length)
+    return idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+
+def conjunctive_matches(seg: Segment, lists: List[Postings], accept=None):
+    """
+    Yield (ordinal, [index into each postings list]) for live documents present
+    in every list and passing `accept`. The shortest list drives; the others are
+    probed with a forward-only binary search since all ordinals are ascending.
+    """
+    driver_pos = min(range(len(lists)), key=lambda j: len(lists[j]))
+    driver = lists[driver_pos]
+    cursors = [0] * len(lists)
+    for i, ordinal in enumerate(driver.ordinals):
+        if ordinal in seg.deleted or (accept is not None and not accept(ordinal)):
+            continue
+        idx = []
+        for j, postings in enumerate(lists):
+            if j == driver_pos:
+                idx.append(i)
+                continue
+            k = bisect_left(postings.ordinals, ordinal, cursors[j])
+            cursors[j] = k
+            if k == len(postings.ordinals) or postings.ordinals[k] != ordinal:
+                break
+            idx.append(k)
+        else:
+            yield ordinal, idx
+
+
+def phrase_starts(position_lists: List[List[int]]) -> List[int]:
+    """Positions where the first list's term starts a run of all the lists' terms in order."""
+    starts = set(position_lists[0])
+    for offset, positions in enumerate(position_lists[1:], 1):
+        starts.intersection_update(p - offset for p in positions)
+        if not starts:
+            break
+    return sorted(starts)
+
+
+def within_window(start_lists: List[List[int]], lengths: List[int], slop: int) -> bool:
+    """
+    True if one occurrence of every operand (ascending start positions, fixed
+    token lengths) fits in a window with at most `slop` other tokens. Classic
+    smallest-range sweep: always advance the operand that starts first.
+    """
+    if any(not starts for starts in start_lists):
+        return False
+    needed = sum(lengths)
+    cursors = [0] * len(start_lists)
+    heap = [(starts[0], i) for i, starts in enumerate(start_lists)]
+    heapq.heapify(heap)
+    max_end = max(starts[0] + lengths[i] - 1 for i, starts in enumerate(start_lists))
+    while True:
+        first, i = heap[0]
+        if max_end - first + 1 - needed <= slop:
+            return True
+        cursors[i] += 1
+        if cursors[i] == len(start_lists[i]):
+            return False
+        nxt = start_lists[i][cursors[i]]
+        max_end = max(max_end, nxt + lengths[i] - 1)
+        heapq.heapreplace(heap, (nxt, i))
+
+
+def positional_match(node, positions_of) -> bool:
+    """Check a Phrase or Near clause against one document's term positions."""
+    if isinstance(node, Phrase):
+        return bool(phrase_starts([positions_of(t) for t in node.terms]))
+    if isinstance(node, Near):
+        starts = [
+            positions_of(op.text) if isinstance(op, Term) else phrase_starts([positions_of(t) for t in op.terms])
+            for op in node.operands
+        ]
+        lengths = [1 if isinstance(op, Term) else len(op.terms) for op in node.operands]
+        return within_window(starts, lengths, node.distance)
+    return True
+
+
+def _positions_reader(lists: List[tuple], idx: List[int]):
+    """positions_of(term) for the current candidate, decoding each list at most once."""
+    column = {term: j for j, (term, _) in enumerate(lists)}
+    cache = {}
+
+    def positions_of(term: str) -> List[int]:
+        if term not in cache:
+            j = column[term]
+            cache[term] = lists[j][1].positions(idx[j])
+        return cache[term]
+    return positions_of
+
+
+class _Candidate:
+    """One document's slots in the query's postings, looked up on demand."""
+    __slots__ = ("postings", "ordinal", "slots", "decoded")
+
+    def __init__(self, postings: Dict[str, Optional[Postings]], ordinal: int):
+        self.postings = postings
+        self.ordinal = ordinal
+        self.slots = {}
+        self.decoded = {}
+
+    def slot(self, term: str) -> Optional[int]:
+        if term not in self.slots:
+            found = None
+            p = self.postings.get(term)
+            if p is not None:
+                k = bisect_left(p.ordinals, self.ordinal)
+                if k < len(p.ordinals) and p.ordinals[k] == self.ordinal:
+                    found = k
+            self.slots[term] = found
+        return self.slots[term]
+
+    def has(self, term: str) -> bool:
+        return self.slot(term) is not None
+
+    def tf(self, term: str) -> int:
+        return self.postings[term].tfs[self.slot(term)]
+
+    def positions(self, term: str) -> List[int]:
+        if term not in self.decoded:
+            self.decoded[term] = self.postings[term].positions(self.slot(term))
+        return self.decoded[term]
+
+
+def _intersect(sets: List[set]) -> set:
+    sets = sorted(sets, key=len)
+    result = set(sets[0]) if sets else set()
+    for other in sets[1:]:
+        if not result:
+            break
+        result &= other
+    return result
+
+
+def candidate_ordinals(node, postings: Dict[str, Optional[Postings]]) -> set:
+    """
+    Ordinals that can satisfy node: a superset, since positions and
+    exclusions are left to evaluate(). And clauses are intersected in the
+    order given, so order_by_selectivity puts the smallest first.
+    """
+    if isinstance(node, Term):
+        p = postings.get(node.text)
+        return set(p.ordinals) if p is not None else set()
+    if isinstance(node, (Phrase, Near)):
+        return _intersect([candidate_ordinals(Term(t), postings) for t in query_terms(node)])
+    if isinstance(node, And):
+        result = None
+        for child in node.children:
+            if isinstance(child, Not):
+                continue
+            found = candidate_ordinals(child, postings)
+            result = found if result is None else result & found
+            if not result:
+                break
+        return result or set()
+    if isinstance(node, Or):
+        result = set()
+        for child in node.children:
+            result |= candidate_ordinals(child, postings)
+        return result
+    return set()
+
+
+def evaluate(node, doc: _Candidate) -> bool:
+    """Whether the document behind doc matches the text expression node."""
+    if isinstance(node, Term):
+        return doc.has(node.text)
+    if isinstance(node, (Phrase, Near)):
+        return all(doc.has(t) for t in query_terms(node)) and positional_match(node, doc.positions)
+    if isinstance(node, And):
+        return all(evaluate(c, doc) for c in node.children)
+    if isinstance(node, Or):
+        return any(evaluate(c, doc) for c in node.children)
+    if isinstance(node, Not):
+        return not evaluate(node.child, doc)
+    return False
+
+
+def boolean_matches(seg: Segment, node, postings: Dict[str, Optional[Postings]], accept=None, candidates: set = None):
+    """Yield (ordinal, _Candidate) for live documents matching a boolean text expression."""
+    if candidates is None:
+        candidates = candidate_ordinals(node, postings)
+    for ordinal in sorted(candidates):
+        if ordinal in seg.deleted or (accept is not None and not accept(ordinal)):
+            continue
+        doc = _Candidate(postings, ordinal)
+        if evaluate(node, doc):
+            yield ordinal, doc
+
+
+def field_filter(seg: Segment, filters: dict):
+    """
+    Build a per-ordinal predicate from search filters over the segment's stored
+    fields. Returns None when nothing is filtered and False when no document in
+    the segment can match, so the whole segment is skipped.
+    """
+    checks = []
+    for name, key in (("dataset", "datasets"), ("doc_type", "doc_types")):
+        if filters.get(key):
+            allowed = set(filters[key])
+            if not allowed & seg.distinct(name):
+                return False
+            column = seg.fields.get(name)
+            checks.append(lambda o, column=column, allowed=allowed: column[o] in allowed)
+    if filters.get("countries"):
+        allowed = set(filters["countries"])
+        if not allowed & seg.distinct("countries"):
+            return False
+        column = seg.fields.get("countries")
+        checks.append(lambda o, column=column, allowed=allowed: not allowed.isdisjoint(column[o] or ()))
+    if filters.get("page_min") is not None or filters.get("page_max") is not None:
+        column = seg.fields.get("page_num")
+        if column is None:
+            return False
+        lo = filters.get("page_min")
+        hi = filters.get("page_max")
+        checks.append(lambda o, column=column, lo=lo, hi=hi: column[o] is not None
+                      and (lo is None or column[o] >= lo) and (hi is None or column[o] <= hi))
+
+    if not checks:
+        return None
+    return lambda o: all(check(o) for check in checks)
+
+
+# search_query field -> stored field
+STORED_FIELDS = {"dataset": "dataset", "doc_type": "doc_type", "country": "countries", "page": "page_num"}
+
+
+def where_filter(seg: Segment, node, key_sets: dict = None):
+    """
+    Per-ordinal predicate for a query's field clauses (search_query.Field
+    under And / Or / Not), read from the segment's stored fields. Fields the
+    index doesn't store are answered from `key_sets`, {Field: set of keys}.
+    Returns None without clauses and False when a required dataset or type
+    is absent from the segment.
+    """
+    if node is None:
+        return None
+    required = node.children if isinstance(node, And) else (node,)
+    for f in required:
+        if isinstance(f, Field) and f.name in ("dataset", "doc_type") and f.value not in seg.distinct(f.name):
+            return False
+
+    def build(n):
+        if isinstance(n, Not):
+            inner = build(n.child)
+            return lambda o: not inner(o)
+        if isinstance(n, (And, Or)):
+            checks = [build(c) for c in n.children]
+            combine = all if isinstance(n, And) else any
+            return lambda o: combine(check(o) for check in checks)
+        if n.name in STORED_FIELDS:
+            column = seg.fields.get(STORED_FIELDS[n.name])
+            if column is None:
+                return lambda o: False
+            if n.name == "country":
+                return lambda o: n.value in (column[o] or ())
+            return lambda o: compare(n.op, column[o], n.value)
+        if key_sets is None or n not in key_sets:
+            raise ValueError(f"{n.name}: can't be searched in this index")
+        keys = key_sets[n]
+        return lambda o: seg.keys[o] in keys
+
+    return build(node)
+
+
+def segment_filter(seg: Segment, filters: dict, where=None, key_sets: dict = None):
+    """field_filter and where_filter combined, with the same None / False conventions."""
+    checks = [field_filter(seg, filters or {}), where_filter(seg, where, key_sets)]
+    if any(check is False for check in checks):
+        return False
+    checks = [check for check in checks if check is not None]
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda o: all(check(o) for check in checks)
+
+
+def analyze(text: str) -> tuple:
+    """Tokenize text into (length, {term: (tf, encoded positions)})."""
+    positions: Dict[str, List[int]] = {}
+    tokens = tokenize(text)
+    for pos, term in enumerate(tokens):
+        positions.setdefault(term, []).append(pos)
+    return len(tokens), {t: (len(p), encode_positions(p)) for t, p in positions.items()}
+
+
+class SegmentIndex:
+    """
+    An index directory of immutable segments, shared safely between the API
+    process (reader) and ingestion processes (writers).
+    """
+
+    def __init__(self, root: str, merge_factor: int = MERGE_FACTOR,
+                 flush_docs: int = FLUSH_DOCS, flush_seconds: float = FLUSH_SECONDS):
+        self.root = root
+        self.merge_factor = merge_factor
+        self.flush_docs = flush_docs
+        self.flush_seconds = flush_seconds
+
+        self._mutex = threading.RLock()
+        self._segments: Dict[str, Segment] = {}
+        self._manifest = None
+        self._manifest_mtime = None
+
+        self._buffer: Dict[int, tuple] = {}
+        self._flush_timer = None
+        self._merge_thread = None
+        atexit.register(self.close)
+
+    # -- manifest / locking -------------------------------------------------
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root, "manifest.json")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def create(self):
+        """Create an empty index directory if there is none yet."""
+        os.makedirs(self.root, exist_ok=True)
+        with self._write_lock():
+            if not self.exists():
+                self._write_manifest({
+                    "index_id": f"{os.getpid()}-{time.time_ns()}",
+                    "next_segment": 1,
+                    "generation": 0,
+                    "segments": [],
+                })
+
+    @contextmanager
+    def _write_lock(self):
+        with self._mutex:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, "write.lock"), "a+") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict:
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict):
+        manifest["generation"] = manifest.get("generation", 0) + 1
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def refresh(self):
+        """Pick up segments, merges and deletes written by any process."""
+        if not self.exists():
+            return
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        with self._mutex:
+            if mtime == self._manifest_mtime:
+                return
+            manifest = self._read_manifest()
+            if self._manifest and manifest.get("index_id") != self._manifest.get("index_id"):
+                # The directory was rebuilt and swapped in; segment names restart
+                for seg in self._segments.values():
+                    seg.close()
+                self._segments = {}
+            live = {}
+            for entry in manifest["segments"]:
+                seg = self._segments.get(entry["name"])
+                if seg is None:
+                    seg = Segment(self.root, entry["name"])
+                elif len(seg.deleted) != entry["deleted"]:
+                    seg.load_tombstones()
+                live[entry["name"]] = seg
+            for name, seg in self._segments.items():
+                if name not in live:
+                    seg.close()
+            self._segments = live
+            self._manifest = manifest
+            self._manifest_mtime = mtime
+
+    def segments(self) -> List[Segment]:
+        self.refresh()
+        with self._mutex:
+            return [self._segments[e["name"]] for e in self._manifest["segments"]] if self._manifest else []
+
+    def doc_count(self) -> int:
+        return sum(seg.live_count for seg in self.segments())
+
+    def version(self) -> str:
+        """Changes whenever a flush, delete, merge or rebuild changes what search sees."""
+        self.refresh()
+        with self._mutex:
+            if not self._manifest:
+                return ""
+            return f"{self._manifest['index_id']}:{self._manifest['generation']}"
+
+    # -- writing -------------------------------------------------------------
+
+    def add(self, key: int, text: str, fields: dict = None, replace: bool = False):
+        """Buffer a document; it becomes searchable after the next flush."""
+        length, term_positions = analyze(text)
+        with self._mutex:
+            if replace:
+                self._delete_flushed([key])
+            self._buffer[key] = (key, length, fields or {}, term_positions)
+            if len(self._buffer) >= self.flush_docs:
+                self.flush()
+            elif self._flush_timer is None and self.flush_seconds > 0:
+                self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def delete(self, keys: Iterable[int]):
+        keys = list(keys)
+        with self._mutex:
+            for key in keys:
+                self._buffer.pop(key, None)
+            self._delete_flushed(keys)
+
+    def _delete_flushed(self, keys: List[int]):
+        if not keys or not self.exists():
+            return
+        with self._write_lock():
+            self._manifest_mtime = None
+            self.refresh()
+            manifest = self._read_manifest()
+            changed = False
+            for entry in manifest["segments"]:
+                seg = self._segments[entry["name"]]
+                ordinals = [o for o in (seg.ordinal_of(k) for k in keys) if o is not None]
+                if not ordinals:
+                    continue
+                seg.load_tombstones()
+                seg.deleted.update(ordinals)
+                self._write_tombstones(seg.name, seg.deleted)
+                entry["deleted"] = len(seg.deleted)
+                changed = True
+            if changed:
+                self._write_manifest(manifest)
+
+    def _write_tombstones(self, name: str, deleted: set):
+        path = os.path.join(self.root, name + ".del")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(sorted(deleted), f)
+        os.replace(path + ".tmp", path)
+
+    def flush(self):
+        """Write buffered documents as a new segment."""
+        with self._mutex:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._buffer:
+                return
+            docs = list(self._buffer.values())
+            self._buffer = {}
+
+            if not self.exists():
+                self.create()
+            with self._write_lock():
+                manifest = self._read_manifest()
+                name = f"seg_{manifest['next_segment']:06d}"
+                manifest["next_segment"] += 1
+                entry = write_segment(self.root, name, docs)
+                manifest["segments"].append(entry)
+                self._write_manifest(manifest)
+
+        self._maybe_merge()
+
+    # -- merging -------------------------------------------------------------
+
+    def _maybe_merge(self):
+        with self._mutex:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            if len(self._read_manifest()["segments"]) <= self.merge_factor:
+                return
+            self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self._merge_thread.start()
+
+    def _merge_loop(self):
+        try:
+            while len(self._read_manifest()["segments"]) > self.merge_factor:
+                if not self.merge_smallest():
+                    break
+        except Exception as e:
+            print(f"Search index merge failed: {e}")
+
+    def merge_smallest(self) -> bool:
+        """Merge the `merge_factor` smallest segments into one."""
+        entries = sorted(self._read_manifest()["segments"], key=lambda e: e["docs"] - e["deleted"])
+        victims = [e["name"] for e in entries[:self.merge_factor]]
+        return self.merge(victims)
+
+    def merge(self, names: List[str]) -> bool:
+        if len(names) < 2:
+            return False
+
+        with self._write_lock():
+            manifest = self._read_manifest()
+            name = f"seg_{manifest['next_segment']:06d}"
+            manifest["next_segment"] += 1
+            self._write_manifest(manifest)
+
+        # Open private views so the merge never races the reader's refresh
+        sources = [Segment(self.root, n) for n in names]
+        try:
+            docs = []
+            for seg in sources:
+                per_doc: Dict[int, Dict[str, tuple]] = {}
+                for term in seg.terms:
+                    postings = seg.postings(term)
+                    for i, ordinal in enumerate(postings.ordinals):
+                        if ordinal in seg.deleted:
+                            continue
+                        per_doc.setdefault(ordinal, {})[term] = (postings.tfs[i], postings.raw_positions(i))
+                for ordinal, key in enumerate(seg.keys):
+                    if ordinal in seg.deleted:
+                        continue
+                    fields = {k: col[ordinal] for k, col in seg.fields.items()}
+                    docs.append((key, seg.lengths[ordinal], fields, per_doc.get(ordinal, {})))
+            merged_deleted = {n: set(s.deleted) for n, s in zip(names, sources)}
+            entry = write_segment(self.root, name, docs)
+        finally:
+            for seg in sources:
+                seg.close()
+
+        with self._write_lock():
+            manifest = self._read_manifest()
+            current = {e["name"]: e for e in manifest["segments"]}
+            if not all(n in current for n in names):
+                self._remove_segment_files(name)
+                return False
+
+            # Carry over deletes that landed while the merge was running
+            late = []
+            for n in names:
+                tomb_path = os.path.join(self.root, n + ".del")
+                if os.path.exists(tomb_path):
+                    with open(tomb_path, "r", encoding="utf-8") as f:
+                        now_deleted = set(json.load(f))
+                    if now_deleted - merged_deleted[n]:
+                        seg = Segment(self.root, n)
+                        late.extend(seg.keys[o] for o in now_deleted - merged_deleted[n])
+                        seg.close()
+
+            position = min(i for i, e in enumerate(manifest["segments"]) if e["name"] in names)
+            kept = [e for e in manifest["segments"] if e["name"] not in names]
+            kept.insert(min(position, len(kept)), entry)
+            manifest["segments"] = kept
+
+            if late:
+                merged = Segment(self.root, name)
+                dead = {o for o in (merged.ordinal_of(k) for k in late) if o is not None}
+                merged.close()
+                self._write_tombstones(name, dead)
+                entry["deleted"] = len(dead)
+
+            self._write_manifest(manifest)
+
+        for n in names:
+            self._remove_segment_files(n)
+        return True
+
+    def _remove_segment_files(self, name: str):
+        for ext in (".post", ".docs", ".meta", ".terms", ".del"):
+            try:
+                os.remove(os.path.join(self.root, name + ext))
+            except OSError:
+                # Missing, or still mapped by a reader on Windows
+                pass
+
+    # -- searching -----------------------------------------------------------
+
+    def stats(self) -> dict:
+        """
+        Collection statistics for BM25, maintained incrementally: every flush and
+        merge records its segment's document count and total length in the manifest.
+        """
+        self.refresh()
+        entries = self._manifest["segments"] if self._manifest else []
+        stored = sum(e["docs"] for e in entries)
+        return {
+            "docs": stored - sum(e["deleted"] for e in entries),
+            "avg_length": (sum(e["length"] for e in entries) / stored) if stored else 0.0,
+            "segments": len(entries),
+        }
+
+    def document_frequency(self, term: str, segments: List[Segment] = None) -> int:
+        return sum(seg.terms[term][1] for seg in (segments or self.segments()) if term in seg.terms)
+
+    def collection_stats(self, terms: Iterable[str], segments: List[Segment] = None) -> dict:
+        """
+        BM25 inputs for `terms` as {"docs", "stored", "length", "df"}. Every
+        value is a plain sum, so the stats of several indexes add up to the
+        stats of their union (see search_shards).
+        """
+        segments = segments if segments is not None else self.segments()
+        with self._mutex:
+            entries = self._manifest["segments"] if self._manifest else []
+        stored = sum(e["docs"] for e in entries)
+        return {
+            "docs": stored - sum(e["deleted"] for e in entries),
+            "stored": stored,
+            "length": sum(e["length"] for e in entries),
+            "df": {t: self.document_frequency(t, segments) for t in terms},
+        }
+
+    def _bm25_inputs(self, q: Query, segments: List[Segment], corpus: dict = None) -> tuple:
+        # (docs, average length, df) from this index, or from collection-wide stats when sharded
+        corpus = corpus or self.collection_stats(query_terms(q.text, negated=True), segments)
+        avgdl = (corpus["length"] / corpus["stored"]) if corpus["stored"] else 0.0
+        return corpus["docs"], avgdl or 1.0, corpus["df"]
+
+    def search(self, query, limit: int = 10, filters: dict = None, after: tuple = None,
+               key_sets: dict = None, corpus: dict = None) -> List[tuple]:
+        """
+        Term search ranked by BM25 over the query's matched words. Returns
+        [(score, key, segment, ordinal)], best first (ties by ascending key).
+        `query` is search box text (search_query syntax) or a parsed Query.
+        `filters` and the query's field clauses are checked against stored
+        fields before a candidate is scored (see segment_filter). `after` is a
+        (score, key) keyset position; only hits ranking strictly below it are
+        returned. `corpus` replaces this index's own BM25 statistics with
+        collection_stats() summed over every shard, so scores from different
+        shards are comparable.
+
+        Phrase and NEAR clauses are verified by intersecting the candidate's
+        stored position lists, and only for candidates that would otherwise
+        enter the top k.
+
+        Top-k early termination: each segment's term headers give an upper bound
+        on any of its documents' scores, so segments are visited best-bound first
+        and the scan stops once no remaining segment can reach the k-th hit's
+        score (a tie still wins on a smaller key). Within a segment, a
+        candidate is abandoned as soon as its partial score plus the bounds of
+        its unscored terms falls below that threshold.
+        Queries with OR or NOT keep the segment bound but evaluate every
+        candidate (see _search_boolean).
+        """
+        q = query if isinstance(query, Query) else parse(query)
+        terms = query_terms(q.text)
+        if not terms:
+            return []
+        clauses = conjuncts(q.text)
+        if clauses is None:
+            return self._search_boolean(q, limit, filters, after, key_sets, corpus)
+        positional = [node for node in clauses if not isinstance(node, Term)]
+
+        segments = self.segments()
+        n, avgdl, df = self._bm25_inputs(q, segments, corpus)
+        if n == 0 or any(df[t] == 0 for t in terms):
+            return []
+        idf = {t: bm25_idf(df[t], n) for t in terms}
+
+        plans = []
+        for seg in segments:
+            entries = [seg.terms.get(t) for t in terms]
+            if any(e is None for e in entries) or not seg.live_count:
+                continue
+            accept = segment_filter(seg, filters, q.where, key_sets)
+            if accept is False:
+                continue
+            bounds = {t: bm25_term(e[2], e[3], idf[t], avgdl) for t, e in zip(terms, entries)}
+            plans.append((sum(bounds.values()), seg, bounds, accept))
+        plans.sort(key=lambda p: p[0], reverse=True)
+
+        heap = []
+        for seg_bound, seg, bounds, accept in plans:
+            # Strictly below: a segment that can only tie the k-th hit may hold a smaller key, which ranks higher
+            if len(heap) >= limit and seg_bound < heap[0][0]:
+                break
+
+            # Score the highest-impact terms first so pruning kicks in early
+            lists = sorted(((t, seg.postings(t)) for t in terms), key=lambda tp: bounds[tp[0]], reverse=True)
+            remaining = [sum(bounds[t] for t, _ in lists[j:]) for j in range(len(lists) + 1)]
+
+            for ordinal, idx in conjunctive_matches(seg, [p for _, p in lists], accept):
+                dl = seg.lengths[ordinal]
+                full = len(heap) >= limit
+                score = 0.0
+                for j, (term, postings) in enumerate(lists):
+                    if full and score + remaining[j] < heap[0][0]:
+                        break
+                    score += bm25_term(postings.tfs[idx[j]], dl, idf[term], avgdl)
+                else:
+                    key = seg.keys[ordinal]
+                    if after and not (score < after[0] or (score == after[0] and key > after[1])):
+                        continue
+                    item = (score, -key, seg.name, ordinal)
+                    if full and item <= heap[0]:
+                        continue
+                    if positional:
+                        positions_of = _positions_reader(lists, idx)
+                        if not all(positional_match(node, positions_of) for node in positional):
+                            continue
+                    if not full:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+
+        by_name = {seg.name: seg for seg in segments}
+        return [(s, -k, by_name[name], o) for s, k, name, o in sorted(heap, reverse=True)]
+
+    @staticmethod
+    def _ordered_text(q: Query, df: dict):
+        # Real document frequencies put each And's rarest clause first
+        return order_by_selectivity(q.text, lambda leaf: min(df[t] for t in query_terms(leaf)))
+
+    def _search_boolean(self, q: Query, limit: int, filters: dict, after: tuple, key_sets: dict,
+                        corpus: dict = None) -> List[tuple]:
+        """
+        search() for expressions with OR / NOT: candidates come from set algebra
+        over the postings, then the whole expression is evaluated per candidate
+        and the words it actually contains are scored.
+        """
+        segments = self.segments()
+        n, avgdl, df = self._bm25_inputs(q, segments, corpus)
+        if n == 0:
+            return []
+        text = self._ordered_text(q, df)
+        terms = query_terms(text)
+        idf = {t: bm25_idf(df[t], n) for t in terms}
+
+        plans = []
+        for seg in segments:
+            if not seg.live_count:
+                continue
+            present = {t: seg.terms[t] for t in terms if t in seg.terms}
+            if not present:
+                continue
+            accept = segment_filter(seg, filters, q.where, key_sets)
+            if accept is False:
+                continue
+            bound = sum(bm25_term(e[2], e[3], idf[t], avgdl) for t, e in present.items())
+            plans.append((bound, seg, accept))
+        plans.sort(key=lambda p: p[0], reverse=True)
+
+        heap = []
+        for seg_bound, seg, accept in plans:
+            # Strictly below: a segment that can only tie the k-th hit may hold a smaller key, which ranks higher
+            if len(heap) >= limit and seg_bound < heap[0][0]:
+                break
+            postings = {t: seg.postings(t) for t in df}
+            for ordinal, doc in boolean_matches(seg, text, postings, accept):
+                dl = seg.lengths[ordinal]
+                score = sum(bm25_term(doc.tf(t), dl, idf[t], avgdl) for t in terms if doc.has(t))
+                key = seg.keys[ordinal]
+                if after and not (score < after[0] or (score == after[0] and key > after[1])):
+                    continue
+                item = (score, -key, seg.name, ordinal)
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        by_name = {seg.name: seg for seg in segments}
+        return [(s, -k, by_name[name], o) for s, k, name, o in sorted(heap, reverse=True)]
+
+    def matches(self, query, filters: dict = None, key_sets: dict = None, corpus: dict = None):
+        """
+        Every hit as (score, key, segment, ordinal), in index order and with
+        no top-k pruning: for callers that aggregate over all of them.
+        """
+        q = query if isinstance(query, Query) else parse(query)
+        terms = query_terms(q.text)
+        if not terms:
+            return
+        clauses = conjuncts(q.text)
+        segments = self.segments()
+        n, avgdl, df = self._bm25_inputs(q, segments, corpus)
+        text = self._ordered_text(q, df)
+        if n == 0 or (clauses is not None and any(df[t] == 0 for t in terms)):
+            return
+        idf = {t: bm25_idf(df[t], n) for t in terms}
+        positional = [node for node in clauses or () if not isinstance(node, Term)]
+
+        for seg in segments:
+            if not seg.live_count:
+                continue
+            accept = segment_filter(seg, filters, q.where, key_sets)
+            if accept is False:
+                continue
+            if clauses is None:
+                postings = {t: seg.postings(t) for t in df}
+                for ordinal, doc in boolean_matches(seg, text, postings, accept):
+                    dl = seg.lengths[ordinal]
+                    score = sum(bm25_term(doc.tf(t), dl, idf[t], avgdl) for t in terms if doc.has(t))
+                    yield score, seg.keys[ordinal], seg, ordinal
+                continue
+            lists = [(t, seg.postings(t)) for t in terms]
+            if any(p is None for _, p in lists):
+                continue
+            for ordinal, idx in conjunctive_matches(seg, [p for _, p in lists], accept):
+                if positional:
+                    positions_of = _positions_reader(lists, idx)
+                    if not all(positional_match(node, positions_of) for node in positional):
+                        continue
+                dl = seg.lengths[ordinal]
+                score = sum(bm25_term(p.tfs[idx[j]], dl, idf[t], avgdl) for j, (t, p) in enumerate(lists))
+                yield score, seg.keys[ordinal], seg, ordinal
+
+    def search_grouped(self, query, group_field: str, groups: Optional[int] = 10, per_group: int = 3,
+                       filters: dict = None, key_sets: dict = None, corpus: dict = None) -> List[tuple]:
+        """
+        Hits collapsed by a stored field: the `groups` groups with the best
+        hits, as [(group, match_count, [(score, key, segment, ordinal)])], each
+        with its `per_group` best hits first (every group if `groups` is
+        None). One pass over the matches keeps a
+        bounded min-heap per group, so memory is per_group entries per
+        matching group rather than one per hit.
+        """
+        best: Dict[object, list] = {}
+        counts: Dict[object, int] = {}
+        segments = {}
+        for score, key, seg, ordinal in self.matches(query, filters, key_sets, corpus):
+            group = seg.field(group_field, ordinal)
+            counts[group] = counts.get(group, 0) + 1
+            segments[seg.name] = seg
+            heap = best.setdefault(group, [])
+            item = (score, -key, seg.name, ordinal)
+            if len(heap) < per_group:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        top = heapq.nlargest(len(best) if groups is None else groups, best, key=lambda g: max(best[g])[:2])
+        return [
+            (group, counts[group],
+             [(s, -k, segments[name], o) for s, k, name, o in sorted(best[group], reverse=True)])
+            for group in top
+        ]
+
+    def estimate_total(self, query, filters: dict = None, budget: int = 50000, key_sets: dict = None) -> tuple:
+        """
+        Sampled hit count as (value, relation). Segments are counted exactly,
+        largest first, until `budget` driver postings (or boolean candidates)
+        have been walked; the rest is extrapolated from the sampled match rate.
+        """
+        q = query if isinstance(query, Query) else parse(query)
+        terms = query_terms(q.text)
+        if not terms:
+            return 0, "eq"
+        clauses = conjuncts(q.text)
+        positional = [node for node in clauses or () if not isinstance(node, Term)]
+        segments = self.segments()
+        if clauses is None:
+            text = self._ordered_text(q, self.collection_stats(query_terms(q.text, negated=True), segments)["df"])
+        else:
+            text = q.text
+
+        matched = sampled_docs = remaining_docs = walked = 0
+        for seg in sorted(segments, key=lambda s: s.live_count, reverse=True):
+            if walked >= budget:
+                remaining_docs += seg.live_count
+                continue
+            sampled_docs += seg.live_count
+            accept = segment_filter(seg, filters, q.where, key_sets)
+            if accept is False:
+                continue
+            if clauses is None:
+                postings = {t: seg.postings(t) for t in query_terms(text, negated=True)}
+                candidates = candidate_ordinals(text, postings)
+                walked += len(candidates)
+                matched += sum(1 for _ in boolean_matches(seg, text, postings, accept, candidates))
+                continue
+            lists = [seg.postings(t) for t in terms]
+            if any(p is None for p in lists):
+                continue
+            walked += min(len(p) for p in lists)
+            if not positional:
+                matched += sum(1 for _ in conjunctive_matches(seg, lists, accept))
+                continue
+            named = list(zip(terms, lists))
+            for _, idx in conjunctive_matches(seg, lists, accept):
+                positions_of = _positions_reader(named, idx)
+                if all(positional_match(node, positions_of) for node in positional):
+                    matched += 1
+
+        if not remaining_docs:
+            return matched, "eq"
+        return int(round(matched * (sampled_docs + remaining_docs) / max(sampled_docs, 1))), "estimate"
+
+    def close(self):
+        """Flush buffered documents and wait for a running merge."""
+        try:
+            if self._buffer and self.exists():
+                self.flush()
+            thread = self._merge_thread
+            if thread is not None and thread.is_alive():
+                thread.join()
+        except Exception as e:
+            print(f"Search index close failed: {e}")
@@ -0,0 +1,518 @@
+"""
+Search Query
+Parses the search box syntax and compiles it to each engine's native form.
+
+    little st james              every word, anywhere on the page
+    "little st james"            exact phrase
+    maxwell NEAR/5 epstein       at most 5 other words between them (plain NEAR: 10, at most NEAR/20)
+    paris OR london              either one; AND (or just a space) binds tighter
+    maxwell -dershowitz          NOT, or a leading "-", excludes a word, phrase or group
+    maxwell (paris OR london)    parentheses group
+    dataset:Justice.gov          pages of one dataset; also type:, country: and
+    entity:"Ghislaine Maxwell"   pages that mention an entity
+    page:>10  page:5..20         page number comparisons and ranges
+
+Words are what the indexes store: lowercased runs of letters and digits, so
+"N212JE" and "St." match n212je and st. Operators are upper case; a lower
+case "near" or "or" is an ordinary word.
+
+Field clauses are filters rather than text: they combine with words through
+AND and NOT (and with each other through OR too), and are pushed down to the
+database as predicates.
+"""
+import re
+import operator
+from typing import Callable, List, NamedTuple, Optional, Union
+
+DEFAULT_NEAR = 10
+# NEAR/N expands to 2 * (N + 1) alternatives in a Postgres tsquery, so N is capped for every engine
+MAX_NEAR = 20
+
+# Search box field name -> canonical field
+FIELDS = {
+    "dataset": "dataset",
+    "type": "doc_type",
+    "doc_type": "doc_type",
+    "country": "country",
+    "entity": "entity",
+    "page": "page",
+}
+
+COMPARISONS = {
+    "=": operator.eq,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+WORD_RE = re.compile(r"\w+")
+TOKEN_RE = re.compile(r'''
+    (?P<paren>[()])
+  | (?P<field>(?P<name>[A-Za-z_]+):(?P<cmp>>=|<=|>|<|=)?(?:"(?P<quoted>[^"]*)"?|(?P<bare>[^\s()"]+)))
+  | (?<![^\s(])(?P<neg>-)(?=[^\s\-)])
+  | "(?P<phrase>[^"]*)"?
+  | (?P<op>(?:AND|OR|NOT|NEAR(?:/(?P<distance>\d+))?)(?=[\s()"]|$))
+  | [^\s()"]+
+''', re.VERBOSE)
+
+
+class Term(NamedTuple):
+    text: str
+
+
+class Phrase(NamedTuple):
+    terms: tuple
+
+
+class Near(NamedTuple):
+    operands: tuple  # Term / Phrase
+    distance: int
+
+
+class And(NamedTuple):
+    children: tuple
+
+
+class Or(NamedTuple):
+    children: tuple
+
+
+class Not(NamedTuple):
+    child: "Node"
+
+
+class Field(NamedTuple):
+    name: str  # a FIELDS value
+    op: str    # a COMPARISONS key, or ".." with value (low, high), either end None
+    value: object
+
+
+Node = Union[Term, Phrase, Near, And, Or, Not, Field]
+
+
+class Query(NamedTuple):
+    text: Optional[Node]   # what the full-text engine matches and ranks
+    where: Optional[Node]  # Field clauses under And / Or / Not
+
+
+def words(value: str) -> List[str]:
+    return WORD_RE.findall((value or "").lower())
+
+
+def parse(query: str) -> Query:
+    """
+    Parse a search box query into its text and field parts. Operators that
+    are missing an operand are dropped; queries that can't be run raise
+    ValueError with a message meant for the user.
+    """
+    node = _Parser(_tokens(query)).parse()
+    text, where = _split(node)
+    if text is None and where is not None:
+        raise ValueError("Field filters need at least one word or phrase to search for")
+    if text is not None and not _positive(text):
+        raise ValueError("Exclusions need at least one word or phrase that must match")
+    return Query(text, where)
+
+
+def canonical(query: str) -> str:
+    """Stable text for a query's meaning, for cache keys."""
+    return repr(parse(query))
+
+
+# -- parsing ------------------------------------------------------------------------
+
+def _word_atom(text: str):
+    terms = tuple(words(text))
+    if not terms:
+        return None
+    # "o'brien" or "N.212" index as adjacent words
+    return Term(terms[0]) if len(terms) == 1 else Phrase(terms)
+
+
+def _field(name: str, cmp: Optional[str], raw: str) -> Field:
+    raw = (raw or "").strip()
+    if not raw:
+        raise ValueError(f"{name}: needs a value")
+    if name == "page":
+        try:
+            if cmp is None and ".." in raw:
+                low, high = raw.split("..", 1)
+                if not low and not high:
+                    raise ValueError(raw)
+                return Field("page", "..", (int(low) if low else None, int(high) if high else None))
+            return Field("page", cmp or "=", int(raw))
+        except ValueError:
+            raise ValueError("page: expects a number, a comparison like page:>10 or a range like page:5..20")
+    if cmp not in (None, "="):
+        raise ValueError(f"{name}: only matches exact values")
+    return Field(name, "=", raw.upper() if name == "country" else raw)
+
+
+def _tokens(query: str) -> list:
+    """(kind, value) pairs; kind is "(", ")", "AND", "OR", "NOT", "NEAR" or "atom"."""
+    out = []
+    for m in TOKEN_RE.finditer(query or ""):
+        atom = None
+        if m.group("paren"):
+            out.append((m.group("paren"), None))
+            continue
+        elif m.group("field"):
+            name = FIELDS.get(m.group("name").lower())
+            if name is None:
+                atom = _word_atom(m.group(0))
+            else:
+                raw = m.group("quoted") if m.group("quoted") is not None else m.group("bare")
+                atom = _field(name, m.group("cmp"), raw)
+        elif m.group("neg"):
+            out.append(("NOT", None))
+            continue
+        elif m.group("phrase") is not None:
+            atom = _word_atom(m.group("phrase"))
+        elif m.group("op"):
+            if m.group("op").startswith("NEAR"):
+                distance = int(m.group("distance")) if m.group("distance") else DEFAULT_NEAR
+                if distance > MAX_NEAR:
+                    raise ValueError(f"NEAR/{distance}: proximity is limited to NEAR/{MAX_NEAR}")
+                out.append(("NEAR", distance))
+            else:
+                out.append((m.group("op"), None))
+            continue
+        else:
+            atom = _word_atom(m.group(0))
+        if atom is not None:
+            out.append(("atom", atom))
+    return out
+
+
+def _and(children) -> Optional[Node]:
+    flat = []
+    for child in children:
+        if child is None:
+            continue
+        flat.extend(child.children if isinstance(child, And) else (child,))
+    flat = list(dict.fromkeys(flat))
+    if not flat:
+        return None
+    return flat[0] if len(flat) == 1 else And(tuple(flat))
+
+
+def _or(children) -> Optional[Node]:
+    flat = []
+    for child in children:
+        if child is None:
+            continue
+        flat.extend(child.children if isinstance(child, Or) else (child,))
+    flat = list(dict.fromkeys(flat))
+    if not flat:
+        return None
+    return flat[0] if len(flat) == 1 else Or(tuple(flat))
+
+
+def _near(left: Node, right: Node, distance: int) -> Node:
+    if isinstance(left, And) and isinstance(left.children[-1], Near):
+        # A chain that already changed distance once
+        return _and([*left.children[:-1], _near(left.children[-1], right, distance)])
+    if not isinstance(right, (Term, Phrase)) or not isinstance(left, (Term, Phrase, Near)):
+        raise ValueError("NEAR joins words and phrases, not groups or fields")
+    if isinstance(left, Near):
+        if left.distance == distance:
+            return Near(left.operands + (right,), distance)
+        # a NEAR/5 b NEAR/3 c: b is the left operand of the second NEAR
+        return And((left, Near((left.operands[-1], right), distance)))
+    return Near((left, right), distance)
+
+
+class _Parser:
+    """
+    Recursive descent, loosest binding first:
+        or_expr  := and_expr ("OR" and_expr)*
+        and_expr := unary (["AND"] unary)*
+        unary    := ("NOT" | "-") unary | near
+        near     := atom ("NEAR" atom)*
+        atom     := "(" or_expr ")" | phrase | field | word
+    """
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self) -> Optional[Node]:
+        node = self.or_expr()
+        while self.peek() is not None:
+            # Unbalanced ")": keep going as if it weren't there
+            self.take()
+            node = _and([node, self.or_expr()])
+        return node
+
+    def or_expr(self) -> Optional[Node]:
+        children = [self.and_expr()]
+        while self.peek() == "OR":
+            self.take()
+            children.append(self.and_expr())
+        return _or(children)
+
+    def and_expr(self) -> Optional[Node]:
+        children = []
+        while self.peek() not in (None, ")", "OR"):
+            if self.peek() == "AND":
+                self.take()
+                continue
+            children.append(self.unary())
+        return _and(children)
+
+    def unary(self) -> Optional[Node]:
+        if self.peek() == "NOT":
+            self.take()
+            child = self.unary()
+            return Not(child) if child is not None else None
+        return self.near()
+
+    def near(self) -> Optional[Node]:
+        left = self.atom()
+        while self.peek() == "NEAR":
+            distance = self.take()[1]
+            right = self.atom()
+            if right is None:
+                continue
+            left = right if left is None else _near(left, right, distance)
+        return left
+
+    def atom(self) -> Optional[Node]:
+        kind = self.peek()
+        if kind == "(":
+            self.take()
+            node = self.or_expr()
+            if self.peek() == ")":
+                self.take()
+            return node
+        if kind == "atom":
+            return self.take()[1]
+        return None
+
+
+def _is_field_only(node: Node) -> Optional[bool]:
+    """True if every leaf is a Field, False if none is, None if mixed."""
+    if isinstance(node, Field):
+        return True
+    if isinstance(node, Not):
+        return _is_field_only(node.child)
+    if isinstance(node, (And, Or)):
+        kinds = {_is_field_only(c) for c in node.children}
+        return kinds.pop() if len(kinds) == 1 else None
+    return False
+
+
+def _split(node: Optional[Node]) -> tuple:
+    text, where = [], []
+    for part in (node.children if isinstance(node, And) else (node,) if node else ()):
+        kind = _is_field_only(part)
+        if kind is None:
+            raise ValueError("Field filters combine with words through AND and NOT only")
+        (where if kind else text).append(part)
+    return _and(text), _and(where)
+
+
+def _positive(node: Node) -> bool:
+    """Whether node can match on its own, i.e. isn't purely exclusions."""
+    if isinstance(node, Not):
+        return False
+    if isinstance(node, And):
+        return any(_positive(c) for c in node.children)
+    if isinstance(node, Or):
+        return all(_positive(c) for c in node.children)
+    return True
+
+
+# -- inspection ---------------------------------------------------------------------
+
+def query_terms(node: Optional[Node], negated: bool = False) -> List[str]:
+    """Every distinct word the text part matches on, in order; excluded words only if `negated`."""
+    out = []
+
+    def walk(n, excluded):
+        if isinstance(n, Term):
+            if negated or not excluded:
+                out.append(n.text)
+        elif isinstance(n, Phrase):
+            if negated or not excluded:
+                out.extend(n.terms)
+        elif isinstance(n, Near):
+            for op in n.operands:
+                walk(op, excluded)
+        elif isinstance(n, Not):
+            walk(n.child, True)
+        elif isinstance(n, (And, Or)):
+            for c in n.children:
+                walk(c, excluded)
+
+    if node is not None:
+        walk(node, False)
+    return list(dict.fromkeys(out))
+
+
+def conjuncts(node: Optional[Node]) -> Optional[list]:
+    """The clauses of a plain conjunction of words, phrases and NEARs; None for anything else."""
+    if node is None:
+        return None
+    clauses = node.children if isinstance(node, And) else (node,)
+    if all(isinstance(c, (Term, Phrase, Near)) for c in clauses):
+        return list(clauses)
+    return None
+
+
+def is_plain(node: Optional[Node]) -> bool:
+    clauses = conjuncts(node)
+    return clauses is not None and all(isinstance(c, Term) for c in clauses)
+
+
+def fields(node: Optional[Node]) -> List[Field]:
+    if isinstance(node, Field):
+        return [node]
+    if isinstance(node, Not):
+        return fields(node.child)
+    if isinstance(node, (And, Or)):
+        return [f for c in node.children for f in fields(c)]
+    return []
+
+
+def compare(op: str, actual, value) -> bool:
+    """Evaluate a Field comparison against a stored value."""
+    if actual is None:
+        return False
+    if op == "..":
+        low, high = value
+        return (low is None or actual >= low) and (high is None or actual <= high)
+    return COMPARISONS[op](actual, value)
+
+
+# -- selectivity ---------------------------------------------------------------------
+
+def estimate(node: Node, leaf: Callable[[Node], float]) -> float:
+    """Expected matches of node given `leaf` estimates for words, phrases, NEARs and fields."""
+    if isinstance(node, And):
+        positives = [estimate(c, leaf) for c in node.children if not isinstance(c, Not)]
+        return min(positives) if positives else float("inf")
+    if isinstance(node, Or):
+        return sum(estimate(c, leaf) for c in node.children)
+    if isinstance(node, Not):
+        return float("inf")
+    return leaf(node)
+
+
+def order_by_selectivity(node: Optional[Node], leaf: Callable[[Node], float]) -> Optional[Node]:
+    """
+    Reorder every And so its most selective clause comes first and exclusions
+    come last; engines that evaluate left to right then drive from the
+    smallest candidate set and short-circuit sooner.
+    """
+    if isinstance(node, And):
+        children = [order_by_selectivity(c, leaf) for c in node.children]
+        return And(tuple(sorted(children, key=lambda c: estimate(c, leaf))))
+    if isinstance(node, Or):
+        return Or(tuple(order_by_selectivity(c, leaf) for c in node.children))
+    if isinstance(node, Not):
+        return Not(order_by_selectivity(node.child, leaf))
+    return node
+
+
+def heuristic_selectivity(node: Node) -> float:
+    """
+    Leaf estimate for engines without cheap term statistics, as a fraction of
+    pages: long words are rarer than short ones, and every extra word of a
+    phrase or NEAR narrows it further.
+    """
+    if isinstance(node, Term):
+        return 1.0 / (1 + len(node.text))
+    if isinstance(node, Phrase):
+        return min(heuristic_selectivity(Term(t)) for t in node.terms) / len(node.terms)
+    if isinstance(node, Near):
+        return min(heuristic_selectivity(op) for op in node.operands) / len(node.operands)
+    return 1.0
+
+
+# -- Postgres ---------------------------------------------------------------------
+
+def _ts_operand(node: Node) -> str:
+    if isinstance(node, Term):
+        return node.text
+    return "(" + " <-> ".join(node.terms) + ")"
+
+
+def _ts_near_pair(a: Node, b: Node, distance: int) -> str:
+    # tsquery only has exact distances (<N>), so "within N" is every distance in either order
+    options = []
+    for gap in range(1, distance + 2):
+        options.append(f"{_ts_operand(a)} <{gap}> {_ts_operand(b)}")
+        options.append(f"{_ts_operand(b)} <{gap}> {_ts_operand(a)}")
+    return "(" + " | ".join(options) + ")"
+
+
+def to_tsquery(node: Node) -> str:
+    """
+    Text for to_tsquery('english', ...). NEAR groups of three or more operands
+    become pairwise constraints between neighbours, which is looser than the
+    single window FTS5 and the embedded index require: "a NEAR/2 b NEAR/2 c"
+    also accepts a and c up to 5 words apart.
+    """
+    if isinstance(node, (Term, Phrase)):
+        return _ts_operand(node)
+    if isinstance(node, Near):
+        ops = node.operands
+        return "(" + " & ".join(_ts_near_pair(ops[i], ops[i + 1], node.distance) for i in range(len(ops) - 1)) + ")"
+    if isinstance(node, Not):
+        return "!" + to_tsquery(node.child)
+    if isinstance(node, And):
+        return "(" + " & ".join(to_tsquery(c) for c in node.children) + ")"
+    if isinstance(node, Or):
+        return "(" + " | ".join(to_tsquery(c) for c in node.children) + ")"
+    raise ValueError(f"Not a text clause: {node!r}")
+
+
+# -- SQLite FTS5 --------------------------------------------------------------------
+
+def _fts5_operand(node: Node) -> str:
+    if isinstance(node, Term):
+        return f'"{node.text}"'
+    return '"' + " ".join(node.terms) + '"'
+
+
+def to_fts5(node: Node) -> str:
+    """
+    FTS5 MATCH expression; words are always quoted so none is read as syntax.
+    FTS5's NOT is binary, so an And's exclusions are subtracted from the
+    conjunction of its other clauses.
+    """
+    if isinstance(node, (Term, Phrase)):
+        return _fts5_operand(node)
+    if isinstance(node, Near):
+        return "NEAR(" + " ".join(_fts5_operand(op) for op in node.operands) + f", {node.distance})"
+    if isinstance(node, Or):
+        return "(" + " OR ".join(to_fts5(c) for c in node.children) + ")"
+    if isinstance(node, And):
+        positives = [c for c in node.children if not isinstance(c, Not)]
+        expr = "(" + " AND ".join(to_fts5(c) for c in positives) + ")"
+        for excluded in (c.child for c in node.children if isinstance(c, Not)):
+            expr = f"({expr} NOT {to_fts5(excluded)})"
+        return expr
+    raise ValueError(f"FTS5 can't match {node!r} on its own")
+
+
+# -- LIKE fallback ------------------------------------------------------------------
+
+def like_patterns(node: Node) -> List[str]:
+    """
+    ILIKE patterns that must all match for a word, phrase or NEAR. A phrase
+    keeps its word order but not its adjacency, and NEAR degrades to its
+    operands; exact checks need an index.
+    """
+    operands = node.operands if isinstance(node, Near) else (node,)
+    return ["%" + "%".join(query_terms(op)) + "%" for op in operands]
@@ -0,0 +1,319 @@
+"""
+Search Schema
+Dialect-specific full-text structures that live next to the ORM tables.
+
+On Postgres, `pages.search_vector` is a stored tsvector kept up to date by a
+trigger and served by a GIN index. Large existing databases should be
+backfilled with scripts/migrate_search_vector.py before the index is built.
+
+On SQLite, `pages_fts` is an external-content FTS5 table over pages.text_content,
+kept in sync by triggers.
+
+Fuzzy suggestions use trigram indexes over entities.name and documents.filename:
+pg_trgm GIN indexes on Postgres (built concurrently by
+scripts/migrate_indexes.py), and the `suggest_trgm` FTS5 trigram table on
+SQLite (see suggest.py).
+"""
+from sqlalchemy import text, literal_column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+# tsvector values are capped at 1MB; full-dataset djvu imports can exceed that,
+# so only the leading part of very large pages is vectorized.
+SEARCH_VECTOR_MAX_CHARS = 1000000
+SEARCH_VECTOR_INDEX = "ix_pages_search_vector"
+
+SEARCH_VECTOR_EXPR = f"to_tsvector('english', left(coalesce(text_content, ''), {SEARCH_VECTOR_MAX_CHARS}))"
+
+# Column reference for queries; the column is not mapped on models.Page so
+# SQLite databases and ORM inserts never touch it.
+search_vector = literal_column("pages.search_vector", type_=TSVECTOR)
+
+PG_SEARCH_VECTOR_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION pages_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    BEGIN
+        NEW.search_vector := {SEARCH_VECTOR_EXPR.replace('text_content', 'NEW.text_content')};
+    EXCEPTION WHEN program_limit_exceeded THEN
+        NEW.search_vector := NULL;
+    END;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+PG_SEARCH_VECTOR_TRIGGER = """
+CREATE TRIGGER pages_search_vector_trigger
+BEFORE INSERT OR UPDATE OF text_content ON pages
+FOR EACH ROW EXECUTE PROCEDURE pages_search_vector_update()
+"""
+
+
+SQLITE_FTS_TABLE = "pages_fts"
+
+SQLITE_FTS_DDL = [
+    f"""
+    CREATE VIRTUAL TABLE {SQLITE_FTS_TABLE} USING fts5(
+        text_content, content='pages', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS pages_fts_ai AFTER INSERT ON pages BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, text_content) VALUES (new.id, new.text_content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS pages_fts_ad AFTER DELETE ON pages BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, text_content) VALUES ('delete', old.id, old.text_content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS pages_fts_au AFTER UPDATE OF text_content ON pages BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, text_content) VALUES ('delete', old.id, old.text_content);
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, text_content) VALUES (new.id, new.text_content);
+    END
+    """,
+]
+
+PG_TRGM_INDEXES = {
+    "ix_entities_name_trgm": "entities USING gin (name gin_trgm_ops)",
+    "ix_documents_filename_trgm": "documents USING gin (filename gin_trgm_ops)",
+}
+
+
+SUGGEST_TRGM_TABLE = "suggest_trgm"
+
+# rowid = id * 2 for entities and id * 2 + 1 for documents, so the triggers
+# can delete by rowid without a second lookup table
+SUGGEST_TRGM_DDL = [
+    f"""
+    CREATE VIRTUAL TABLE {SUGGEST_TRGM_TABLE} USING fts5(
+        label, kind UNINDEXED, tokenize='trigram'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trgm_ai AFTER INSERT ON entities BEGIN
+        INSERT INTO {SUGGEST_TRGM_TABLE}(rowid, label, kind) VALUES (new.id * 2, new.name, 'entity');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trgm_ad AFTER DELETE ON entities BEGIN
+        DELETE FROM {SUGGEST_TRGM_TABLE} WHERE rowid = old.id * 2;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trgm_au AFTER UPDATE OF name ON entities BEGIN
+        DELETE FROM {SUGGEST_TRGM_TABLE} WHERE rowid = old.id * 2;
+        INSERT INTO {SUGGEST_TRGM_TABLE}(rowid, label, kind) VALUES (new.id * 2, new.name, 'entity');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS documents_trgm_ai AFTER INSERT ON documents BEGIN
+        INSERT INTO {SUGGEST_TRGM_TABLE}(rowid, label, kind) VALUES (new.id * 2 + 1, new.filename, 'document');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS documents_trgm_ad AFTER DELETE ON documents BEGIN
+        DELETE FROM {SUGGEST_TRGM_TABLE} WHERE rowid = old.id * 2 + 1;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS documents_trgm_au AFTER UPDATE OF filename ON documents BEGIN
+        DELETE FROM {SUGGEST_TRGM_TABLE} WHERE rowid = old.id * 2 + 1;
+        INSERT INTO {SUGGEST_TRGM_TABLE}(rowid, label, kind) VALUES (new.id * 2 + 1, new.filename, 'document');
+    END
+    """,
+    f"""
+    INSERT INTO {SUGGEST_TRGM_TABLE}(rowid, label, kind)
+    SELECT id * 2, name, 'entity' FROM entities WHERE name IS NOT NULL
+    UNION ALL
+    SELECT id * 2 + 1, filename, 'document' FROM documents WHERE filename IS NOT NULL
+    """,
+]
+
+# Engines (by URL) known to have a usable pages_fts table
+_fts_ready = {}
+# Engines (by URL) with trigram suggestion structures
+_trgm_ready = {}
+
+
+def ensure_search_schema(engine):
+    """Create any missing search structures for the engine's dialect."""
+    if engine.dialect.name == "postgresql":
+        ensure_postgres_search_vector(engine)
+        # Trigram indexes are built by scripts/migrate_indexes.py; suggest.py checks for them
+    elif engine.dialect.name == "sqlite":
+        ensure_sqlite_fts(engine)
+        ensure_sqlite_trigrams(engine)
+
+
+def ensure_postgres_search_vector(engine, check_index: bool = True):
+    """
+    Add the search_vector column and its maintenance trigger.
+    Both steps are cheap on a live table: the column is nullable with no default
+    and the trigger only affects rows written from now on. The GIN index is
+    not built here; a plain CREATE INDEX would lock writers for the whole build,
+    so scripts/migrate_search_vector.py builds it concurrently.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE pages ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+        conn.execute(text(PG_SEARCH_VECTOR_FUNCTION))
+        trigger_exists = conn.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'pages_search_vector_trigger'"
+        )).first()
+        if not trigger_exists:
+            conn.execute(text(PG_SEARCH_VECTOR_TRIGGER))
+
+    if not check_index:
+        return
+
+    with engine.connect() as conn:
+        index_exists = conn.execute(
+            text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+            {"name": SEARCH_VECTOR_INDEX}
+        ).first()
+        if index_exists:
+            return
+        pending = conn.execute(text(
+            "SELECT 1 FROM pages WHERE search_vector IS NULL AND text_content IS NOT NULL LIMIT 1"
+        )).first()
+
+    if pending:
+        print("Warning: pages.search_vector is not backfilled. "
+              "Run scripts/migrate_search_vector.py to backfill and build the GIN index.")
+    else:
+        print(f"Warning: missing index {SEARCH_VECTOR_INDEX}. "
+              "Run scripts/migrate_search_vector.py to build it.")
+
+
+def ensure_sqlite_fts(engine):
+    """
+    Create pages_fts and its sync triggers, then index any existing pages.
+    Leaves search on the LIKE fallback if SQLite was built without FTS5.
+    """
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": SQLITE_FTS_TABLE}
+        ).first()
+        if exists:
+            _fts_ready[str(engine.url)] = True
+            return
+
+        try:
+            conn.execute(text(SQLITE_FTS_DDL[0]))
+        except OperationalError as e:
+            print(f"Warning: SQLite FTS5 unavailable ({e}); search will use LIKE scans.")
+            _fts_ready[str(engine.url)] = False
+            return
+
+        for ddl in SQLITE_FTS_DDL[1:]:
+            conn.execute(text(ddl))
+        conn.execute(text(f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('rebuild')"))
+
+    _fts_ready[str(engine.url)] = True
+
+
+def create_index_concurrently(engine, name: str, target: str):
+    """
+    CREATE INDEX CONCURRENTLY `name` ON `target` (e.g. "pages USING gin (search_vector)"),
+    which keeps the table writable during the build. It cannot run inside a
+    transaction block, and an interrupted build leaves an INVALID index
+    behind that is dropped first. Other dialects get a plain CREATE INDEX.
+    """
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        invalid = conn.execute(text("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND NOT i.indisvalid
+        """), {"name": name}).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target}"))
+
+
+def ensure_postgres_trigrams(engine):
+    """
+    Enable pg_trgm and index the suggestion columns concurrently; needs CREATE
+    privilege once. Run by scripts/migrate_indexes.py, not at startup.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for name, target in PG_TRGM_INDEXES.items():
+            create_index_concurrently(engine, name, target)
+    except Exception as e:
+        print(f"Warning: pg_trgm unavailable ({e}); suggestions will use ILIKE scans.")
+        _trgm_ready[str(engine.url)] = False
+        return
+    _trgm_ready[str(engine.url)] = True
+
+
+def ensure_sqlite_trigrams(engine):
+    """Create suggest_trgm and its triggers, filling it from existing rows."""
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": SUGGEST_TRGM_TABLE}
+        ).first()
+        if exists:
+            _trgm_ready[str(engine.url)] = True
+            return
+
+        try:
+            conn.execute(text(SUGGEST_TRGM_DDL[0]))
+        except OperationalError as e:
+            # The trigram tokenizer needs SQLite 3.34+
+            print(f"Warning: FTS5 trigram tokenizer unavailable ({e}); suggestions will use LIKE scans.")
+            _trgm_ready[str(engine.url)] = False
+            return
+
+        for ddl in SUGGEST_TRGM_DDL[1:]:
+            conn.execute(text(ddl))
+
+    _trgm_ready[str(engine.url)] = True
+
+
+def trigrams_available(bind) -> bool:
+    """
+    True if the database behind `bind` has trigram suggestion indexes. On
+    Postgres a negative answer isn't cached, so servers pick the indexes up
+    once scripts/migrate_indexes.py has built them.
+    """
+    engine = getattr(bind, "engine", bind)
+    key = str(engine.url)
+    if key not in _trgm_ready:
+        with engine.connect() as conn:
+            if engine.dialect.name == "postgresql":
+                valid = conn.execute(text("""
+                    SELECT count(*) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = ANY(:names) AND i.indisvalid
+                """), {"names": list(PG_TRGM_INDEXES)}).scalar()
+                if valid < len(PG_TRGM_INDEXES):
+                    return False
+                found = True
+            elif engine.dialect.name == "sqlite":
+                found = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": SUGGEST_TRGM_TABLE}
+                ).first()
+            else:
+                found = None
+            _trgm_ready[key] = found is not None
+    return _trgm_ready[key]
+
+
+def sqlite_fts_available(bind) -> bool:
+    """True if the database behind `bind` has the pages_fts table."""
+    engine = getattr(bind, "engine", bind)
+    key = str(engine.url)
+    if key not in _fts_ready:
+        with engine.connect() as conn:
+            _fts_ready[key] = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": SQLITE_FTS_TABLE}
+            ).first() is not None
+    return _fts_ready[key]
@@ -0,0 +1,319 @@
+"""
+Sharded Search Index
+Splits the page index into shards, one SegmentIndex directory each, and fans
+queries out over a worker pool.
+
+Pages are routed by Document.dataset (one shard per dataset) or by page-ID
+range. Scoring in search_index is pure Python and holds the GIL, so shards are
+searched in a process pool by default. A query runs in two rounds: the
+collection statistics of every shard are summed first, then each shard scores
+against those global BM25 statistics and returns its top k, and the per-shard
+lists are merged with a heap. Scores are therefore the same as with a single
+index, whatever the sharding.
+
+Layout of a sharded index directory:
+    shards.json         {"key": "dataset" | "range", "range": pages per range shard}
+    <shard>/            a SegmentIndex directory (see search_index)
+
+A directory holding a manifest.json of its own predates sharding and is
+served as one shard until it is rebuilt. Each shard can be rebuilt and swapped
+in on its own (scripts/build_search_index.py --shard).
+"""
+import os
+import re
+import json
+import heapq
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Iterable
+from search_index import SegmentIndex
+from search_query import parse, query_terms, Query
+
+SHARD_KEY = os.getenv("SEARCH_SHARD_KEY", "dataset").lower()
+SHARD_RANGE = int(os.getenv("SEARCH_SHARD_RANGE", "500000"))
+# "process" scales scoring across cores; "thread" only overlaps index I/O
+SHARD_POOL = os.getenv("SEARCH_SHARD_POOL", "process").lower()
+SHARD_WORKERS = int(os.getenv("SEARCH_SHARD_WORKERS", str(min(32, os.cpu_count() or 1))))
+
+CONFIG_FILE = "shards.json"
+NO_DATASET = "_none"
+LEGACY_SHARD = ""
+
+
+def shard_name(config: dict, key: int, fields: dict) -> str:
+    """The shard a page belongs to under `config`."""
+    if config["key"] == "range":
+        return f"ids_{key // config['range']:06d}"
+    dataset = (fields or {}).get("dataset")
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(dataset)) if dataset else NO_DATASET
+
+
+def _results(method: str, value):
+    # Segments are not picklable; callers only need scores and keys
+    if method == "search":
+        return [(score, key) for score, key, _, _ in value]
+    if method == "search_grouped":
+        return [(group, count, [(s, k) for s, k, _, _ in hits]) for group, count, hits in value]
+    return value
+
+
+def _call(index: SegmentIndex, method: str, query: Query, kwargs: dict):
+    return _results(method, getattr(index, method)(query, **kwargs))
+
+
+_worker_indexes: Dict[str, SegmentIndex] = {}
+
+
+def _run(root: str, method: str, query: Query, kwargs: dict):
+    """Pool entry point: searches one shard with an index kept open per worker process."""
+    index = _worker_indexes.get(root)
+    if index is None:
+        index = _worker_indexes[root] = SegmentIndex(root)
+    return _call(index, method, query, kwargs)
+
+
+class ShardedIndex:
+    """
+    A directory of SegmentIndex shards searched in parallel. `index_options`
+    (flush_docs, flush_seconds, ...) are passed on to each shard's SegmentIndex.
+    """
+
+    def __init__(self, root: str, workers: int = SHARD_WORKERS, pool: str = SHARD_POOL, **index_options):
+        self.root = root
+        self.workers = workers
+        self.pool = pool
+        self.index_options = index_options
+
+        self._mutex = threading.RLock()
+        self._shards: Dict[str, SegmentIndex] = {}
+        self._listed: List[str] = []
+        self._listed_mtime = None
+        self._config = None
+        self._executor = None
+
+    # -- layout --------------------------------------------------------------
+
+    @property
+    def config_path(self) -> str:
+        return os.path.join(self.root, CONFIG_FILE)
+
+    def is_legacy(self) -> bool:
+        return os.path.exists(os.path.join(self.root, "manifest.json"))
+
+    def exists(self) -> bool:
+        return os.path.exists(self.config_path) or self.is_legacy()
+
+    def config(self) -> dict:
+        if self._config is None and os.path.exists(self.config_path):
+            with open(self.config_path, "r", encoding="utf-8") as f:
+                self._config = json.load(f)
+        return self._config or {"key": SHARD_KEY, "range": SHARD_RANGE}
+
+    def create(self, key: str = None, range_size: int = None):
+        """Create an empty sharded index if there is none yet; shards appear as pages arrive."""
+        if self.exists():
+            return
+        if (key or SHARD_KEY) not in ("dataset", "range"):
+            raise ValueError(f"Unknown shard key: {key or SHARD_KEY}")
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.config_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"key": key or SHARD_KEY, "range": range_size or SHARD_RANGE}, f)
+        os.replace(tmp, self.config_path)
+        self._config = None
+
+    def shard_path(self, name: str) -> str:
+        return os.path.join(self.root, name) if name else self.root
+
+    def shard(self, name: str) -> SegmentIndex:
+        with self._mutex:
+            index = self._shards.get(name)
+            if index is None:
+                index = self._shards[name] = SegmentIndex(self.shard_path(name), **self.index_options)
+            return index
+
+    def shard_names(self) -> List[str]:
+        """Live shards. Rebuilds and new shards change the directory, so the listing is cached on its mtime."""
+        try:
+            mtime = os.stat(self.root).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._mutex:
+            if mtime != self._listed_mtime:
+                pending = False
+                if self.is_legacy():
+                    names = [LEGACY_SHARD]
+                else:
+                    names = []
+                    # Skip staging (".building") and retired (".old") copies
+                    for name in sorted(os.listdir(self.root)):
+                        if "." in name or not os.path.isdir(os.path.join(self.root, name)):
+                            continue
+                        if os.path.exists(os.path.join(self.root, name, "manifest.json")):
+                            names.append(name)
+                        else:
+                            pending = True
+                for name in set(self._shards) - set(names):
+                    self._shards.pop(name).close()
+                self._listed = names
+                # A shard being created has no manifest yet; list again until it does
+                self._listed_mtime = None if pending else mtime
+                self._config = None
+            return list(self._listed)
+
+    def version(self) -> str:
+        """Changes whenever any shard changes, or a shard is added or swapped in."""
+        versions = "|".join(f"{name}={self.shard(name).version()}" for name in self.shard_names())
+        return hashlib.sha1(versions.encode("utf-8")).hexdigest()[:16] if versions else ""
+
+    # -- writing -------------------------------------------------------------
+
+    def add_many(self, records: Iterable[tuple]):
+        """
+        Buffer (key, text, fields, replace) records into their shards. A
+        replaced page may have moved to another dataset, so its old copy is
+        deleted from every other shard.
+        """
+        legacy = self.is_legacy()
+        config = self.config()
+        moved: Dict[str, List[int]] = {}
+        for key, text, fields, replace in records:
+            name = LEGACY_SHARD if legacy else shard_name(config, key, fields)
+            index = self.shard(name)
+            if not index.exists():
+                index.create()
+            index.add(key, text, fields, replace=replace)
+            if replace and not legacy and config["key"] != "range":
+                moved.setdefault(name, []).append(key)
+        for name in self.shard_names():
+            stale = [key for shard, keys in moved.items() if shard != name for key in keys]
+            if stale:
+                self.shard(name).delete(stale)
+
+    def add(self, key: int, text: str, fields: dict = None, replace: bool = False):
+        self.add_many([(key, text, fields, replace)])
+
+    def delete(self, keys: Iterable[int]):
+        keys = list(keys)
+        for name in self.shard_names():
+            self.shard(name).delete(keys)
+
+    # -- searching -----------------------------------------------------------
+
+    def corpus(self, query: Query, names: List[str]) -> dict:
+        """collection_stats() summed over shards: the BM25 statistics of the whole index."""
+        terms = query_terms(query.text, negated=True)
+        total = {"docs": 0, "stored": 0, "length": 0, "df": dict.fromkeys(terms, 0)}
+        for name in names:
+            stats = self.shard(name).collection_stats(terms)
+            for field in ("docs", "stored", "length"):
+                total[field] += stats[field]
+            for term, df in stats["df"].items():
+                total["df"][term] += df
+        return total
+
+    def _pool(self):
+        with self._mutex:
+            if self._executor is None:
+                try:
+                    if self.pool == "thread":
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                    else:
+                        # fork would copy the parent's threads and locks; spawn starts clean
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+                except Exception as e:
+                    print(f"Search shard pool unavailable, searching shards inline: {e}")
+                    self.workers = 1
+            return self._executor
+
+    def _fan_out(self, method: str, query: Query, kwargs: dict) -> list:
+        """Run a SegmentIndex method on every shard; one result per shard."""
+        names = self.shard_names()
+        executor = self._pool() if len(names) > 1 and self.workers > 1 else None
+        if executor is not None:
+            try:
+                if isinstance(executor, ThreadPoolExecutor):
+                    futures = [executor.submit(_call, self.shard(name), method, query, kwargs) for name in names]
+                else:
+                    futures = [executor.submit(_run, self.shard_path(name), method, query, kwargs) for name in names]
+                return [f.result() for f in futures]
+            except BrokenProcessPool as e:
+                print(f"Search shard pool failed, retrying inline: {e}")
+                with self._mutex:
+                    self._executor = None
+        return [_call(self.shard(name), method, query, kwargs) for name in names]
+
+    def search(self, query, limit: int = 10, filters: dict = None, after: tuple = None,
+               key_sets: dict = None) -> List[tuple]:
+        """
+        SegmentIndex.search over every shard as [(score, key)], best first.
+        Each shard returns its own top `limit` and the lists are heap-merged.
+        """
+        q = query if isinstance(query, Query) else parse(query)
+        names = self.shard_names()
+        if not names:
+            return []
+        kwargs = {"limit": limit, "filters": filters, "after": after, "key_sets": key_sets,
+                  "corpus": self.corpus(q, names)}
+        merged = heapq.merge(*self._fan_out("search", q, kwargs), key=lambda hit: (-hit[0], hit[1]))
+        return [hit for _, hit in zip(range(limit), merged)]
+
+    def search_grouped(self, query, group_field: str, groups: int = 10, per_group: int = 3,
+                       filters: dict = None, key_sets: dict = None) -> List[tuple]:
+        """
+        SegmentIndex.search_grouped over every shard as
+        [(group, count, [(score, key)])]. A document lives in one dataset
+        shard, but its pages can straddle a range boundary, so range shards
+        report every group for the counts to add up.
+        """
+        q = query if isinstance(query, Query) else parse(query)
+        names = self.shard_names()
+        if not names:
+            return []
+        split = self.config()["key"] == "range" and not self.is_legacy()
+        kwargs = {"group_field": group_field, "groups": None if split else groups, "per_group": per_group,
+                  "filters": filters, "key_sets": key_sets, "corpus": self.corpus(q, names)}
+        counts, best = {}, {}
+        for shard_groups in self._fan_out("search_grouped", q, kwargs):
+            for group, count, hits in shard_groups:
+                counts[group] = counts.get(group, 0) + count
+                best.setdefault(group, []).extend(hits)
+        for group, hits in best.items():
+            best[group] = heapq.nsmallest(per_group, hits, key=lambda hit: (-hit[0], hit[1]))
+        top = heapq.nsmallest(groups, best, key=lambda g: (-best[g][0][0], best[g][0][1]))
+        return [(group, counts[group], best[group]) for group in top]
+
+    def estimate_total(self, query, filters: dict = None, budget: int = 50000, key_sets: dict = None) -> tuple:
+        """Sum of the shards' estimates; exact only if every shard counted exactly."""
+        q = query if isinstance(query, Query) else parse(query)
+        names = self.shard_names()
+        if not names:
+            return 0, "eq"
+        # The sampling budget is shared out so a query costs the same however many shards there are
+        kwargs = {"filters": filters, "budget": max(1, budget // len(names)), "key_sets": key_sets}
+        estimates = self._fan_out("estimate_total", q, kwargs)
+        relation = "eq" if all(rel == "eq" for _, rel in estimates) else "estimate"
+        return sum(value for value, _ in estimates), relation
+
+    def stats(self) -> dict:
+        shards = {name: self.shard(name).stats() for name in self.shard_names()}
+        totals = self.corpus(Query(None, None), list(shards))
+        return {
+            "docs": totals["docs"],
+            "avg_length": (totals["length"] / totals["stored"]) if totals["stored"] else 0.0,
+            "segments": sum(s["segments"] for s in shards.values()),
+            "shards": {name: s["docs"] for name, s in shards.items()},
+        }
+
+    def close(self):
+        """Flush every shard's buffered pages and stop the worker pool."""
+        with self._mutex:
+            for index in self._shards.values():
+                index.close()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
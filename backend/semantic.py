@@ -0,0 +1,427 @@
+"""
+Semantic Search
+Offline page embeddings for the paraphrase-level matches keyword search misses.
+No network or GPU: pages become TF-IDF vectors that a truncated SVD (LSA)
+projects down to SEMANTIC_DIMS dimensions.
+
+The model (vocabulary, IDF weights, projection) is fitted once on a sample by
+scripts/build_semantic_index.py and then frozen, so ingesters embed only the
+pages they add. Vectors live in a memory-mapped float16 matrix with an IVF
+index (k-means centroids, one inverted list per centroid) on top, and queries
+only score the lists nearest to them.
+"""
+import os
+import re
+import json
+import time
+import math
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Iterable, Tuple
+
+try:
+    import numpy as np
+    from scipy import sparse
+    from scipy.sparse.linalg import svds
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+DIMS = int(os.getenv("SEMANTIC_DIMS", "128"))
+MAX_FEATURES = int(os.getenv("SEMANTIC_MAX_FEATURES", "50000"))
+# Inverted lists scanned per query
+NPROBE = int(os.getenv("SEMANTIC_NPROBE", "8"))
+# Below this many vectors a full scan beats the IVF lists
+BRUTE_FORCE_ROWS = int(os.getenv("SEMANTIC_BRUTE_FORCE_ROWS", "20000"))
+# Rows added since the lists were last sorted are scanned directly up to this size
+TAIL_ROWS = 50000
+# Only the start of very long pages (full dataset imports) is embedded
+MAX_TEXT_CHARS = 20000
+SCAN_CHUNK = 65536
+
+TOKEN_RE = re.compile(r"[a-z][a-z0-9']+")
+STOPWORDS = frozenset("""
+a an and are as at be been but by for from had has have he her his i if in into is it its
+me my no not of on or our she so than that the their them then there these they this to
+was we were what when which who will with would you your
+""".split())
+
+
+def available() -> bool:
+    return np is not None
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall((text or "")[:MAX_TEXT_CHARS].lower()) if t not in STOPWORDS]
+
+
+class EmbeddingModel:
+    """Frozen TF-IDF vocabulary and LSA projection."""
+
+    def __init__(self, vocab: dict, idf, components):
+        self.vocab = vocab
+        self.idf = idf
+        self.components = components
+        self.dims = components.shape[0]
+
+    @classmethod
+    def fit(cls, texts: List[str], dims: int = DIMS, max_features: int = MAX_FEATURES, min_df: int = 2):
+        tokenized = [tokenize(t) for t in texts]
+        n = len(tokenized)
+        df = Counter()
+        for tokens in tokenized:
+            df.update(set(tokens))
+        # Terms on nearly every page carry no topic signal
+        keep = [t for t, c in df.items() if min(min_df, n) <= c <= max(1, int(n * 0.95))]
+        keep = sorted(keep, key=lambda t: (-df[t], t))[:max_features]
+        vocab = {t: i for i, t in enumerate(sorted(keep))}
+        idf = np.array([math.log((1 + n) / (1 + df[t])) + 1 for t in sorted(keep)], dtype=np.float32)
+
+        model = cls(vocab, idf, np.zeros((0, len(vocab)), dtype=np.float32))
+        matrix = model._tfidf(tokenized)
+        k = min(dims, min(matrix.shape) - 1)
+        if k >= 1 and matrix.nnz:
+            _, s, vt = svds(matrix.astype(np.float64), k=k)
+            components = vt[np.argsort(-s)].astype(np.float32)
+        else:
+            components = np.zeros((0, len(vocab)), dtype=np.float32)
+        if components.shape[0] < dims:
+            # Tiny corpora can't support `dims` singular vectors; pad with random projections
+            rng = np.random.default_rng(0)
+            extra = rng.standard_normal((dims - components.shape[0], len(vocab))).astype(np.float32)
+            extra /= np.sqrt(max(len(vocab), 1))
+            components = np.vstack([components, extra])
+        model.components = components
+        model.dims = dims
+        return model
+
+    def _tfidf(self, tokenized: List[List[str]]):
+        rows, cols, vals = [], [], []
+        for row, tokens in enumerate(tokenized):
+            counts = Counter(self.vocab[t] for t in tokens if t in self.vocab)
+            for col, tf in counts.items():
+                rows.append(row)
+                cols.append(col)
+                vals.append((1.0 + math.log(tf)) * self.idf[col])
+        matrix = sparse.csr_matrix((vals, (rows, cols)), shape=(len(tokenized), len(self.vocab)), dtype=np.float32)
+        norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A.ravel()
+        norms[norms == 0] = 1.0
+        return sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+    def transform(self, texts: List[str]):
+        """Unit-length embeddings, one row per text (all zeros if no known term)."""
+        matrix = self._tfidf([tokenize(t) for t in texts])
+        vectors = np.asarray(matrix @ self.components.T, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def save(self, path: str):
+        terms = np.array(sorted(self.vocab, key=self.vocab.get))
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, terms=terms, idf=self.idf, components=self.components.astype(np.float16))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            vocab = {t: i for i, t in enumerate(data["terms"].tolist())}
+            return cls(vocab, data["idf"], data["components"].astype(np.float32))
+
+
+class SemanticIndex:
+    """
+    Append-only float16 vector store keyed by page id, with IVF lists.
+
+    Files in `root`: model.npz, vectors.f16 (capacity x dims), ids.i64 (page id
+    per row, -1 once replaced or deleted), lists.i32 (IVF list per row),
+    centroids.npy, and state.json with the row count. Writers hold a file lock;
+    readers reopen the maps when state.json changes.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._mutex = threading.RLock()
+        self._model = None
+        self._state = None
+        self._state_mtime = None
+        self._vectors = self._ids = self._lists = self._centroids = None
+        # IVF layout for rows [0, _sorted_rows): row numbers grouped by list
+        self._order = self._bounds = None
+        self._sorted_rows = 0
+        # Page id -> row for rows [0, _mapped_rows): (sorted page ids, their rows)
+        self._id_rows = None
+        self._mapped_rows = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def exists(self) -> bool:
+        return available() and os.path.exists(self._path("state.json"))
+
+    @contextmanager
+    def _write_lock(self):
+        with self._mutex:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._path("write.lock"), "a+") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _write_state(self, state: dict):
+        tmp = self._path("state.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self._path("state.json"))
+
+    def create(self, model: EmbeddingModel):
+        """Start an empty index around a fitted model."""
+        os.makedirs(self.root, exist_ok=True)
+        with self._write_lock():
+            model.save(self._path("model.npz"))
+            for name in ("vectors.f16", "ids.i64", "lists.i32", "centroids.npy"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self._write_state({
+                "model_id": f"{os.getpid()}-{time.time_ns()}",
+                "count": 0, "capacity": 0, "dims": model.dims, "nlist": 0,
+            })
+        self._state_mtime = None
+        self.refresh()
+
+    # -- reading --------------------------------------------------------------
+
+    def refresh(self):
+        """Reopen the maps if another process appended rows or retrained the lists."""
+        if not self.exists():
+            return
+        mtime = os.stat(self._path("state.json")).st_mtime_ns
+        with self._mutex:
+            if mtime == self._state_mtime:
+                return
+            with open(self._path("state.json"), "r", encoding="utf-8") as f:
+                state = json.load(f)
+            previous = self._state or {}
+            new_model = self._model is None or state.get("model_id") != previous.get("model_id")
+            if new_model:
+                self._model = EmbeddingModel.load(self._path("model.npz"))
+            capacity, dims = state["capacity"], state["dims"]
+            if capacity:
+                self._vectors = np.memmap(self._path("vectors.f16"), dtype=np.float16, mode="r", shape=(capacity, dims))
+                self._ids = np.memmap(self._path("ids.i64"), dtype=np.int64, mode="r", shape=(capacity,))
+                self._lists = np.memmap(self._path("lists.i32"), dtype=np.int32, mode="r", shape=(capacity,))
+            else:
+                self._vectors = self._ids = self._lists = None
+            retrained = new_model or state.get("trained_at") != previous.get("trained_at")
+            if state.get("nlist"):
+                self._centroids = np.load(self._path("centroids.npy"))
+            else:
+                self._centroids = None
+            self._state = state
+            self._state_mtime = mtime
+            if new_model or state["count"] - self._mapped_rows > TAIL_ROWS or state["count"] < self._mapped_rows:
+                self._map_ids()
+            if retrained or state["count"] - self._sorted_rows > TAIL_ROWS or state["count"] < self._sorted_rows:
+                self._sort_lists()
+
+    def _sort_lists(self):
+        count = self._state["count"]
+        if self._centroids is None or not count:
+            self._order = self._bounds = None
+            self._sorted_rows = 0
+            return
+        lists = np.asarray(self._lists[:count])
+        self._order = np.argsort(lists, kind="stable").astype(np.int64)
+        self._bounds = np.searchsorted(lists[self._order], np.arange(len(self._centroids) + 1))
+        self._sorted_rows = count
+
+    def _map_ids(self):
+        count = self._state["count"]
+        ids = np.asarray(self._ids[:count]) if count else np.empty(0, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        self._id_rows = (ids[order], order.astype(np.int64))
+        self._mapped_rows = count
+
+    def _row(self, page_id: int):
+        """Row holding the live vector of page_id, or None."""
+        count = self._state["count"]
+        tail = np.nonzero(np.asarray(self._ids[self._mapped_rows:count]) == page_id)[0]
+        if len(tail):
+            return self._mapped_rows + int(tail[-1])
+        sorted_ids, rows = self._id_rows
+        lo, hi = np.searchsorted(sorted_ids, page_id, "left"), np.searchsorted(sorted_ids, page_id, "right")
+        # Replaced rows are -1 now, so at most one of the mapped rows is still live
+        for row in rows[lo:hi]:
+            if self._ids[row] == page_id:
+                return int(row)
+        return None
+
+    def count(self) -> int:
+        self.refresh()
+        return self._state["count"] if self._state else 0
+
+    def version(self) -> str:
+        self.refresh()
+        return str(self._state_mtime or "")
+
+    def search(self, query: str, limit: int = 10, nprobe: int = NPROBE) -> List[Tuple[int, float]]:
+        """[(page_id, cosine similarity)], most similar first."""
+        self.refresh()
+        with self._mutex:
+            if not self._state or not self._state["count"]:
+                return []
+            return self._nearest(self._model.transform([query])[0], limit, nprobe)
+
+    def similar(self, page_id: int, limit: int = 10, nprobe: int = NPROBE) -> List[Tuple[int, float]]:
+        """
+        [(page_id, cosine similarity)] of the pages nearest to an indexed page,
+        most similar first, from its stored vector. Empty if it isn't indexed.
+        """
+        self.refresh()
+        with self._mutex:
+            if not self._state or not self._state["count"]:
+                return []
+            row = self._row(page_id)
+            if row is None:
+                return []
+            q = np.asarray(self._vectors[row], dtype=np.float32)
+            nearest = self._nearest(q, limit + 1, nprobe)
+        return [(pid, score) for pid, score in nearest if pid != page_id][:limit]
+
+    def _nearest(self, q, limit: int, nprobe: int) -> List[Tuple[int, float]]:
+        # Caller holds the mutex
+        if not q.any():
+            return []
+        count = self._state["count"]
+
+        if self._centroids is None or count <= BRUTE_FORCE_ROWS:
+            rows = None
+        else:
+            nearest = np.argsort(-(self._centroids @ q))[:nprobe]
+            parts = [self._order[self._bounds[c]:self._bounds[c + 1]] for c in nearest]
+            parts.append(np.arange(self._sorted_rows, count))
+            rows = np.sort(np.concatenate(parts))
+
+        ids_out, scores_out = [], []
+        if rows is None:
+            for start in range(0, count, SCAN_CHUNK):
+                stop = min(count, start + SCAN_CHUNK)
+                scores_out.append(np.asarray(self._vectors[start:stop], dtype=np.float32) @ q)
+                ids_out.append(np.asarray(self._ids[start:stop]))
+        else:
+            for start in range(0, len(rows), SCAN_CHUNK):
+                chunk = rows[start:start + SCAN_CHUNK]
+                scores_out.append(np.asarray(self._vectors[chunk], dtype=np.float32) @ q)
+                ids_out.append(np.asarray(self._ids[chunk]))
+        scores = np.concatenate(scores_out)
+        ids = np.concatenate(ids_out)
+
+        live = ids >= 0
+        scores, ids = scores[live], ids[live]
+        if not len(ids):
+            return []
+        k = min(limit, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((ids[top], -scores[top]))]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    # -- writing --------------------------------------------------------------
+
+    def _open_for_write(self, state: dict, needed: int):
+        """Writable maps with room for `needed` rows, growing the files by doubling."""
+        dims = state["dims"]
+        capacity = state["capacity"]
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            for name, itemsize in (("vectors.f16", 2 * dims), ("ids.i64", 8), ("lists.i32", 4)):
+                with open(self._path(name), "ab") as f:
+                    f.truncate(capacity * itemsize)
+            state["capacity"] = capacity
+        vectors = np.memmap(self._path("vectors.f16"), dtype=np.float16, mode="r+", shape=(capacity, dims))
+        ids = np.memmap(self._path("ids.i64"), dtype=np.int64, mode="r+", shape=(capacity,))
+        lists = np.memmap(self._path("lists.i32"), dtype=np.int32, mode="r+", shape=(capacity,))
+        return vectors, ids, lists
+
+    def add(self, pages: List[Tuple[int, str]]):
+        """Embed and append (page_id, text) pairs; earlier rows for the same pages are retired."""
+        if not pages or not self.exists():
+            return
+        with self._write_lock():
+            self.refresh()
+            state = dict(self._state)
+            embedded = self._model.transform([text for _, text in pages]).astype(np.float16)
+            page_ids = np.array([pid for pid, _ in pages], dtype=np.int64)
+            count = state["count"]
+
+            vectors, ids, lists = self._open_for_write(state, count + len(pages))
+            if count:
+                ids[:count][np.isin(ids[:count], page_ids)] = -1
+            vectors[count:count + len(pages)] = embedded
+            ids[count:count + len(pages)] = page_ids
+            if self._centroids is not None:
+                lists[count:count + len(pages)] = np.argmax(embedded.astype(np.float32) @ self._centroids.T, axis=1)
+            for m in (vectors, ids, lists):
+                m.flush()
+            state["count"] = count + len(pages)
+            self._write_state(state)
+
+    def delete(self, page_ids: Iterable[int]):
+        page_ids = np.array(list(page_ids), dtype=np.int64)
+        if not len(page_ids) or not self.exists():
+            return
+        with self._write_lock():
+            self.refresh()
+            state = dict(self._state)
+            if not state["count"]:
+                return
+            _, ids, _ = self._open_for_write(state, state["count"])
+            hit = np.isin(ids[:state["count"]], page_ids)
+            if hit.any():
+                ids[:state["count"]][hit] = -1
+                ids.flush()
+                self._write_state(state)
+
+    def train(self, nlist: int = None, sample: int = 50000, iterations: int = 10):
+        """Fit IVF centroids with spherical k-means on a sample and reassign every row."""
+        with self._write_lock():
+            self.refresh()
+            state = dict(self._state)
+            count = state["count"]
+            if not count:
+                return
+            nlist = nlist or int(min(4096, max(16, 4 * math.sqrt(count))))
+            nlist = min(nlist, count)
+            vectors, ids, lists = self._open_for_write(state, count)
+
+            rng = np.random.default_rng(0)
+            picks = np.sort(rng.choice(count, size=min(sample, count), replace=False))
+            data = np.asarray(vectors[picks], dtype=np.float32)
+            centroids = data[rng.choice(len(data), size=nlist, replace=False)]
+            for _ in range(iterations):
+                assign = np.argmax(data @ centroids.T, axis=1)
+                for c in range(nlist):
+                    members = data[assign == c]
+                    if len(members):
+                        centroids[c] = members.sum(axis=0)
+                norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                centroids /= norms
+
+            for start in range(0, count, SCAN_CHUNK):
+                stop = min(count, start + SCAN_CHUNK)
+                lists[start:stop] = np.argmax(np.asarray(vectors[start:stop], dtype=np.float32) @ centroids.T, axis=1)
+            lists.flush()
+            np.save(self._path("centroids.tmp.npy"), centroids)
+            os.replace(self._path("centroids.tmp.npy"), self._path("centroids.npy"))
+            state["nlist"] = nlist
+            state["trained_at"] = time.time()
+            self._write_state(state)
@@ -0,0 +1,109 @@
+"""
+Suggestions
+Similarity-ranked completions for /api/suggestions over entity names and
+document filenames, tolerant of misspellings and OCR damage.
+
+Postgres ranks with pg_trgm's word_similarity through its GIN indexes. SQLite
+pulls candidates from the suggest_trgm FTS5 trigram table and re-ranks them with
+the same trigram measure in Python. Either way only indexed rows are touched.
+"""
+import os
+import re
+from typing import List
+from sqlalchemy import text, select, func, literal, union_all
+from sqlalchemy.orm import Session
+from models import Entity, Document
+from search_schema import trigrams_available, SUGGEST_TRGM_TABLE
+
+# Matches the default feel of pg_trgm: a transposed letter in a 7-letter name still passes
+MIN_SIMILARITY = float(os.getenv("SUGGEST_MIN_SIMILARITY", "0.4"))
+# Trigram hits pulled from SQLite before exact re-ranking
+SQLITE_CANDIDATES = 200
+
+
+def trigrams(value: str) -> set:
+    """pg_trgm trigrams: each lowercased word padded with two spaces in front and one behind."""
+    out = set()
+    for word in re.findall(r"[^\W_]+", (value or "").lower()):
+        padded = f"  {word} "
+        out.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return out
+
+
+def similarity(query: str, label: str) -> float:
+    """
+    Share of the query's trigrams found in label: pg_trgm's word_similarity
+    without the contiguous-extent refinement, so a typed prefix of a long name
+    still scores high.
+    """
+    q = trigrams(query)
+    if not q:
+        return 0.0
+    return len(q & trigrams(label)) / len(q)
+
+
+def suggest(db: Session, query: str, limit: int = 8) -> List[dict]:
+    """Best matching labels as [{"text", "kind", "score"}], highest score first."""
+    query = (query or "").strip()
+    if len(query) < 2:
+        return []
+
+    dialect = db.bind.dialect.name
+    if dialect == "postgresql" and trigrams_available(db.bind):
+        rows = _suggest_postgres(db, query, limit * 2)
+    elif dialect == "sqlite" and trigrams_available(db.bind) and len(query) >= 3:
+        rows = _suggest_sqlite(db, query)
+    else:
+        rows = _suggest_like(db, query, limit * 2)
+
+    best = {}
+    for label, kind, score in rows:
+        if label and (label not in best or score > best[label]["score"]):
+            best[label] = {"text": label, "kind": kind, "score": round(float(score), 4)}
+    ranked = sorted(best.values(), key=lambda s: (-s["score"], len(s["text"]), s["text"]))
+    return ranked[:limit]
+
+
+def _suggest_postgres(db: Session, query: str, limit: int) -> list:
+    # <% and ILIKE are both answered by the gin_trgm_ops indexes
+    db.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :t, true)"), {"t": str(MIN_SIMILARITY)})
+    pattern = f"%{query}%"
+    parts = []
+    for column, kind in ((Entity.name, "entity"), (Document.filename, "document")):
+        score = func.word_similarity(query, column)
+        parts.append(
+            select(column.label("label"), literal(kind).label("kind"), score.label("score"))
+            .where(column.op("%>")(query) | column.ilike(pattern))
+            .order_by(score.desc())
+            .limit(limit)
+        )
+    combined = union_all(*parts).subquery()
+    stmt = select(combined.c.label, combined.c.kind, combined.c.score).order_by(combined.c.score.desc()).limit(limit)
+    return [tuple(r) for r in db.execute(stmt)]
+
+
+def _suggest_sqlite(db: Session, query: str) -> list:
+    # The trigram tokenizer reads quoted three-character strings as single trigrams
+    lowered = query.lower()
+    grams = {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+    match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+    rows = db.execute(
+        text(f"SELECT label, kind FROM {SUGGEST_TRGM_TABLE} WHERE {SUGGEST_TRGM_TABLE} MATCH :match "
+             "ORDER BY rank LIMIT :n"),
+        {"match": match, "n": SQLITE_CANDIDATES}
+    ).all()
+    scored = []
+    for label, kind in rows:
+        score = 1.0 if lowered in label.lower() else similarity(query, label)
+        if score >= MIN_SIMILARITY:
+            scored.append((label, kind, score))
+    return scored
+
+
+def _suggest_like(db: Session, query: str, limit: int) -> list:
+    # No trigram index: substring scans, as before
+    pattern = f"%{query}%"
+    docs = db.query(Document.filename).filter(Document.filename.ilike(pattern)).limit(limit).all()
+    entities = db.query(Entity.name).filter(Entity.name.ilike(pattern)).limit(limit).all()
+    return [(d.filename, "document", similarity(query, d.filename)) for d in docs] + \
+           [(e.name, "entity", similarity(query, e.name)) for e in entities]
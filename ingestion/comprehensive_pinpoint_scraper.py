@@ -15,6 +15,7 @@ sys.path.append(str(Path(__file__).parent.parent / "backend"))
 
 from sqlalchemy.orm import Session
 from models import Document, Page, Entity, PageEntity, Relationship
+from pii import mask_pii
 from database import SessionLocal
 
 class ComprehensivePinpointScraper:
@@ -327,7 +328,7 @@ class ComprehensivePinpointScraper:
         page = Page(
             document_id=document.id,
             page_num=1,
-            text_content=context_text,
+            text_content=mask_pii(context_text),
             text_quality=0.5,
             media_type='pinpoint_reference'
         )
@@ -11,6 +11,7 @@ sys.path.append(str(Path(__file__).parent.parent / "backend"))
 
 from sqlalchemy.orm import Session
 from models import Document, Page
+from pii import mask_pii
 from database import SessionLocal
 
 class DocumentCloudFetcher:
@@ -146,7 +147,7 @@ class DocumentCloudFetcher:
                     page = Page(
                         document_id=document.id,
                         page_num=page_data['page_num'],
-                        text_content=page_data['text'],
+                        text_content=mask_pii(page_data['text']),
                         text_quality=page_data['quality'],
                         media_type='document_page'
                     )
@@ -13,6 +13,7 @@ sys.path.append(str(Path(__file__).parent.parent / "backend"))
 
 from sqlalchemy.orm import Session
 from models import Document, Page, FlightLog, Entity
+from pii import mask_pii
 from database import SessionLocal
 
 class JMailScraper:
@@ -184,7 +185,7 @@ class JMailScraper:
                         page = Page(
                             document_id=document.id,
                             page_num=1,
-                            text_content=content_resp.text[:10000],  # Limit size
+                            text_content=mask_pii(content_resp.text)[:10000],  # Limit size
                             text_quality=0.7,
                             media_type='web_document'
                         )
@@ -1,18 +1,85 @@
 import os
 import fitz  # PyMuPDF
 import sys
+import time
+import argparse
+import multiprocessing
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from sqlalchemy.orm import Session
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'backend'))
 from database import SessionLocal, init_db
 from models import Document, Page, Entity, PageEntity, CountryStats, PersonCountryCoMention
-from processor import mask_pii, extract_entities, get_text_quality
+from processor import extract_entities_batch, get_text_quality, get_nlp
+from pii import masker, mask_counts
 from normalization import normalize_country
+from entity_cache import EntityCache
+from bulk_load import BulkLoader
+import search
+
+# Pages that nearly duplicate an already indexed page are reported; set this to leave them out
+SKIP_DUPLICATE_PAGES = os.getenv("SKIP_DUPLICATE_PAGES", "").lower() in ("1", "true", "yes")
 
 DATA_DIR = Path(__file__).parent.parent / "data" / "files"
 ZIPS_DIR = Path(__file__).parent.parent / "data" / "zips"
+# Entity IDs by (normalized name, type); new places get a country code
+entity_cache = EntityCache(lambda name, ent_type: normalize_country(name) if ent_type in ("GPE", "LOC") else None)
+# --workers splits large PDFs into ranges of this many pages
+PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "25"))
+
+class StageTimer:
+    """Seconds spent in each ingestion stage, summed over workers, pages written and PII masked."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.pages = 0
+        self.masked = Counter()
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
 
-def process_pdf(file_path: Path, db: Session):
+    def add(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def report(self):
+        if not self.pages:
+            return
+        print(f"✅ {self.pages} pages in {time.time() - self.started:.1f}s")
+        for name, seconds in self.seconds.items():
+            print(f"  {name}: {self.pages / max(seconds, 1e-9):.0f} pages/sec per process")
+        print(f"  masked: {mask_counts(self.masked)}")
+
+def extract_pages(file_path: Path, start: int = 0, stop: int = None) -> tuple:
+    """
+    Extract, mask and NER pages [start, stop) of a PDF; runs in pool workers.
+    Returns compact (page_num, masked_text, quality, entities) tuples, the
+    seconds spent per stage and the masked PII counts.
+    """
+    timer = StageTimer()
+    with timer.stage("extract"):
+        with fitz.open(file_path) as pdf_doc:
+            stop = len(pdf_doc) if stop is None else min(stop, len(pdf_doc))
+            texts = [pdf_doc.load_page(page_num).get_text() for page_num in range(start, stop)]
+    # Mask PII for storage and search; NER sees the original text
+    with timer.stage("mask"):
+        masked = [(masker.mask(text, timer.masked)[0], get_text_quality(text)) for text in texts]
+    with timer.stage("ner"):
+        entities = extract_entities_batch(texts)
+    pages = [
+        (start + i + 1, masked_text, quality, entities[i])
+        for i, (masked_text, quality) in enumerate(masked)
+    ]
+    return pages, timer.seconds, timer.masked
+
+def start_document(db: Session, file_path: Path) -> Document:
     print(f"Processing PDF: {file_path.name}")
     doc = Document(
         filename=file_path.name,
@@ -21,65 +88,156 @@ def process_pdf(file_path: Path, db: Session):
     )
     db.add(doc)
     db.flush() # Get doc.id
-    
-    pdf_doc = fitz.open(file_path)
-    for page_num in range(len(pdf_doc)):
-        page = pdf_doc.load_page(page_num)
-        text = page.get_text()
-        
-        # Mask PII for storage and search
-        masked_text = mask_pii(text)
-        quality = get_text_quality(text)
+    return doc
+
+def write_pages(db: Session, doc: Document, pages: list, bulk: bool = False):
+    rows, page_entities = [], []
+    for page_num, masked_text, quality, entities in pages:
+        duplicates = search.duplicate_pages(masked_text, limit=1)
+        if duplicates:
+            original, similarity = duplicates[0]
+            print(f"  Page {page_num} nearly duplicates page {original} ({similarity:.0%})")
+            if SKIP_DUPLICATE_PAGES:
+                continue
         
-        db_page = Page(
+        rows.append(dict(
             document_id=doc.id,
-            page_num=page_num + 1,
+            page_num=page_num,
             text_content=masked_text,
             text_quality=quality,
             media_type="page_image"
-        )
-        db.add(db_page)
-        db.flush()
-        
-        # Extract and save entities
-        entities = extract_entities(text)
-        process_entities(db, db_page, entities)
-        
-    db.commit()
-
-def process_entities(db: Session, page: Page, entities_dict: dict):
-    for ent_type, names in entities_dict.items():
-        for name in names:
-            # Upsert Entity
-            db_entity = db.query(Entity).filter_by(name=name, type=ent_type).first()
-            if not db_entity:
-                db_entity = Entity(name=name, type=ent_type)
-                if ent_type in ["GPE", "LOC"]:
-                    db_entity.country_code = normalize_country(name)
-                db.add(db_entity)
-                db.flush()
-            
-            # Save link
-            pe = PageEntity(page_id=page.id, entity_id=db_entity.id)
-            db.add(pe)
-            
-            # Update Country/Co-mention stats
-            if db_entity.country_code:
-                update_country_stats(db, db_entity.country_code)
-                # Link person entities in the same page to this country
-                # (This is handled in a separate aggregation step usually, 
-                # but we can do simple increments here)
-
-def update_country_stats(db: Session, country_code: str):
+        ))
+        page_entities.append(entities)
+    if not rows:
+        return
+
+    if bulk:
+        with BulkLoader(db) as loader:
+            page_ids = loader.add_pages(rows)
+            process_entities(db, list(zip(page_ids, page_entities)), loader)
+        return
+    db_pages = [Page(**row) for row in rows]
+    db.add_all(db_pages)
+    db.flush()
+    
+    # Save extracted entities
+    process_entities(db, [(db_page.id, entities) for db_page, entities in zip(db_pages, page_entities)])
+
+def _write_range(db: Session, doc: Document, extracted: tuple, timer: StageTimer, bulk: bool = False):
+    pages, seconds, masked = extracted
+    for name, spent in seconds.items():
+        timer.add(name, spent)
+    timer.masked.update(masked)
+    with timer.stage("write"):
+        write_pages(db, doc, pages, bulk)
+    timer.pages += len(pages)
+
+def process_pdf(file_path: Path, db: Session, timer: StageTimer = None, bulk: bool = False):
+    timer = timer or StageTimer()
+    doc = start_document(db, file_path)
+    _write_range(db, doc, extract_pages(file_path), timer, bulk)
+    with timer.stage("write"):
+        db.commit()
+
+def process_pdfs_parallel(file_paths: list, db: Session, workers: int, pages_per_task: int = PAGES_PER_TASK,
+                          timer: StageTimer = None, bulk: bool = False):
+    """
+    Extract PDFs in a pool of worker processes, split into page ranges, while
+    this process stays the only DB writer. Documents are written in order as
+    their ranges come back; only a bounded number of ranges is in flight.
+    """
+    tasks = []
+    for file_path in file_paths:
+        try:
+            with fitz.open(file_path) as pdf_doc:
+                page_count = len(pdf_doc)
+        except Exception as e:
+            print(f"Skipping {file_path.name}: {e}")
+            continue
+        ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+        tasks.append((file_path, ranges or [(0, 0)]))
+
+    timer = timer or StageTimer()
+    queue = deque((file_path, start, stop) for file_path, ranges in tasks for start, stop in ranges)
+    in_flight = deque()
+    # Forked workers share the already loaded spaCy model copy-on-write. They
+    # only open their own PDFs and never touch this process's DB session.
+    get_nlp()
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        def fill():
+            while queue and len(in_flight) < workers * 4:
+                file_path, start, stop = queue.popleft()
+                in_flight.append(pool.submit(extract_pages, file_path, start, stop))
+
+        for file_path, ranges in tasks:
+            doc = start_document(db, file_path)
+            remaining = len(ranges)
+            try:
+                while remaining:
+                    fill()
+                    remaining -= 1
+                    _write_range(db, doc, in_flight.popleft().result(), timer, bulk)
+                with timer.stage("write"):
+                    db.commit()
+            except Exception as e:
+                print(f"Failed to ingest {file_path.name}: {e}")
+                db.rollback()
+                # Drop the document's remaining ranges
+                for _ in range(remaining):
+                    fill()
+                    in_flight.popleft().cancel()
+
+def process_entities(db: Session, pages: list, loader: BulkLoader = None):
+    """Link a batch of (page id, {type: [names]}) to their entities, creating the new ones in one insert."""
+    resolved = entity_cache.resolve(db, [
+        (name, ent_type) for _, entities_dict in pages
+        for ent_type, names in entities_dict.items() for name in names
+    ])
+    links = set()
+    country_pages = Counter()
+    for page_id, entities_dict in pages:
+        for ent_type, names in entities_dict.items():
+            for name in names:
+                if (name, ent_type) not in resolved:
+                    continue
+                entity_id, country_code = resolved[(name, ent_type)]
+                if (page_id, entity_id) in links:
+                    continue
+                links.add((page_id, entity_id))
+                
+                # Update Country/Co-mention stats
+                if country_code:
+                    country_pages[country_code] += 1
+                    # Link person entities in the same page to this country
+                    # (This is handled in a separate aggregation step usually, 
+                    # but we can do simple increments here)
+    
+    # Save links
+    if loader:
+        loader.add_page_entities([{"page_id": page_id, "entity_id": entity_id} for page_id, entity_id in sorted(links)])
+    else:
+        db.add_all([PageEntity(page_id=page_id, entity_id=entity_id) for page_id, entity_id in sorted(links)])
+    for country_code, count in country_pages.items():
+        update_country_stats(db, country_code, count)
+
+def update_country_stats(db: Session, country_code: str, pages: int = 1):
     stats = db.query(CountryStats).filter_by(country_code=country_code).first()
     if not stats:
-        stats = CountryStats(country_code=country_code, doc_count=1, page_count=1)
+        stats = CountryStats(country_code=country_code, doc_count=1, page_count=pages)
         db.add(stats)
     else:
-        stats.page_count += 1
+        stats.page_count += pages
         # doc_count logic would need tracking docs per country
 
 def main():
+    parser = argparse.ArgumentParser(description='Ingest PDFs from data/files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Extraction worker processes (default: extract in this process)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Write pages and entity links with COPY / executemany instead of ORM objects')
+    args = parser.parse_args()
+
     init_db()
     db = SessionLocal()
     
@@ -88,11 +246,18 @@ def main():
         print(f"Data directory {DATA_DIR} not found.")
         return
 
-    for file_path in DATA_DIR.glob("*.pdf"):
-        # Check if already processed
-        exists = db.query(Document).filter_by(filename=file_path.name).first()
-        if not exists:
-            process_pdf(file_path, db)
+    # Check if already processed
+    pending = [
+        file_path for file_path in DATA_DIR.glob("*.pdf")
+        if not db.query(Document).filter_by(filename=file_path.name).first()
+    ]
+    timer = StageTimer()
+    if args.workers > 1:
+        process_pdfs_parallel(pending, db, args.workers, timer=timer, bulk=args.bulk)
+    else:
+        for file_path in pending:
+            process_pdf(file_path, db, timer, args.bulk)
+    timer.report()
             
     db.close()
 
@@ -11,6 +11,7 @@ sys.path.append(str(Path(__file__).parent.parent / "backend"))
 
 from sqlalchemy.orm import Session
 from models import Document, Page
+from pii import mask_pii
 from database import SessionLocal
 
 class PinpointFetcher:
@@ -135,7 +136,7 @@ class PinpointFetcher:
                             page = Page(
                                 document_id=document.id,
                                 page_num=1,
-                                text_content=text,
+                                text_content=mask_pii(text),
                                 text_quality=0.9,
                                 media_type='text_doc'
                             )
@@ -151,7 +152,7 @@ class PinpointFetcher:
                                     page = Page(
                                         document_id=document.id,
                                         page_num=page_num,
-                                        text_content=text,
+                                        text_content=mask_pii(text),
                                         text_quality=0.7,
                                         media_type='pdf_page'
                                     )
@@ -1,50 +1,61 @@
-import re
-import spacy
+import os
 from typing import List, Tuple, Dict
 
-# Load spaCy model
+# PII masking lives in backend/pii.py, shared with the scrapers and importers
 try:
-    nlp = spacy.load("en_core_web_md")
-except:
-    # Fallback if model not loaded/installed yet
-    print("Warning: spaCy model 'en_core_web_md' not found. NER will be limited.")
-    nlp = None
-
-# PII RegEx patterns
-EMAIL_PATTERN = r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
-PHONE_PATTERN = r'(\+?\d{1,3}[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}'
-ADDRESS_PATTERN = r'\d{1,5}\s\w.\s(\w\s?){1,3}\s(Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr)'
-
-def mask_pii(text: str) -> str:
-    """Masks emails, phones, and basic addresses in text."""
-    text = re.sub(EMAIL_PATTERN, "[EMAIL]", text)
-    text = re.sub(PHONE_PATTERN, "[PHONE]", text)
-    # Simple address masking - can be more aggressive if needed
-    text = re.sub(ADDRESS_PATTERN, "[ADDRESS]", text)
-    return text
+    from backend.pii import mask_pii
+except ImportError:
+    from pii import mask_pii
+
+NER_MODEL = os.getenv("NER_MODEL", "en_core_web_md")
+# Texts per nlp.pipe batch; larger batches amortize the model calls but hold more docs in memory
+NER_BATCH_SIZE = int(os.getenv("NER_BATCH_SIZE", "64"))
+# spaCy worker processes per pipe call (1 tags in this process)
+NER_PROCESSES = int(os.getenv("NER_PROCESSES", "1"))
+# Only tok2vec and ner are needed for entities
+NER_DISABLE = ["tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+NER_LABELS = ("PERSON", "ORG", "GPE", "LOC")
+
+_nlp = None
+_nlp_loaded = False
+
+def get_nlp():
+    """
+    The spaCy pipeline, loaded on first use. Load it before forking workers
+    and they share the model copy-on-write instead of loading it again.
+    """
+    global _nlp, _nlp_loaded
+    if not _nlp_loaded:
+        _nlp_loaded = True
+        try:
+            import spacy
+            _nlp = spacy.load(NER_MODEL, exclude=NER_DISABLE)
+        except Exception:
+            # Fallback if model not loaded/installed yet
+            print(f"Warning: spaCy model '{NER_MODEL}' not found. NER will be limited.")
+            _nlp = None
+    return _nlp
 
 def extract_entities(text: str) -> Dict[str, List[str]]:
     """Extracts PERSON, ORG, GPE, and LOC from text using spaCy."""
+    return extract_entities_batch([text])[0]
+
+def extract_entities_batch(texts: List[str], batch_size: int = NER_BATCH_SIZE,
+                           n_process: int = NER_PROCESSES) -> List[Dict[str, List[str]]]:
+    """extract_entities for many texts in one nlp.pipe pass."""
+    nlp = get_nlp()
     if not nlp:
-        return {"PERSON": [], "ORG": [], "GPE": [], "LOC": []}
-    
-    doc = nlp(text)
-    entities = {
-        "PERSON": [],
-        "ORG": [],
-        "GPE": [],
-        "LOC": []
-    }
-    
-    for ent in doc.ents:
-        if ent.label_ in entities:
-            entities[ent.label_].append(ent.text.strip())
-            
-    # Deduplicate
-    for label in entities:
-        entities[label] = list(set(entities[label]))
-        
-    return entities
+        return [{label: [] for label in NER_LABELS} for _ in texts]
+
+    results = []
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        entities = {label: set() for label in NER_LABELS}
+        for ent in doc.ents:
+            if ent.label_ in entities:
+                entities[ent.label_].add(ent.text.strip())
+        # Deduplicate
+        results.append({label: list(names) for label, names in entities.items()})
+    return results
 
 def get_text_quality(text: str) -> float:
     """Estimates text quality based on length and common word density."""
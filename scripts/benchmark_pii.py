@@ -0,0 +1,103 @@
+"""
+PII Masking Benchmark
+Measures masking throughput (MB/s) of the single-pass engine in backend/pii.py,
+whole-text and chunked, against the previous three re.sub passes, and checks
+that all three produce the same text.
+
+Runs on generated OCR-like text by default, or on real files such as the
+archive.org djvu dumps in data/files.
+
+Usage:
+    python scripts/benchmark_pii.py --size-mb 20
+    python scripts/benchmark_pii.py data/files/DataSet_1_COMPLETE_djvu.txt
+"""
+import re
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+from pii import PIIMasker, mask_counts
+
+# The patterns as the old mask_pii applied them, one re.sub each
+LEGACY_PATTERNS = [
+    (r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+', "[EMAIL]"),
+    (r'(\+?\d{1,3}[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}', "[PHONE]"),
+    (r'\d{1,5}\s\w.\s(\w\s?){1,3}\s(Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr)', "[ADDRESS]"),
+]
+WORDS = (
+    "the of and to in flight passenger deposition witness account transfer island ranch townhouse "
+    "Maxwell Epstein Palm Beach Manhattan Teterboro exhibit page EFTA00012345 2002 07/06/2019 $25,000"
+).split()
+PII = ["j.doe+vault@example.com", "(212) 555-0187", "+1 561.555.0143", "12 W. Elm Rd", "9 E. Oak Avenue",
+       "a@b.com_j.doe@example.org"]
+# Inputs the engine must mask exactly like the old passes, besides the generated text
+EDGE_CASES = [
+    "a@b.com_j.doe@example.org",
+    "a@b.com+j.doe@example.org",
+    "mail:x@y.org,(212) 555-0187;12 W. Elm Rd.",
+    "EFTA00012345 ph 3055550143 ext 12",
+]
+
+def legacy_mask(text: str) -> str:
+    for pattern, replacement in LEGACY_PATTERNS:
+        text = re.sub(pattern, replacement, text)
+    return text
+
+def generate(size_mb: float, seed: int = 7) -> str:
+    """Words with PII sprinkled in (about one token in 50), in 80-character lines."""
+    rng = random.Random(seed)
+    lines, line, size = [], [], 0
+    while size < size_mb * 1024 * 1024:
+        token = rng.choice(PII) if rng.random() < 0.02 else rng.choice(WORDS)
+        line.append(token)
+        size += len(token) + 1
+        if sum(len(t) + 1 for t in line) > 80:
+            lines.append(" ".join(line))
+            line = []
+    lines.append(" ".join(line))
+    return "\n".join(lines)
+
+def timed(label: str, func, size_mb: float, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<24} {size_mb / best:8.1f} MB/s  ({best:.2f}s)")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PII masking throughput')
+    parser.add_argument('files', nargs='*', help='Text files to mask (default: generated text)')
+    parser.add_argument('--size-mb', type=float, default=10, help='Generated text size')
+    parser.add_argument('--chunk-kb', type=int, default=1024, help='Chunk size for the chunked run')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per variant; the best is reported')
+    args = parser.parse_args()
+
+    if args.files:
+        text = "".join(Path(f).read_text(encoding="utf-8", errors="ignore") for f in args.files)
+    else:
+        text = generate(args.size_mb)
+    size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+    chunk = args.chunk_kb * 1024
+    masker = PIIMasker()
+    print(f"Masking {size_mb:.1f} MB (best of {args.repeat}):")
+
+    legacy = timed("three re.sub passes", lambda: legacy_mask(text), size_mb, args.repeat)
+    masked, counts = timed("single pass", lambda: masker.mask(text), size_mb, args.repeat)
+    chunked = timed(f"chunked ({args.chunk_kb} KB)", lambda: "".join(
+        masker.mask_chunks(text[i:i + chunk] for i in range(0, len(text), chunk))
+    ), size_mb, args.repeat)
+
+    print(f"  replaced: {mask_counts(counts)}")
+    differ = [case for case in EDGE_CASES if legacy_mask(case) != masker.mask(case)[0]]
+    if legacy != masked or chunked != masked or differ:
+        print(f"  ⚠️  outputs differ {differ or ''}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
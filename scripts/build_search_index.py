@@ -0,0 +1,191 @@
+"""
+Search Index Builder
+Builds the embedded search index (backend/search_index) from the database.
+
+The new index is written next to the live one and swapped in at the end, so
+the API keeps serving the old index while a rebuild runs. After the first
+build, ingesters keep it current through corpus_events.
+
+Pages are split into shards by dataset or page-ID range (see search_shards).
+--shard rebuilds a single page shard and swaps in only that one. The same pass
+exports page text for regex search (search_grep) and signs pages for
+near-duplicate detection (near_duplicates, when numpy is installed); both are
+only refreshed by a full build.
+
+Usage:
+    python scripts/build_search_index.py --batch-size 2000
+    python scripts/build_search_index.py --shard-key range --shard-range 250000
+    python scripts/build_search_index.py --shard DataSet_9
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+from sqlalchemy import or_
+from database import SessionLocal
+from models import Document, Page, AINarrative, FlightLog
+from search_index import SegmentIndex
+from search_shards import ShardedIndex, shard_name, NO_DATASET
+from search_grep import GrepIndex
+import near_duplicates
+from near_duplicates import DuplicateIndex
+import search
+import search_cache
+
+def shard_clause(db, config: dict, name: str):
+    """Filter selecting the pages that belong to shard `name`."""
+    if config["key"] == "range":
+        if not name.startswith("ids_") or not name[4:].isdigit():
+            raise ValueError(f"Not a range shard: {name}")
+        low = int(name[4:]) * config["range"]
+        return (Page.id >= low) & (Page.id < low + config["range"])
+    if name == NO_DATASET:
+        return or_(Document.dataset.is_(None), Document.dataset == "")
+    # Shard names are sanitized dataset names, so match them the same way
+    datasets = [d for (d,) in db.query(Document.dataset).distinct() if d and shard_name(config, 0, {"dataset": d}) == name]
+    return Document.dataset.in_(datasets)
+
+def build_pages(db, index: ShardedIndex, batch_size: int, shard: str = None, grep: GrepIndex = None,
+                dedup: DuplicateIndex = None) -> int:
+    rows = db.query(
+        Page.id, Page.document_id, Page.page_num, Page.text_content,
+        Document.dataset, Document.doc_type
+    ).outerjoin(Document, Document.id == Page.document_id)
+    if shard is not None:
+        rows = rows.filter(shard_clause(db, index.config(), shard))
+    rows = rows.order_by(Page.id).yield_per(batch_size)
+
+    count = 0
+    started = time.time()
+    batch = []
+
+    def add_batch():
+        # Country codes come from page entities, looked up once per batch
+        search.attach_page_fields(batch)
+        index.add_many((r["id"], r["text_content"], search._page_fields(r), False) for r in batch)
+        if grep is not None:
+            for r in batch:
+                grep.add(r["id"], r["text_content"], search._page_fields(r))
+        if dedup is not None:
+            # Pages arrive in id order, so each cluster is named after its oldest page
+            dedup.add([(r["id"], r["text_content"]) for r in batch])
+
+    for row in rows:
+        batch.append(dict(row._mapping))
+        count += 1
+        if len(batch) >= batch_size:
+            add_batch()
+            batch = []
+            print(f"  ..{count} pages indexed ({count / (time.time() - started):.0f} pages/sec)")
+    add_batch()
+    return count
+
+def build(staging: str, batch_size: int, shard_key: str, shard_range: int):
+    indexes = {
+        name: SegmentIndex(os.path.join(staging, name), flush_docs=batch_size, flush_seconds=0)
+        for name in ("narratives", "flights")
+    }
+    indexes["pages"] = ShardedIndex(os.path.join(staging, "pages"), flush_docs=batch_size, flush_seconds=0)
+    indexes["pages"].create(shard_key, shard_range)
+    for name in ("narratives", "flights"):
+        indexes[name].create()
+    grep = GrepIndex(os.path.join(staging, "grep"))
+    grep.create()
+    dedup = None
+    if near_duplicates.available():
+        dedup = DuplicateIndex(os.path.join(staging, "dedup"))
+        dedup.create()
+    else:
+        print("⚠️  numpy not installed; skipping the near-duplicate index")
+
+    db = SessionLocal()
+    try:
+        pages = build_pages(db, indexes["pages"], batch_size, grep=grep, dedup=dedup)
+        for n in db.query(AINarrative).yield_per(batch_size):
+            indexes["narratives"].add(n.id, search.narrative_text(n), {"narrative_type": n.narrative_type})
+        for f in db.query(FlightLog).yield_per(batch_size):
+            indexes["flights"].add(f.id, search.flight_text(f), {"tail_number": f.tail_number, "doc_reference": f.doc_reference})
+    finally:
+        db.close()
+
+    for index in indexes.values():
+        index.close()
+    grep.close()
+    return pages
+
+def swap_in(staging: str, target: str):
+    """Replace each sub-index directory of the live index with its rebuilt copy."""
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(staging):
+        live = os.path.join(target, name)
+        retired = live + ".old"
+        if os.path.exists(live):
+            os.replace(live, retired)
+        os.replace(os.path.join(staging, name), live)
+        shutil.rmtree(retired, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+
+def rebuild_shard(index_dir: str, shard: str, batch_size: int) -> int:
+    """Rebuild one page shard next to the live shards and swap in only that one."""
+    live = ShardedIndex(os.path.join(index_dir, "pages"))
+    if not live.exists() or live.is_legacy():
+        raise SystemExit("❌ The page index is not sharded yet; run a full build first")
+    config = live.config()
+    if config["key"] == "dataset":
+        shard = shard_name(config, 0, {"dataset": shard})
+    staging = os.path.join(index_dir, "pages", shard + ".building")
+    shutil.rmtree(staging, ignore_errors=True)
+
+    # Same routing as the live index, so only this shard's pages land in staging
+    index = ShardedIndex(staging, flush_docs=batch_size, flush_seconds=0)
+    index.create(config["key"], config["range"])
+    db = SessionLocal()
+    try:
+        count = build_pages(db, index, batch_size, shard=shard)
+    finally:
+        db.close()
+    index.close()
+
+    target = live.shard_path(shard)
+    retired = target + ".old"
+    if os.path.exists(target):
+        os.replace(target, retired)
+    if os.path.exists(index.shard_path(shard)):
+        os.replace(index.shard_path(shard), target)
+    shutil.rmtree(retired, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the embedded search index from the database')
+    parser.add_argument('--batch-size', type=int, default=2000, help='Documents per segment flush')
+    parser.add_argument('--index-dir', default=search.SEARCH_INDEX_DIR, help='Target index directory')
+    parser.add_argument('--shard-key', choices=['dataset', 'range'], default=None,
+                        help='Split pages by dataset or page-ID range (default SEARCH_SHARD_KEY)')
+    parser.add_argument('--shard-range', type=int, default=None, help='Pages per range shard')
+    parser.add_argument('--shard', default=None, help='Rebuild only this page shard (e.g. a dataset name)')
+    args = parser.parse_args()
+
+    if args.shard:
+        started = time.time()
+        count = rebuild_shard(args.index_dir, args.shard, args.batch_size)
+        search_cache.bump_generation()
+        print(f"✅ Indexed {count} pages in {time.time() - started:.1f}s -> shard {args.shard}")
+        return
+
+    staging = args.index_dir.rstrip(os.sep) + ".building"
+    shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"Building search index in {staging}...")
+    started = time.time()
+    count = build(staging, args.batch_size, args.shard_key, args.shard_range)
+    swap_in(staging, args.index_dir)
+    search_cache.bump_generation()
+    print(f"✅ Indexed {count} pages in {time.time() - started:.1f}s -> {args.index_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Semantic Index Builder
+Fits the TF-IDF/LSA embedding model on a sample of pages, embeds every page in
+batches and trains the IVF lists (backend/search_index/semantic).
+
+Like build_search_index.py, the new index is built next to the live one and
+swapped in at the end. Afterwards ingesters embed new pages as they commit, so
+this only needs re-running to refit the model to a changed corpus.
+
+Usage:
+    python scripts/build_semantic_index.py --sample 20000 --batch-size 2000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+from sqlalchemy import func
+from database import SessionLocal
+from models import Page
+import semantic
+import search
+import search_cache
+
+def fit_model(db, sample: int, dims: int) -> "semantic.EmbeddingModel":
+    rows = db.query(Page.text_content).filter(Page.text_content.isnot(None)) \
+        .order_by(func.random()).limit(sample).all()
+    print(f"Fitting embedding model on {len(rows)} sampled pages ({dims} dims)...")
+    started = time.time()
+    model = semantic.EmbeddingModel.fit([r.text_content for r in rows], dims=dims)
+    print(f"  ..vocabulary {len(model.vocab)} terms in {time.time() - started:.1f}s")
+    return model
+
+def embed_all(db, index: "semantic.SemanticIndex", batch_size: int) -> int:
+    count = 0
+    started = time.time()
+    batch = []
+    for row in db.query(Page.id, Page.text_content).order_by(Page.id).yield_per(batch_size):
+        batch.append((row.id, row.text_content or ""))
+        if len(batch) >= batch_size:
+            index.add(batch)
+            count += len(batch)
+            batch = []
+            print(f"  ..{count} pages embedded ({count / (time.time() - started):.0f} pages/sec)")
+    index.add(batch)
+    return count + len(batch)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the semantic (embedding) search index from the database')
+    parser.add_argument('--sample', type=int, default=20000, help='Pages used to fit the model')
+    parser.add_argument('--batch-size', type=int, default=2000, help='Pages embedded per batch')
+    parser.add_argument('--dims', type=int, default=semantic.DIMS, help='Embedding dimensions')
+    parser.add_argument('--nlist', type=int, default=None, help='IVF lists (default ~4*sqrt(pages))')
+    parser.add_argument('--index-dir', default=search.SEARCH_INDEX_DIR, help='Target index directory')
+    args = parser.parse_args()
+
+    if not semantic.available():
+        print("❌ Semantic search needs numpy and scipy (pip install -r backend/requirements.txt)")
+        sys.exit(1)
+
+    target = os.path.join(args.index_dir, "semantic")
+    staging = target + ".building"
+    shutil.rmtree(staging, ignore_errors=True)
+
+    started = time.time()
+    db = SessionLocal()
+    try:
+        index = semantic.SemanticIndex(staging)
+        index.create(fit_model(db, args.sample, args.dims))
+        count = embed_all(db, index, args.batch_size)
+    finally:
+        db.close()
+
+    print("Training IVF lists...")
+    index.train(nlist=args.nlist)
+
+    retired = target + ".old"
+    if os.path.exists(target):
+        os.replace(target, retired)
+    os.replace(staging, target)
+    shutil.rmtree(retired, ignore_errors=True)
+    search_cache.bump_generation()
+    print(f"✅ Embedded {count} pages in {time.time() - started:.1f}s -> {target}")
+
+if __name__ == "__main__":
+    main()
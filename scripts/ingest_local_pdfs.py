@@ -8,6 +8,7 @@ sys.path.append(str(Path(__file__).parent.parent / "backend"))
 
 from database import SessionLocal, init_db
 from models import Document, Page
+from pii import mask_pii
 from PyPDF2 import PdfReader
 import os
 
@@ -65,7 +66,7 @@ def ingest_local_pdfs():
                             page = Page(
                                 document_id=document.id,
                                 page_num=page_num,
-                                text_content=text[:10000],  # Limit to 10k chars per page
+                                text_content=mask_pii(text)[:10000],  # Limit to 10k chars per page
                                 text_quality=0.7,
                                 media_type='pdf_page'
                             )
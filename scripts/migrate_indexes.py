@@ -0,0 +1,40 @@
+"""
+Index Migration
+Builds the indexes declared on the models that an existing database doesn't
+have yet (init_db only creates tables, and create_all indexes only the tables
+it creates), and on Postgres the pg_trgm suggestion indexes. There each index
+is built with CREATE INDEX CONCURRENTLY, so ingestion and the API keep writing
+while it runs.
+
+Usage:
+    python scripts/migrate_indexes.py
+"""
+import sys
+import time
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+from database import engine, missing_indexes
+from search_schema import create_index_concurrently, ensure_postgres_trigrams
+
+def build_model_indexes():
+    for index in missing_indexes():
+        target = f"{index.table.name} ({', '.join(column.name for column in index.columns)})"
+        print(f"Building {index.name} on {target}...")
+        started = time.time()
+        try:
+            create_index_concurrently(engine, index.name, target)
+        except Exception as e:
+            print(f"  ⚠️  {index.name} failed: {e}")
+            continue
+        print(f"  ..done in {time.time() - started:.1f}s")
+
+def main():
+    build_model_indexes()
+    if engine.dialect.name == "postgresql":
+        print("Building trigram suggestion indexes...")
+        ensure_postgres_trigrams(engine)
+    print("Indexes ready.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Search Vector Migration
+Backfills pages.search_vector in small batches and builds the GIN index
+without blocking a live Postgres database.
+
+Usage:
+    python scripts/migrate_search_vector.py --batch-size 5000 --sleep 0.1
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+from sqlalchemy import text
+from database import engine
+from search_schema import (
+    create_index_concurrently,
+    ensure_postgres_search_vector,
+    SEARCH_VECTOR_INDEX,
+)
+
+def backfill(batch_size: int, pause: float):
+    """
+    Populate search_vector by primary-key ranges, one short transaction per batch.
+    The no-op update of text_content runs the maintenance trigger, so a page
+    whose vector exceeds the tsvector size limit is left NULL instead of
+    aborting the batch.
+    """
+    with engine.connect() as conn:
+        max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM pages")).scalar()
+
+    print(f"Backfilling search_vector for pages 1..{max_id} in batches of {batch_size}")
+    last_id = 0
+    total = 0
+    started = time.time()
+
+    while last_id < max_id:
+        upper = last_id + batch_size
+        with engine.begin() as conn:
+            result = conn.execute(
+                text("""
+                    UPDATE pages SET text_content = text_content
+                    WHERE id > :lo AND id <= :hi
+                      AND search_vector IS NULL AND text_content IS NOT NULL
+                """),
+                {"lo": last_id, "hi": upper}
+            )
+            total += result.rowcount or 0
+        last_id = upper
+
+        elapsed = time.time() - started
+        print(f"  ..id {min(last_id, max_id)}/{max_id} | {total} rows updated | {elapsed:.1f}s")
+        if pause:
+            time.sleep(pause)
+
+    return total
+
+def build_index():
+    print(f"Building GIN index {SEARCH_VECTOR_INDEX} (concurrently)...")
+    create_index_concurrently(engine, SEARCH_VECTOR_INDEX, "pages USING gin (search_vector)")
+    print("Index ready.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill pages.search_vector and build its GIN index')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Pages per UPDATE transaction')
+    parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to pause between batches')
+    parser.add_argument('--skip-index', action='store_true', help='Only backfill, do not build the index')
+    args = parser.parse_args()
+
+    if engine.dialect.name != "postgresql":
+        print("search_vector is only used on Postgres; nothing to migrate.")
+        return
+
+    # Column and trigger first, so rows written during the backfill are covered
+    ensure_postgres_search_vector(engine, check_index=False)
+    count = backfill(args.batch_size, args.sleep)
+    print(f"Backfill complete: {count} pages vectorized")
+
+    if not args.skip_index:
+        build_index()
+
+if __name__ == "__main__":
+    main()
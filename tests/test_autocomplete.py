@@ -0,0 +1,50 @@
+import os
+import sys
+import random
+import tempfile
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp(prefix="vault-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'vault.db')}"
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import autocomplete
+from autocomplete import PrefixIndex, TOPK_DEPTH
+
+WORDS = ["maxwell", "epstein", "marina", "palm", "beach", "manhattan", "mark", "paul", "pilot", "ranch"]
+
+def expected(index, prefix, limit):
+    """Brute-force completions over every entry."""
+    prefix = autocomplete.normalize(prefix)
+    entries = index._view.entries
+    matches = []
+    for ref, (label, alt, weight) in entries.items():
+        starts = autocomplete._word_starts(label) + (autocomplete._word_starts(alt) if alt else [])
+        if any(s.startswith(prefix) for s in starts):
+            matches.append(ref)
+    matches.sort(key=lambda ref: (-entries[ref][2], ref))
+    labels = []
+    for ref in matches:
+        if entries[ref][0] not in labels:
+            labels.append(entries[ref][0])
+    return labels[:limit]
+
+def test_batches_match_a_full_rebuild():
+    rng = random.Random(3)
+    label = lambda: f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {rng.randint(0, 99)}"
+    index = PrefixIndex(os.path.join(_tmp, "autocomplete.json"))
+    index._replace_all([["entity", i, label(), None, rng.randint(0, 20)] for i in range(TOPK_DEPTH * 5)])
+
+    for _ in range(5):
+        records = [{"op": "add", "kind": "entity", "id": rng.randint(0, TOPK_DEPTH * 8), "label": label(),
+                    "weight": rng.randint(0, 40)} for _ in range(50)]
+        records += [{"op": "mention", "id": rng.randint(0, TOPK_DEPTH * 5), "n": rng.randint(-30, 30)}
+                    for _ in range(50)]
+        index._apply_batch(records)
+        for prefix in ["m", "ma", "mar", "mark", "p", "pa", "palm b", "z"]:
+            assert [r["text"] for r in index.complete(prefix, limit=10)] == expected(index, prefix, 10)
+
+    rebuilt = PrefixIndex(os.path.join(_tmp, "rebuilt.json"))
+    rebuilt._replace_all(index._rows())
+    assert rebuilt._view.keys == index._view.keys
+    assert rebuilt._view.topk == index._view.topk
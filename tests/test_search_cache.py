@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The database, indexes and cache file live in a scratch directory for this module
+_tmp = tempfile.mkdtemp(prefix="vault-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'vault.db')}"
+os.environ["SEARCH_INDEX_DIR"] = os.path.join(_tmp, "search_index")
+os.environ["SEARCH_CACHE_PATH"] = os.path.join(_tmp, "search_cache.db")
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import pytest
+from database import SessionLocal, init_db
+from models import Document, Page
+import search
+import search_cache
+
+@pytest.fixture
+def pages():
+    init_db()
+    db = SessionLocal()
+    doc = Document(filename="similar.pdf", path="similar.pdf", doc_type="PDF")
+    db.add(doc)
+    db.flush()
+    rows = [Page(document_id=doc.id, page_num=i + 1, text_content=f"flight log page {i}") for i in range(3)]
+    db.add_all(rows)
+    db.commit()
+    ids = [row.id for row in rows]
+    yield db, ids
+    db.close()
+
+def test_similar_pages_served_from_cache(pages, monkeypatch):
+    db, (page_id, *others) = pages
+    calls = []
+
+    def similar(pid, limit=10):
+        calls.append(pid)
+        return [(other, 0.9 - i / 10) for i, other in enumerate(others)]
+
+    monkeypatch.setattr(search._semantic_index, "similar", similar)
+    hits_before = search_cache.cache.counters["hits"]
+
+    first = search.similar_pages(page_id, db, limit=5)
+    second = search.similar_pages(page_id, db, limit=5)
+
+    assert [hit["_source"]["page_id"] for hit in first] == others
+    assert second == first
+    assert calls == [page_id]
+    assert search_cache.cache.counters["hits"] == hits_before + 1
@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import pytest
+from search_grep import GrepIndex, compile_pattern
+
+@pytest.fixture
+def grep_index():
+    index = GrepIndex(os.path.join(tempfile.mkdtemp(prefix="vault-test-"), "grep"), block_pages=2, workers=2)
+    index.create()
+    for key in range(6):
+        # Odd pages make "(a+)+$" backtrack far past any timeout
+        index.add(key, "a" * 32 + "b" if key % 2 else f"flight N908JE page {key}")
+    index.flush()
+    yield index
+    index.close()
+
+def test_timeout_leaves_other_greps_running(grep_index):
+    errors = []
+
+    def stuck():
+        try:
+            list(grep_index.grep(compile_pattern("(a+)+$"), timeout=1))
+        except TimeoutError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=stuck)
+    thread.start()
+    hits = [hit for batch in grep_index.grep(compile_pattern("N908JE"), timeout=30) for hit in batch]
+    thread.join()
+
+    assert len(errors) == 1
+    assert sorted(key for key, *_ in hits) == [0, 2, 4]
+    # The stuck grep's workers were replaced; a later grep still runs
+    assert [key for batch in grep_index.grep(compile_pattern("page 4")) for key, *_ in batch] == [4]
@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import pytest
+from search_index import SegmentIndex
+
+def pages(index, query, limit, after=None):
+    return [hit[1] for hit in index.search(query, limit=limit, after=after)]
+
+@pytest.fixture
+def tied_index(tmp_path):
+    # Same text in separate segments: equal scores, the larger key flushed first
+    index = SegmentIndex(str(tmp_path / "index"), flush_seconds=0)
+    index.create()
+    for key in (10, 5, 7):
+        index.add(key, "maxwell flight log")
+        index.flush()
+    yield index
+    index.close()
+
+@pytest.mark.parametrize("query", ["maxwell", "maxwell flight", "maxwell OR dershowitz"])
+def test_ties_rank_by_ascending_key(tied_index, query):
+    assert pages(tied_index, query, 3) == [5, 7, 10]
+    assert pages(tied_index, query, 1) == [5]
+
+@pytest.mark.parametrize("query", ["maxwell", "maxwell flight", "maxwell OR dershowitz"])
+def test_ties_across_page_boundary(tied_index, query):
+    seen, after = [], None
+    while True:
+        hits = tied_index.search(query, limit=1, after=after)
+        if not hits:
+            break
+        seen.append(hits[0][1])
+        after = (hits[0][0], hits[0][1])
+    assert seen == [5, 7, 10]
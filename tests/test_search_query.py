@@ -0,0 +1,116 @@
+import sys
+import sqlite3
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import pytest
+import search_query
+from search_query import parse, to_tsquery, to_fts5, like_patterns, Term, Phrase, Near, And, Or, Not, Field
+from search_index import SegmentIndex
+
+@pytest.mark.parametrize("query, text", [
+    ("little st james", And((Term("little"), Term("st"), Term("james")))),
+    ('"little st james"', Phrase(("little", "st", "james"))),
+    ("o'brien", Phrase(("o", "brien"))),
+    ("near or", And((Term("near"), Term("or")))),
+    # Dangling operators and an unclosed group are dropped, not errors
+    ("maxwell NEAR", Term("maxwell")),
+    ("(maxwell OR epstein", Or((Term("maxwell"), Term("epstein")))),
+    ("maxwell NEAR epstein", Near((Term("maxwell"), Term("epstein")), search_query.DEFAULT_NEAR)),
+    ("a NEAR/5 b NEAR/5 c", Near((Term("a"), Term("b"), Term("c")), 5)),
+    # A change of distance starts a new group on the shared operand
+    ("a NEAR/5 b NEAR/3 c", And((Near((Term("a"), Term("b")), 5), Near((Term("b"), Term("c")), 3)))),
+    ('"little st james" NEAR/3 island', Near((Phrase(("little", "st", "james")), Term("island")), 3)),
+    ("maxwell -dershowitz", And((Term("maxwell"), Not(Term("dershowitz"))))),
+    ("maxwell NOT (paris OR london)", And((Term("maxwell"), Not(Or((Term("paris"), Term("london"))))))),
+])
+def test_parse_text(query, text):
+    assert parse(query) == (text, None)
+
+@pytest.mark.parametrize("query, where", [
+    ("maxwell page:5..20", Field("page", "..", (5, 20))),
+    ("maxwell page:..20", Field("page", "..", (None, 20))),
+    ("maxwell page:>10", Field("page", ">", 10)),
+    ("maxwell country:us", Field("country", "=", "US")),
+    ('maxwell entity:"Ghislaine Maxwell"', Field("entity", "=", "Ghislaine Maxwell")),
+    ("maxwell -type:PDF", Not(Field("doc_type", "=", "PDF"))),
+])
+def test_parse_fields(query, where):
+    assert parse(query) == (Term("maxwell"), where)
+
+@pytest.mark.parametrize("query, message", [
+    ("-maxwell", "Exclusions"),
+    ("dataset:Justice.gov", "at least one word"),
+    ("maxwell OR dataset:Justice.gov", "AND and NOT only"),
+    ("maxwell NEAR (paris OR london)", "NEAR joins"),
+    ("maxwell NEAR/21 epstein", "NEAR/20"),
+    ("maxwell page:abc", "page:"),
+    ("maxwell type:>3", "exact values"),
+])
+def test_parse_errors(query, message):
+    with pytest.raises(ValueError, match=message):
+        parse(query)
+
+def test_to_tsquery():
+    assert to_tsquery(parse("maxwell -dershowitz").text) == "(maxwell & !dershowitz)"
+    assert to_tsquery(parse('maxwell NOT "flight log"').text) == "(maxwell & !(flight <-> log))"
+    assert to_tsquery(parse("paris OR london").text) == "(paris | london)"
+    assert to_tsquery(parse("a NEAR/1 b").text) == "((a <1> b | b <1> a | a <2> b | b <2> a))"
+    # Three operands: one pair constraint per neighbouring pair
+    assert to_tsquery(parse("a NEAR/0 b NEAR/0 c").text) == "((a <1> b | b <1> a) & (b <1> c | c <1> b))"
+    # NEAR/N allows N words between, so N + 1 distances in each order
+    assert to_tsquery(parse("a NEAR/20 b").text).count("|") == 2 * 21 - 1
+
+def test_to_fts5():
+    assert to_fts5(parse("maxwell -dershowitz").text) == '(("maxwell") NOT "dershowitz")'
+    assert to_fts5(parse("maxwell NOT (paris OR london)").text) == '(("maxwell") NOT ("paris" OR "london"))'
+    assert to_fts5(parse('"little st james" NEAR/3 island').text) == 'NEAR("little st james" "island", 3)'
+    assert to_fts5(parse("a NEAR/5 b NEAR/5 c").text) == 'NEAR("a" "b" "c", 5)'
+    # Operator words in lower case are quoted like any other word
+    assert to_fts5(parse("near or").text) == '("near" AND "or")'
+
+def test_like_patterns():
+    assert like_patterns(parse('"little st james"').text) == ["%little%st%james%"]
+    assert like_patterns(parse('maxwell NEAR "flight log"').text) == ["%maxwell%", "%flight%log%"]
+
+CORPUS = {
+    1: "maxwell boarded the flight to the island",
+    2: "epstein and maxwell on little st james island",
+    3: "flight log lists maxwell paris london",
+    4: "dershowitz named in the flight log",
+    5: "maxwell epstein island",
+    6: "island visit by epstein with maxwell in paris",
+}
+
+@pytest.fixture(scope="module")
+def engines(tmp_path_factory):
+    fts = sqlite3.connect(":memory:")
+    fts.execute("CREATE VIRTUAL TABLE pages_fts USING fts5(text_content, tokenize='porter unicode61')")
+    fts.executemany("INSERT INTO pages_fts(rowid, text_content) VALUES (?, ?)", CORPUS.items())
+    index = SegmentIndex(str(tmp_path_factory.mktemp("index")), flush_seconds=0)
+    index.create()
+    for key, text in CORPUS.items():
+        index.add(key, text)
+    index.flush()
+    yield fts, index
+    index.close()
+    fts.close()
+
+@pytest.mark.parametrize("query", [
+    "maxwell island",
+    '"flight log"',
+    "maxwell NEAR/1 island",
+    "maxwell NEAR/5 island",
+    "epstein NEAR/1 maxwell NEAR/1 island",
+    '"little st james" NEAR/0 island',
+    "paris OR london",
+    "maxwell -paris",
+    "flight NOT (dershowitz OR paris)",
+    "(epstein OR dershowitz) island",
+])
+def test_fts5_and_embedded_index_agree(engines, query):
+    fts, index = engines
+    node = parse(query).text
+    matched = {row[0] for row in fts.execute("SELECT rowid FROM pages_fts WHERE pages_fts MATCH ?", (to_fts5(node),))}
+    assert matched == {hit[1] for hit in index.search(query, limit=len(CORPUS))}
+    assert matched  # every case should match something